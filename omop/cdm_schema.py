@@ -0,0 +1,275 @@
+import polars as pl
+
+# OMOP CDM v5.4 column order and types for every table this project writes.
+# concept ids fit in Int32, surrogate keys get Int64 and low cardinality
+# source values are stored as categoricals.
+CONCEPT_ID = pl.Int32
+KEY = pl.Int64
+SOURCE_CODE = pl.Categorical
+
+CDM_SCHEMAS: dict[str, dict[str, pl.PolarsDataType]] = {
+    "person": {
+        "person_id": KEY,
+        "gender_concept_id": CONCEPT_ID,
+        "year_of_birth": pl.Int32,
+        "month_of_birth": pl.Int32,
+        "day_of_birth": pl.Int32,
+        "birth_datetime": pl.Datetime,
+        "race_concept_id": CONCEPT_ID,
+        "ethnicity_concept_id": CONCEPT_ID,
+        "location_id": KEY,
+        "provider_id": KEY,
+        "care_site_id": KEY,
+        "person_source_value": pl.Utf8,
+        "gender_source_value": SOURCE_CODE,
+        "gender_source_concept_id": CONCEPT_ID,
+        "race_source_value": SOURCE_CODE,
+        "race_source_concept_id": CONCEPT_ID,
+        "ethnicity_source_value": SOURCE_CODE,
+        "ethnicity_source_concept_id": CONCEPT_ID,
+    },
+    "location": {
+        "location_id": KEY,
+        "address_1": pl.Utf8,
+        "address_2": pl.Utf8,
+        "city": SOURCE_CODE,
+        "state": SOURCE_CODE,
+        "zip": pl.Utf8,
+        "county": SOURCE_CODE,
+        "location_source_value": pl.Utf8,
+        "country_concept_id": CONCEPT_ID,
+        "country_source_value": SOURCE_CODE,
+        "latitude": pl.Float64,
+        "longitude": pl.Float64,
+    },
+    "death": {
+        "person_id": KEY,
+        "death_date": pl.Date,
+        "death_datetime": pl.Datetime,
+        "death_type_concept_id": CONCEPT_ID,
+        "cause_concept_id": CONCEPT_ID,
+        "cause_source_value": pl.Utf8,
+        "cause_source_concept_id": CONCEPT_ID,
+    },
+    "visit_occurrence": {
+        "visit_occurrence_id": KEY,
+        "person_id": KEY,
+        "visit_concept_id": CONCEPT_ID,
+        "visit_start_date": pl.Date,
+        "visit_start_datetime": pl.Datetime,
+        "visit_end_date": pl.Date,
+        "visit_end_datetime": pl.Datetime,
+        "visit_type_concept_id": CONCEPT_ID,
+        "provider_id": KEY,
+        "care_site_id": KEY,
+        "visit_source_value": SOURCE_CODE,
+        "visit_source_concept_id": CONCEPT_ID,
+        "admitted_from_concept_id": CONCEPT_ID,
+        "admitted_from_source_value": SOURCE_CODE,
+        "discharged_to_concept_id": CONCEPT_ID,
+        "discharged_to_source_value": SOURCE_CODE,
+        "preceding_visit_occurrence_id": KEY,
+    },
+    "condition_occurrence": {
+        "condition_occurrence_id": KEY,
+        "person_id": KEY,
+        "condition_concept_id": CONCEPT_ID,
+        "condition_start_date": pl.Date,
+        "condition_start_datetime": pl.Datetime,
+        "condition_end_date": pl.Date,
+        "condition_end_datetime": pl.Datetime,
+        "condition_type_concept_id": CONCEPT_ID,
+        "condition_status_concept_id": CONCEPT_ID,
+        "stop_reason": pl.Utf8,
+        "provider_id": KEY,
+        "visit_occurrence_id": KEY,
+        "visit_detail_id": KEY,
+        "condition_source_value": pl.Utf8,
+        "condition_source_concept_id": CONCEPT_ID,
+        "condition_status_source_value": SOURCE_CODE,
+    },
+    "drug_exposure": {
+        "drug_exposure_id": KEY,
+        "person_id": KEY,
+        "drug_concept_id": CONCEPT_ID,
+        "drug_exposure_start_date": pl.Date,
+        "drug_exposure_start_datetime": pl.Datetime,
+        "drug_exposure_end_date": pl.Date,
+        "drug_exposure_end_datetime": pl.Datetime,
+        "verbatim_end_date": pl.Date,
+        "drug_type_concept_id": CONCEPT_ID,
+        "stop_reason": pl.Utf8,
+        "refills": pl.Int32,
+        "quantity": pl.Float64,
+        "days_supply": pl.Int32,
+        "sig": pl.Utf8,
+        "route_concept_id": CONCEPT_ID,
+        "lot_number": pl.Utf8,
+        "provider_id": KEY,
+        "visit_occurrence_id": KEY,
+        "visit_detail_id": KEY,
+        "drug_source_value": pl.Utf8,
+        "drug_source_concept_id": CONCEPT_ID,
+        "route_source_value": SOURCE_CODE,
+        "dose_unit_source_value": SOURCE_CODE,
+    },
+    "procedure_occurrence": {
+        "procedure_occurrence_id": KEY,
+        "person_id": KEY,
+        "procedure_concept_id": CONCEPT_ID,
+        "procedure_date": pl.Date,
+        "procedure_datetime": pl.Datetime,
+        "procedure_end_date": pl.Date,
+        "procedure_end_datetime": pl.Datetime,
+        "procedure_type_concept_id": CONCEPT_ID,
+        "modifier_concept_id": CONCEPT_ID,
+        "quantity": pl.Int32,
+        "provider_id": KEY,
+        "visit_occurrence_id": KEY,
+        "visit_detail_id": KEY,
+        "procedure_source_value": pl.Utf8,
+        "procedure_source_concept_id": CONCEPT_ID,
+        "modifier_source_value": SOURCE_CODE,
+    },
+    "measurement": {
+        "measurement_id": KEY,
+        "person_id": KEY,
+        "measurement_concept_id": CONCEPT_ID,
+        "measurement_date": pl.Date,
+        "measurement_datetime": pl.Datetime,
+        "measurement_time": pl.Utf8,
+        "measurement_type_concept_id": CONCEPT_ID,
+        "operator_concept_id": CONCEPT_ID,
+        "value_as_number": pl.Float64,
+        "value_as_concept_id": CONCEPT_ID,
+        "unit_concept_id": CONCEPT_ID,
+        "range_low": pl.Float64,
+        "range_high": pl.Float64,
+        "provider_id": KEY,
+        "visit_occurrence_id": KEY,
+        "visit_detail_id": KEY,
+        "measurement_source_value": pl.Utf8,
+        "measurement_source_concept_id": CONCEPT_ID,
+        "unit_source_value": SOURCE_CODE,
+        "unit_source_concept_id": CONCEPT_ID,
+        "value_source_value": pl.Utf8,
+        "measurement_event_id": KEY,
+        "meas_event_field_concept_id": CONCEPT_ID,
+    },
+    "note": {
+        "note_id": KEY,
+        "person_id": KEY,
+        "note_date": pl.Date,
+        "note_datetime": pl.Datetime,
+        "note_type_concept_id": CONCEPT_ID,
+        "note_class_concept_id": CONCEPT_ID,
+        "note_title": pl.Utf8,
+        "note_text": pl.Utf8,
+        "encoding_concept_id": CONCEPT_ID,
+        "language_concept_id": CONCEPT_ID,
+        "provider_id": KEY,
+        "visit_occurrence_id": KEY,
+        "visit_detail_id": KEY,
+        "note_source_value": SOURCE_CODE,
+        "note_event_id": KEY,
+        "note_event_field_concept_id": CONCEPT_ID,
+    },
+    "note_nlp": {
+        "note_nlp_id": KEY,
+        "note_id": KEY,
+        "section_concept_id": CONCEPT_ID,
+        "snippet": pl.Utf8,
+        # character offset of the mention in the note, an integer so it sorts
+        "offset": pl.Int32,
+        "lexical_variant": pl.Utf8,
+        "note_nlp_concept_id": CONCEPT_ID,
+        "note_nlp_source_concept_id": CONCEPT_ID,
+        "nlp_system": SOURCE_CODE,
+        "nlp_date": pl.Date,
+        "nlp_datetime": pl.Datetime,
+        "term_exists": SOURCE_CODE,
+        "term_temporal": SOURCE_CODE,
+        "term_modifiers": pl.Utf8,
+    },
+    "observation_period": {
+        "observation_period_id": KEY,
+        "person_id": KEY,
+        "observation_period_start_date": pl.Date,
+        "observation_period_end_date": pl.Date,
+        "period_type_concept_id": CONCEPT_ID,
+    },
+    "cohort_definition": {
+        "cohort_definition_id": KEY,
+        "cohort_definition_name": pl.Utf8,
+        "cohort_definition_description": pl.Utf8,
+        "definition_type_concept_id": CONCEPT_ID,
+        "cohort_definition_syntax": pl.Utf8,
+        "subject_concept_id": CONCEPT_ID,
+        "cohort_initiation_date": pl.Date,
+    },
+    "cohort": {
+        "cohort_definition_id": KEY,
+        "subject_id": KEY,
+        "cohort_start_date": pl.Date,
+        "cohort_end_date": pl.Date,
+    },
+}
+
+
+def conform(df: pl.LazyFrame | pl.DataFrame, table: str) -> pl.LazyFrame | pl.DataFrame:
+    """Select and cast the columns of an OMOP table to its CDM v5.4 schema.
+
+    Columns are put in CDM order, columns the builder did not produce are added
+    as typed nulls and anything outside of the CDM is dropped. Casts are not
+    strict so unparsable source values end up null instead of failing the build.
+
+    Args:
+        df (pl.LazyFrame | pl.DataFrame): the OMOP table, usually at the end of its plan
+        table (str): CDM table name, e.g. "drug_exposure"
+
+    Returns:
+        pl.LazyFrame | pl.DataFrame: the conformed table, same kind as `df`
+    """
+    schema = CDM_SCHEMAS[table]
+    present = set(df.columns)
+    return df.select(
+        [
+            pl.col(col).cast(dtype, strict=False)
+            if col in present
+            else pl.lit(None).cast(dtype).alias(col)
+            for col, dtype in schema.items()
+        ]
+    )
+
+
+# file stem each table is written under in `DEST_DIR`
+TABLE_FILES: dict[str, str] = {
+    "person": "Person",
+    "location": "Location",
+    "death": "Death",
+    "visit_occurrence": "Visit_Occurrence",
+    "condition_occurrence": "Condition_occurrence",
+    "drug_exposure": "Drug_Exposure",
+    "procedure_occurrence": "Procedure_occurrence",
+    "measurement": "Measurement",
+    "note": "Note",
+    "note_nlp": "Note_NLP",
+    "observation_period": "Observation_Period",
+    "cohort_definition": "Cohort_Definition",
+    "cohort": "Cohort",
+}
+
+# CDM primary keys, death and cohort have none
+PRIMARY_KEYS: dict[str, str] = {
+    "person": "person_id",
+    "location": "location_id",
+    "visit_occurrence": "visit_occurrence_id",
+    "condition_occurrence": "condition_occurrence_id",
+    "drug_exposure": "drug_exposure_id",
+    "procedure_occurrence": "procedure_occurrence_id",
+    "measurement": "measurement_id",
+    "note": "note_id",
+    "note_nlp": "note_nlp_id",
+    "observation_period": "observation_period_id",
+    "cohort_definition": "cohort_definition_id",
+}
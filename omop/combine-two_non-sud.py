@@ -450,40 +450,33 @@ ALL_TABLES["labs"] = labs
 # ### AEHR section
 
 
-def select_aehr_note_text(row: dict[str, str]) -> str:
+def select_aehr_note_text(is_xml: pl.Expr) -> pl.Expr:
     """Select which field to use for the AEHR NOTE_TEXT column.
 
     Args:
-        row (dict[str, str]): a row from the AEHR notes dataset
+        is_xml (pl.Expr): whether `EditableChunkCompressed_PlainText` holds XML
 
     Returns:
-        str: the selected text
+        pl.Expr: the selected text
     """
-    prefer1 = row["UnEditableChunkCompressed_PlainText"]
-    prefer2 = row["EditableChunkCompressed_PlainText"]
-
-    prefer1_valid = False
-    prefer2_valid = False
-    if prefer1 != "" and prefer1 is not None:
-        # best case, most reliable
-        prefer1_valid = True
-    if (
-        prefer2 != ""
-        and prefer2 is not None
-        and not prefer2.strip().startswith("<?xml")
-    ):
-        # second best case, less reliable, use only if not XML
-        prefer2_valid = True
-
-    if prefer1_valid and prefer2_valid:
+    prefer1 = pl.col("UnEditableChunkCompressed_PlainText")
+    prefer2 = pl.col("EditableChunkCompressed_PlainText")
+
+    # best case, most reliable
+    prefer1_valid = prefer1.is_not_null() & (prefer1 != "")
+    # second best case, less reliable, use only if not XML
+    prefer2_valid = prefer2.is_not_null() & (prefer2 != "") & ~is_xml.fill_null(False)
+
+    return (
         # if both valid, combine
-        return prefer1 + "\n\n" + prefer2
-    elif prefer1_valid:
-        return prefer1
-    elif prefer2_valid:
-        return prefer2
-    else:
-        return ""
+        pl.when(prefer1_valid & prefer2_valid)
+        .then(pl.concat_str([prefer1, pl.lit("\n\n"), prefer2]))
+        .when(prefer1_valid)
+        .then(prefer1)
+        .when(prefer2_valid)
+        .then(prefer2)
+        .otherwise(pl.lit(""))
+    )
 
 
 aehr = pl.from_pandas(
@@ -505,23 +498,14 @@ aehr = aehr.with_columns(
             .str.starts_with("<?xml")
             .alias("IS_XML")
         ),
+    ]
+)
+
+aehr = aehr.with_columns(
+    [
+        select_aehr_note_text(pl.col("IS_XML")).alias("NOTE_TEXT"),
         (
-            pl.struct(
-                [
-                    "EditableChunkCompressed_PlainText",
-                    "UnEditableChunkCompressed_PlainText",
-                ]
-            )
-            .apply(select_aehr_note_text, skip_nulls=False)
-            .alias("NOTE_TEXT")
-            .cast(str)
-        ),
-        (
-            pl.when(
-                pl.col("EditableChunkCompressed_PlainText")
-                .str.strip()
-                .str.starts_with("<?xml")
-            )
+            pl.when(pl.col("IS_XML"))
             .then(pl.col("EditableChunkCompressed_PlainText"))
             .otherwise(pl.lit(""))
             .alias("XML_DATA")
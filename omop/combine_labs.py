@@ -109,8 +109,9 @@ combined = (
                 pl.Datetime, "%Y-%m-%d %H:%M:%S%.3f", exact=True
             ),
             pl.col("VALUE_NUM").cast(pl.Float64),
-            pl.col("REFERENCE_LOWER_LIMIT").str.replace(r">|NEG|<", "").str.strip(),
-            pl.col("REFERENCE_UPPER_LIMIT").str.replace(r">|NEG|<", "").str.strip(),
+            # operators and text in the limits are parsed in `lab_values`
+            pl.col("REFERENCE_LOWER_LIMIT").str.strip(),
+            pl.col("REFERENCE_UPPER_LIMIT").str.strip(),
         ]
     )
     .with_columns(
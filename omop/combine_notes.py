@@ -1,8 +1,24 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 from pathlib import Path
+from typing import Iterator
+import csv
+import tempfile
+
 import polars as pl
-import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.ipc
 from rich.console import Console
 
+from note_texts import (
+    NOTE_INDEX_FILE,
+    NOTE_TEXTS_FILE,
+    NoteTextWriter,
+    text_hash,
+    write_note_index,
+)
+from note_xml import XML_WORKERS, extract_xml_texts
 from paths import ID_SOURCE_DIR
 
 pl.Config.set_fmt_str_lengths(80)
@@ -15,214 +31,395 @@ console = Console(
     emoji=True,
 )
 
-
-def select_aehr_note_text(row: dict[str, str]) -> str | None:
+NOTES_FILE = Path().cwd().parent / "data" / "notes.feather"
+# bytes of CSV parsed per batch, notes are streamed so memory follows this
+CSV_BLOCK_SIZE = 64 << 20
+
+# column order and dtypes of every harmonized batch, so all record batches of
+# the output share one schema, `NOTE_TEXT` is swapped for `TEXT_HASH` on write
+NOTE_COLUMNS: dict[str, pl.PolarsDataType] = {
+    "CREATED_DTM": pl.Datetime,
+    "DATA_SOURCE": pl.Utf8,
+    "EPIC_LINES": pl.Utf8,
+    "IS_XML": pl.Boolean,
+    "NOTE_SOURCE": pl.Utf8,
+    "NOTE_TEXT": pl.Utf8,
+    "NOTE_TYPE": pl.Utf8,
+    "PATIENT_NUM": pl.Utf8,
+    "SPECIALTY": pl.Utf8,
+    "VISIT_NUM": pl.Utf8,
+    "XML_DATA": pl.Utf8,
+}
+
+
+def select_aehr_note_text(is_xml: pl.Expr, xml_text: pl.Expr) -> pl.Expr:
     """Select which field to use for the AEHR NOTE_TEXT column.
 
     Args:
-        row (dict[str, str]): a row from the AEHR notes dataset
+        is_xml (pl.Expr): whether `EditableChunkCompressed_PlainText` holds XML
+        xml_text (pl.Expr): text parsed out of the XML, see `note_xml.py`
 
     Returns:
-        str: the selected text
+        pl.Expr: the selected text
     """
-    prefer1 = row["UnEditableChunkCompressed_PlainText"]
-    prefer2 = row["EditableChunkCompressed_PlainText"]
-
-    prefer1_valid = False
-    prefer2_valid = False
-    if prefer1 != "" and prefer1 is not None:
-        # best case, most reliable
-        prefer1_valid = True
-    if (
-        prefer2 != ""
-        and prefer2 is not None
-        and not prefer2.strip().startswith("<?xml")
-    ):
-        # second best case, less reliable, use only if not XML
-        prefer2_valid = True
-
-    if prefer1_valid and prefer2_valid:
+    prefer1 = pl.col("UnEditableChunkCompressed_PlainText")
+    # second best case, less reliable, XML only through its parsed text
+    prefer2 = (
+        pl.when(is_xml.fill_null(False))
+        .then(xml_text)
+        .otherwise(pl.col("EditableChunkCompressed_PlainText"))
+    )
+
+    # best case, most reliable
+    prefer1_valid = prefer1.is_not_null() & (prefer1 != "")
+    prefer2_valid = prefer2.is_not_null() & (prefer2 != "")
+
+    return (
         # if both valid, combine
-        return prefer1 + "\n\n" + prefer2
-    elif prefer1_valid:
-        return prefer1
-    elif prefer2_valid:
-        return prefer2
-    else:
-        return None
-
-
-aehr1 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT1_AEHR_NOTES.csv", low_memory=False)
-).lazy()
-aehr2 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT2_AEHR_NOTES.csv", low_memory=False)
-).lazy()
-
-aehr = pl.concat([aehr1, aehr2], how="vertical")
-
-aehr = aehr.rename({"DOCUMENT_TYPE": "NOTE_TYPE", "RECORDED_DTM": "CREATED_DTM"})
-
-aehr = aehr.with_columns(
-    [
-        pl.lit("AEHR").alias("NOTE_SOURCE"),
-        pl.lit("UKHC").alias("DATA_SOURCE"),
-        pl.lit("").alias("SPECIALTY"),
-        pl.lit("0").alias("EPIC_LINES"),
-        pl.col("VISIT_NUM").cast(str),
-        (
-            pl.col("EditableChunkCompressed_PlainText")
-            .str.strip()
-            .str.starts_with("<?xml")
-            .alias("IS_XML")
-        ),
-        (
-            pl.struct(
-                [
-                    "EditableChunkCompressed_PlainText",
-                    "UnEditableChunkCompressed_PlainText",
-                ]
-            )
-            .apply(select_aehr_note_text)
-            .alias("NOTE_TEXT")
-        ),
-        (
-            pl.when(
-                pl.col("EditableChunkCompressed_PlainText")
-                .str.strip()
-                .str.starts_with("<?xml")
-            )
-            .then(pl.col("EditableChunkCompressed_PlainText"))
-            .otherwise("")
-            .alias("XML_DATA")
+        pl.when(prefer1_valid & prefer2_valid)
+        .then(pl.concat_str([prefer1, pl.lit("\n\n"), prefer2]))
+        .when(prefer1_valid)
+        .then(prefer1)
+        .when(prefer2_valid)
+        .then(prefer2)
+        .otherwise(pl.lit(None, dtype=pl.Utf8))
+    )
+
+
+def read_csv_batches(path: Path) -> Iterator[pl.DataFrame]:
+    """Stream a notes CSV in batches with the native Arrow reader.
+
+    Every column is read as a string so type inference on the first block can't
+    clash with a later one, quoted values may span lines and empty values are
+    null like they were with pandas.
+
+    Args:
+        path (Path): the CSV
+
+    Yields:
+        pl.DataFrame: about `CSV_BLOCK_SIZE` bytes of rows at a time
+    """
+    with open(path, "r", newline="") as f:
+        header = next(csv.reader(f))
+    reader = pa.csv.open_csv(
+        path,
+        read_options=pa.csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+        parse_options=pa.csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa.csv.ConvertOptions(
+            column_types={col: pa.string() for col in header},
+            strings_can_be_null=True,
         ),
-    ]
-)
+    )
+    for batch in reader:
+        yield pl.from_arrow(batch)
 
-aehr = aehr.select(
-    # apparently this keeps predicate push-down from breaking as opposed to `drop`
-    pl.all().exclude(
+
+def harmonize(df: pl.DataFrame) -> pl.DataFrame:
+    """Put a batch of any note source in the column order and dtypes of the output."""
+    return df.select(
         [
-            "EditableChunkCompressed_PlainText",
-            "UnEditableChunkCompressed_PlainText",
-            "COHORT",
+            # `%.f` parses to nanoseconds, the cast brings every source to one unit
+            pl.col(col).str.strptime(dtype, "%Y-%m-%d %H:%M:%S%.f").cast(dtype)
+            if col == "CREATED_DTM" and df.schema[col] == pl.Utf8
+            else pl.col(col).cast(dtype)
+            for col, dtype in NOTE_COLUMNS.items()
         ]
     )
-)
+
+
+# ### AEHR Section
+
+
+def parse_xml_payloads(pool: ProcessPoolExecutor, aehr: pl.DataFrame) -> pl.DataFrame:
+    """Add `XML_TEXT`, parsed in `pool` for the rows flagged `IS_XML` only."""
+    aehr = aehr.with_row_count("xml_row")
+    flagged = aehr.filter(pl.col("IS_XML"))
+    parsed = flagged.select("xml_row").with_columns(
+        [extract_xml_texts(pool, flagged["EditableChunkCompressed_PlainText"])]
+    )
+    return aehr.join(parsed, on="xml_row", how="left").drop("xml_row")
+
+
+def aehr_batches() -> Iterator[pl.DataFrame]:
+    # one pool for all batches, XML payloads are a small share of the notes,
+    # spawned since the parent already runs pyarrow and polars threads
+    with ProcessPoolExecutor(
+        max_workers=XML_WORKERS, mp_context=get_context("spawn")
+    ) as pool:
+        for file in [
+            ID_SOURCE_DIR / "EX5765_COHORT1_AEHR_NOTES.csv",
+            ID_SOURCE_DIR / "EX5765_COHORT2_AEHR_NOTES.csv",
+        ]:
+            for aehr in read_csv_batches(file):
+                aehr = aehr.rename(
+                    {"DOCUMENT_TYPE": "NOTE_TYPE", "RECORDED_DTM": "CREATED_DTM"}
+                )
+                aehr = aehr.with_columns(
+                    [
+                        pl.lit("AEHR").alias("NOTE_SOURCE"),
+                        pl.lit("UKHC").alias("DATA_SOURCE"),
+                        pl.lit("").alias("SPECIALTY"),
+                        pl.lit("0").alias("EPIC_LINES"),
+                        (
+                            pl.col("EditableChunkCompressed_PlainText")
+                            .str.strip()
+                            .str.starts_with("<?xml")
+                            .alias("IS_XML")
+                        ),
+                    ]
+                )
+                aehr = parse_xml_payloads(pool, aehr)
+                aehr = aehr.with_columns(
+                    [
+                        select_aehr_note_text(
+                            pl.col("IS_XML"), pl.col("XML_TEXT")
+                        ).alias("NOTE_TEXT"),
+                        (
+                            pl.when(pl.col("IS_XML"))
+                            .then(pl.col("EditableChunkCompressed_PlainText"))
+                            .otherwise("")
+                            .alias("XML_DATA")
+                        ),
+                    ]
+                )
+                yield harmonize(aehr)
+
 
 # ### SCM Section
 
-scm1 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT1_SCM_NOTES.csv", low_memory=False)
-).lazy()
-scm2 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT2_SCM_NOTES.csv", low_memory=False)
-).lazy()
-
-scm = pl.concat([scm1, scm2], how="vertical")
-
-scm = scm.rename(
-    {
-        "DocumentName": "NOTE_TYPE",
-        "CreatedWhen": "CREATED_DTM",
-        "DetailText_PlainText": "NOTE_TEXT",
-    }
-)
 
-scm = scm.with_columns(
-    [
-        pl.lit("SCM").alias("NOTE_SOURCE"),
-        pl.lit("UKHC").alias("DATA_SOURCE"),
-        pl.lit("").alias("SPECIALTY"),
-        pl.lit(False).alias("IS_XML"),
-        pl.lit("").alias("XML_DATA"),
-        pl.lit("0").alias("EPIC_LINES"),
-    ]
-)
+def scm_batches() -> Iterator[pl.DataFrame]:
+    for file in [
+        ID_SOURCE_DIR / "EX5765_COHORT1_SCM_NOTES.csv",
+        ID_SOURCE_DIR / "EX5765_COHORT2_SCM_NOTES.csv",
+    ]:
+        for scm in read_csv_batches(file):
+            scm = scm.rename(
+                {
+                    "DocumentName": "NOTE_TYPE",
+                    "CreatedWhen": "CREATED_DTM",
+                    "DetailText_PlainText": "NOTE_TEXT",
+                }
+            )
+            scm = scm.with_columns(
+                [
+                    pl.lit("SCM").alias("NOTE_SOURCE"),
+                    pl.lit("UKHC").alias("DATA_SOURCE"),
+                    pl.lit("").alias("SPECIALTY"),
+                    pl.lit(False).alias("IS_XML"),
+                    pl.lit("").alias("XML_DATA"),
+                    pl.lit("0").alias("EPIC_LINES"),
+                ]
+            )
+            yield harmonize(scm)
 
-scm = scm.select(pl.all().exclude(["COHORT"]))
 
 # ### EPIC Section
 
-epic1 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT1_EPIC_NOTES_LDS.csv")
-).lazy()
-epic2 = pl.from_pandas(
-    pd.read_csv(ID_SOURCE_DIR / "EX5765_COHORT2_EPIC_NOTES_LDS.csv")
-).lazy()
-
-epic = pl.concat([epic1, epic2], how="vertical")
-
-epic = epic.with_columns(
-    [
-        pl.lit("EPIC").alias("NOTE_SOURCE"),
-        pl.lit("EPIC").alias("DATA_SOURCE"),
-        pl.lit(False).alias("IS_XML"),
-        pl.lit("").alias("XML_DATA"),
-    ]
-)
 
-combined_epic_notes = (
-    epic.unique()
-    .sort("LINE")
-    .groupby("NOTE_ID")
-    .agg(
-        [
-            # note at this time in the query these are still elements and are not
-            # colleted into a list until the end of this aggregation
-            pl.col("LINE").max().cast(str).alias("EPIC_LINES"),
-            pl.col("NOTE_TEXT"),
-        ]
+EPIC_NOTE_FILES = [
+    ID_SOURCE_DIR / "EX5765_COHORT1_EPIC_NOTES_LDS.csv",
+    ID_SOURCE_DIR / "EX5765_COHORT2_EPIC_NOTES_LDS.csv",
+]
+EPIC_SORT_KEY = ["NOTE_ID", "LINE"]
+# rows per record batch of a sorted run, this is what the merge holds per run
+EPIC_RUN_CHUNK_SIZE = 50_000
+
+
+def _up_to(note_id: str, line: int) -> pl.Expr:
+    """Rows ordered at or before (note_id, line)."""
+    return (pl.col("NOTE_ID") < note_id) | (
+        (pl.col("NOTE_ID") == note_id) & (pl.col("LINE") <= line)
     )
-    .with_columns(
-        [
-            pl.col("NOTE_TEXT").arr.join("\n\n"),
-        ]
+
+
+def spill_sorted_runs(files: list[Path], run_dir: Path) -> list[Path]:
+    """Write the EPIC lines as runs sorted by `EPIC_SORT_KEY`.
+
+    Every CSV batch is sorted on its own, a batch that starts at or after the
+    end of the previous one extends the current run, so lines that already
+    arrive in order end up in a single run and the merge has nothing to do.
+
+    Args:
+        files (list[Path]): the EPIC note CSVs
+        run_dir (Path): where to write the runs
+
+    Returns:
+        list[Path]: the runs, as IPC files
+    """
+    runs: list[Path] = []
+    writer = None
+    last_key = None
+    for file in files:
+        for batch in read_csv_batches(file):
+            batch = (
+                batch.filter(pl.col("NOTE_ID").is_not_null())
+                .with_columns(
+                    [pl.col("LINE").cast(pl.Int64, strict=False).fill_null(0)]
+                )
+                .sort(EPIC_SORT_KEY)
+            )
+            if len(batch) == 0:
+                continue
+            first_key = (batch["NOTE_ID"][0], batch["LINE"][0])
+            table = batch.to_arrow()
+            if writer is None or first_key < last_key:
+                if writer is not None:
+                    writer.close()
+                runs.append(run_dir / f"run-{len(runs):05d}.feather")
+                writer = pa.ipc.new_file(str(runs[-1]), table.schema)
+            for record_batch in table.to_batches(max_chunksize=EPIC_RUN_CHUNK_SIZE):
+                writer.write_batch(record_batch)
+            last_key = (batch["NOTE_ID"][-1], batch["LINE"][-1])
+    if writer is not None:
+        writer.close()
+    return runs
+
+
+def _run_chunks(run: Path) -> Iterator[pl.DataFrame]:
+    reader = pa.ipc.open_file(pa.memory_map(str(run)))
+    for i in range(reader.num_record_batches):
+        yield pl.from_arrow(reader.get_batch(i))
+
+
+def merge_runs(runs: list[Path]) -> Iterator[pl.DataFrame]:
+    """Merge sorted runs into one stream of chunks sorted by `EPIC_SORT_KEY`.
+
+    Each round emits every buffered row up to the smallest of the runs' last
+    keys, which always uses up at least one run's chunk, so only one chunk per
+    run is held at a time.
+
+    Args:
+        runs (list[Path]): runs from `spill_sorted_runs`
+
+    Yields:
+        pl.DataFrame: consecutive sorted chunks of the merged lines
+    """
+    sources = [_run_chunks(run) for run in runs]
+    pending = {i: next(source) for i, source in enumerate(sources)}
+    while pending:
+        bound = min((df["NOTE_ID"][-1], df["LINE"][-1]) for df in pending.values())
+        ready = []
+        for i, df in list(pending.items()):
+            up_to = _up_to(*bound)
+            ready.append(df.filter(up_to))
+            rest = df.filter(~up_to)
+            if len(rest) == 0:
+                rest = next(sources[i], None)
+            if rest is None:
+                del pending[i]
+            else:
+                pending[i] = rest
+        if len(runs) == 1:
+            yield ready[0]
+        else:
+            yield pl.concat(ready, how="vertical").sort(EPIC_SORT_KEY)
+
+
+def collapse_epic_lines(df: pl.DataFrame) -> pl.DataFrame:
+    """One row per note from complete, sorted notes' lines.
+
+    A line is kept once per (NOTE_ID, LINE, NOTE_TEXT), even when the cohort
+    files repeat it with other metadata, and the note takes the metadata of
+    its first line.
+    """
+    return (
+        df.unique(subset=["NOTE_ID", "LINE", "NOTE_TEXT"], maintain_order=True)
+        .groupby("NOTE_ID", maintain_order=True)
+        .agg(
+            [
+                # note at this time in the query these are still elements and are not
+                # colleted into a list until the end of this aggregation
+                pl.col("LINE").max().cast(str).alias("EPIC_LINES"),
+                pl.col("NOTE_TEXT"),
+                pl.all().exclude(["NOTE_ID", "LINE", "NOTE_TEXT", "COHORT"]).first(),
+            ]
+        )
+        .with_columns(
+            [
+                pl.col("NOTE_TEXT").arr.join("\n\n"),
+            ]
+        )
     )
-)
 
-epic = epic.select(pl.all().exclude(["COHORT", "LINE", "NOTE_TEXT"])).join(
-    combined_epic_notes,
-    on="NOTE_ID",
-)
 
-epic = epic.select(pl.all().exclude(["NOTE_ID"]))
+def _harmonize_epic(epic: pl.DataFrame) -> pl.DataFrame:
+    return harmonize(
+        epic.with_columns(
+            [
+                pl.lit("EPIC").alias("NOTE_SOURCE"),
+                pl.lit("EPIC").alias("DATA_SOURCE"),
+                pl.lit(False).alias("IS_XML"),
+                pl.lit("").alias("XML_DATA"),
+            ]
+        )
+    )
+
+
+def epic_batches() -> Iterator[pl.DataFrame]:
+    # lines are put in NOTE_ID/LINE order once, after that a single pass over
+    # the sorted stream sees every note's lines back to back, only the lines of
+    # the note at the end of a chunk are carried over to the next one
+    with tempfile.TemporaryDirectory(dir=NOTES_FILE.parent) as run_dir:
+        runs = spill_sorted_runs(EPIC_NOTE_FILES, Path(run_dir))
+        console.log(f"Merging {len(runs)} sorted runs of EPIC lines...")
+        carry = None
+        for chunk in merge_runs(runs):
+            if carry is not None:
+                chunk = pl.concat([carry, chunk], how="vertical")
+            last_note = chunk["NOTE_ID"][-1]
+            carry = chunk.filter(pl.col("NOTE_ID") == last_note)
+            done = chunk.filter(pl.col("NOTE_ID") != last_note)
+            if len(done) > 0:
+                yield _harmonize_epic(collapse_epic_lines(done))
+        if carry is not None:
+            yield _harmonize_epic(collapse_epic_lines(carry))
+
 
 # ### Combine Notes
 
-# Now, before we actually combine these, we can run a sanity check that all of the columns match.
+def number_notes(batch: pl.DataFrame, first_id: int) -> pl.DataFrame:
+    """A harmonized batch with its `note_id` from `first_id` on and `TEXT_HASH`."""
+    return batch.with_row_count(name="note_id", offset=first_id).with_columns(
+        [text_hash(batch["NOTE_TEXT"])]
+    )
 
-assert (
-    sorted(aehr.columns) == sorted(scm.columns) == sorted(epic.columns)
-), "Columns do not match"
 
-# since each notes table have the same columns, we can write a little hack to `select` those columns in the same order
-# since `concat` requires the same columns in the same order
-sorted_cols = sorted(aehr.columns)
-combined = (
-    pl.concat(
-        [
-            # hacky hack :)
-            aehr.select([pl.col(c) for c in sorted_cols]),
-            scm.select([pl.col(c) for c in sorted_cols]),
-            epic.select([pl.col(c) for c in sorted_cols]),
-        ],
-        how="vertical",
+# the XML workers are spawned and import this module, the notes are only
+# combined when it is run
+if __name__ == "__main__":
+    # every source is harmonized to `NOTE_COLUMNS` and appended batch by batch, so
+    # neither the sources nor the combined notes are ever held in memory at once,
+    # each distinct text is stored once in `NOTE_TEXTS_FILE` and notes keep its hash
+    # the schema is known up front, so the file is valid even without any notes
+    notes_schema = (
+        number_notes(pl.DataFrame(schema=NOTE_COLUMNS), 1)
+        .drop("NOTE_TEXT")
+        .to_arrow()
+        .schema
     )
-    .with_columns(
-        [
-            pl.col("CREATED_DTM")
-            .str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S%.f")
-            .alias("CREATED_DTM"),
-        ]
+    note_id = 1
+    with NoteTextWriter(NOTE_TEXTS_FILE) as text_writer, pa.ipc.new_file(
+        str(NOTES_FILE),
+        notes_schema,
+        options=pa.ipc.IpcWriteOptions(compression="zstd"),
+    ) as writer:
+        for source, batches in [
+            ("AEHR", aehr_batches()),
+            ("SCM", scm_batches()),
+            ("EPIC", epic_batches()),
+        ]:
+            console.log(f"Writing {source} notes...")
+            for batch in batches:
+                batch = number_notes(batch, note_id)
+                text_writer.write(batch)
+                writer.write_table(batch.drop("NOTE_TEXT").to_arrow())
+                note_id += len(batch)
+
+    console.log("Indexing note texts by note_id...")
+    write_note_index(NOTES_FILE, NOTE_TEXTS_FILE, NOTE_INDEX_FILE)
+
+    console.log(
+        f"[green]Wrote {note_id - 1:,} notes with {len(text_writer.seen):,} distinct "
+        f"texts to {NOTES_FILE.name} and {NOTE_TEXTS_FILE.name}"
     )
-    .with_row_count(name="note_id", offset=1)
-)
-print(combined.fetch().head(2))
-
-# ? for some reason parquet broke on reading, but feather works fine
-# dump notes to feather temp file for easier querying later.
-# takes ~1-2 minutes and results in ~5 GB file
-# uncompressed
-collected = combined.collect()
-collected.write_ipc(Path().cwd().parent / "data" / "notes.feather", compression="zstd")
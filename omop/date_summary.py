@@ -0,0 +1,86 @@
+import polars as pl
+from rich.console import Console
+
+from paths import DEST_DIR
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# per table (person_id, min_date, max_date) summaries, one parquet file per table
+SUMMARY_DIR = DEST_DIR / "date_summaries"
+
+
+def date_summary(df: pl.DataFrame) -> pl.DataFrame:
+    """Earliest and latest date of every person across all date columns.
+
+    Datetime columns are truncated to their date, rows without a person or a
+    date are ignored.
+
+    Args:
+        df (pl.DataFrame): a conformed OMOP table with a `person_id` column
+
+    Returns:
+        pl.DataFrame: `person_id`, `min_date` and `max_date`
+    """
+    date_cols = [
+        col
+        for col, dtype in df.schema.items()
+        if dtype == pl.Date or dtype == pl.Datetime
+    ]
+    if len(date_cols) == 0:
+        raise ValueError(f"No date columns in {df.columns}")
+    return (
+        df.select(["person_id"] + [pl.col(col).cast(pl.Date) for col in date_cols])
+        .melt(id_vars="person_id", value_vars=date_cols, value_name="date")
+        .drop_nulls()
+        .groupby("person_id")
+        .agg(
+            [
+                pl.col("date").min().alias("min_date"),
+                pl.col("date").max().alias("max_date"),
+            ]
+        )
+        # stable row order so an unchanged table gives a byte identical file
+        .sort("person_id")
+    )
+
+
+def write_date_summary(df: pl.DataFrame, table_name: str):
+    """Write the per-person date summary of an OMOP table for the observation period.
+
+    Args:
+        df (pl.DataFrame): the collected OMOP table
+        table_name (str): file stem of the table, e.g. "Measurement"
+    """
+    SUMMARY_DIR.mkdir(parents=True, exist_ok=True)
+    summary = date_summary(df)
+    summary.write_parquet(SUMMARY_DIR / f"{table_name}.parquet")
+    console.log(f"Wrote date summary of {table_name} for {len(summary):,} people")
+
+
+def scan_date_summaries(table_names: list[str]) -> pl.LazyFrame:
+    """The date summaries of the tables reduced to one (min, max) per person.
+
+    Only the summaries of `table_names` are read, one left behind by a table
+    that was renamed or removed since doesn't widen anyone's period.
+
+    Args:
+        table_names (list[str]): file stems of the tables, e.g. ["Measurement"]
+
+    Returns:
+        pl.LazyFrame: `person_id`, `min_date` and `max_date`
+    """
+    files = [SUMMARY_DIR / f"{table_name}.parquet" for table_name in table_names]
+    missing = [file.name for file in files if not file.exists()]
+    if missing:
+        raise FileNotFoundError(f"Missing date summaries {missing} in {SUMMARY_DIR}")
+    return (
+        pl.concat([pl.scan_parquet(file) for file in files])
+        .groupby("person_id")
+        .agg([pl.col("min_date").min(), pl.col("max_date").max()])
+    )
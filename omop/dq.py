@@ -0,0 +1,409 @@
+from typing import NamedTuple
+
+import polars as pl
+from rich.console import Console
+
+from cdm_schema import CDM_SCHEMAS, TABLE_FILES, conform
+from paths import DEST_DIR, KNOWLEDGE_DIR
+from writers import find_output
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+DQ_RESULTS_FILE = DEST_DIR / "dq_results.parquet"
+# counts `profile_table` reports per check, `pct_violated` is derived from them
+DQ_RESULT_SCHEMA: dict[str, pl.PolarsDataType] = {
+    "table": pl.Utf8,
+    "check": pl.Utf8,
+    "column": pl.Utf8,
+    "violated": pl.Int64,
+    "denominator": pl.Int64,
+    "rows": pl.Int64,
+}
+
+# CDM v5.4 columns that may not be null
+REQUIRED_COLUMNS: dict[str, list[str]] = {
+    "person": [
+        "person_id",
+        "gender_concept_id",
+        "year_of_birth",
+        "race_concept_id",
+        "ethnicity_concept_id",
+    ],
+    "location": ["location_id"],
+    "death": ["person_id", "death_date"],
+    "visit_occurrence": [
+        "visit_occurrence_id",
+        "person_id",
+        "visit_concept_id",
+        "visit_start_date",
+        "visit_end_date",
+        "visit_type_concept_id",
+    ],
+    "condition_occurrence": [
+        "condition_occurrence_id",
+        "person_id",
+        "condition_concept_id",
+        "condition_start_date",
+        "condition_type_concept_id",
+    ],
+    "drug_exposure": [
+        "drug_exposure_id",
+        "person_id",
+        "drug_concept_id",
+        "drug_exposure_start_date",
+        "drug_exposure_end_date",
+        "drug_type_concept_id",
+    ],
+    "procedure_occurrence": [
+        "procedure_occurrence_id",
+        "person_id",
+        "procedure_concept_id",
+        "procedure_date",
+        "procedure_type_concept_id",
+    ],
+    "measurement": [
+        "measurement_id",
+        "person_id",
+        "measurement_concept_id",
+        "measurement_date",
+        "measurement_type_concept_id",
+    ],
+    "note": [
+        "note_id",
+        "person_id",
+        "note_date",
+        "note_type_concept_id",
+        "note_class_concept_id",
+        "note_text",
+        "encoding_concept_id",
+        "language_concept_id",
+    ],
+    "note_nlp": ["note_nlp_id", "note_id", "lexical_variant", "nlp_date"],
+    "observation_period": [
+        "observation_period_id",
+        "person_id",
+        "observation_period_start_date",
+        "observation_period_end_date",
+        "period_type_concept_id",
+    ],
+    "cohort": [
+        "cohort_definition_id",
+        "subject_id",
+        "cohort_start_date",
+        "cohort_end_date",
+    ],
+}
+
+# column -> (parent table, parent key)
+FOREIGN_KEYS: dict[str, tuple[str, str]] = {
+    "person_id": ("person", "person_id"),
+    "subject_id": ("person", "person_id"),
+    "location_id": ("location", "location_id"),
+    "visit_occurrence_id": ("visit_occurrence", "visit_occurrence_id"),
+    "note_id": ("note", "note_id"),
+}
+
+# table -> (start date, end date)
+DATE_RANGES: dict[str, tuple[str, str]] = {
+    "visit_occurrence": ("visit_start_date", "visit_end_date"),
+    "condition_occurrence": ("condition_start_date", "condition_end_date"),
+    "drug_exposure": ("drug_exposure_start_date", "drug_exposure_end_date"),
+    "procedure_occurrence": ("procedure_date", "procedure_end_date"),
+    "observation_period": (
+        "observation_period_start_date",
+        "observation_period_end_date",
+    ),
+    "cohort": ("cohort_start_date", "cohort_end_date"),
+}
+
+# table -> date of the event, checked against birth and death
+EVENT_DATES: dict[str, str] = {
+    "visit_occurrence": "visit_start_date",
+    "condition_occurrence": "condition_start_date",
+    "drug_exposure": "drug_exposure_start_date",
+    "procedure_occurrence": "procedure_date",
+    "measurement": "measurement_date",
+    "note": "note_date",
+}
+
+# (table, column) -> domain_id the concepts have to belong to
+CONCEPT_DOMAINS: dict[tuple[str, str], str] = {
+    ("person", "gender_concept_id"): "Gender",
+    ("person", "race_concept_id"): "Race",
+    ("person", "ethnicity_concept_id"): "Ethnicity",
+    ("visit_occurrence", "visit_concept_id"): "Visit",
+    ("condition_occurrence", "condition_concept_id"): "Condition",
+    ("drug_exposure", "drug_concept_id"): "Drug",
+    ("drug_exposure", "route_concept_id"): "Route",
+    ("procedure_occurrence", "procedure_concept_id"): "Procedure",
+    ("measurement", "measurement_concept_id"): "Measurement",
+    ("measurement", "unit_concept_id"): "Unit",
+}
+
+# (table, column) -> plausible (low, high), inclusive
+VALUE_RANGES: dict[tuple[str, str], tuple[float, float]] = {
+    ("person", "year_of_birth"): (1850, 2030),
+    ("drug_exposure", "quantity"): (0, 100_000),
+    ("drug_exposure", "days_supply"): (0, 365),
+    ("drug_exposure", "refills"): (0, 99),
+    ("procedure_occurrence", "quantity"): (0, 1_000),
+}
+
+
+class Check(NamedTuple):
+    """One data quality check on one column of a table.
+
+    `violated` flags the failing rows and `denominator` the rows the check
+    applies to, every row when None. Both are summed in the same scan of the
+    table.
+    """
+
+    check: str
+    column: str
+    violated: pl.Expr
+    denominator: pl.Expr | None
+
+
+def scan_table(table: str) -> pl.LazyFrame | None:
+    """Scan whichever format a CDM table was written in, typed by its schema."""
+    path = find_output(DEST_DIR / TABLE_FILES[table])
+    if path is None:
+        return None
+    if path.suffix == ".parquet":
+        df = pl.scan_parquet(path)
+    elif path.suffix == ".csv":
+        # CSV carries no types, scan it with the CDM ones instead of guessing
+        df = pl.scan_csv(path, dtypes=CDM_SCHEMAS[table])
+    else:
+        df = pl.scan_ipc(path)
+    return conform(df, table)
+
+
+def load_concept_domains() -> pl.DataFrame:
+    """`concept_id` and `domain_id` of every concept in the vocabulary."""
+    return (
+        pl.scan_csv(KNOWLEDGE_DIR / "CONCEPT.CSV", low_memory=False, sep="\t")
+        .select(["concept_id", "domain_id"])
+        .collect()
+    )
+
+
+def table_checks(
+    table: str,
+    parent_keys: dict[str, pl.Series],
+    domain_ids: dict[str, pl.Series],
+) -> list[Check]:
+    """Every check that applies to a table.
+
+    Args:
+        table (str): CDM table name
+        parent_keys (dict[str, pl.Series]): keys of the parent tables by FK column
+        domain_ids (dict[str, pl.Series]): concept ids by domain
+
+    Returns:
+        list[Check]: the checks, birth and death ones expect `_birth_date` and
+            `_death_date` columns to be joined on
+    """
+    schema = CDM_SCHEMAS[table]
+    checks = []
+    for col in REQUIRED_COLUMNS.get(table, []):
+        checks.append(Check("is_required", col, pl.col(col).is_null(), None))
+    for col, (parent, key) in FOREIGN_KEYS.items():
+        if col not in schema or parent == table or col not in parent_keys:
+            continue
+        present = pl.col(col).is_not_null()
+        checks.append(
+            Check(
+                "fk_integrity",
+                col,
+                present & ~pl.col(col).is_in(parent_keys[col]),
+                present,
+            )
+        )
+    if table in DATE_RANGES:
+        start, end = DATE_RANGES[table]
+        both = pl.col(start).is_not_null() & pl.col(end).is_not_null()
+        checks.append(
+            Check("start_before_end", end, both & (pl.col(start) > pl.col(end)), both)
+        )
+    if table in EVENT_DATES:
+        date = EVENT_DATES[table]
+        known = pl.col(date).is_not_null() & pl.col("_birth_date").is_not_null()
+        checks.append(
+            Check(
+                "after_birth",
+                date,
+                known & (pl.col(date) < pl.col("_birth_date")),
+                known,
+            )
+        )
+        # death dates are only known to the year and set to december 30th
+        known = pl.col(date).is_not_null() & pl.col("_death_date").is_not_null()
+        checks.append(
+            Check(
+                "before_death",
+                date,
+                known & (pl.col(date).dt.year() > pl.col("_death_date").dt.year()),
+                known,
+            )
+        )
+    for (concept_table, col), domain in CONCEPT_DOMAINS.items():
+        if concept_table != table:
+            continue
+        mapped = pl.col(col).is_not_null() & (pl.col(col) != 0)
+        checks.append(
+            Check(
+                "concept_domain",
+                col,
+                mapped & ~pl.col(col).is_in(domain_ids[domain]),
+                mapped,
+            )
+        )
+    for (range_table, col), (low, high) in VALUE_RANGES.items():
+        if range_table != table:
+            continue
+        present = pl.col(col).is_not_null()
+        checks.append(
+            Check(
+                "value_range",
+                col,
+                present & ((pl.col(col) < low) | (pl.col(col) > high)),
+                present,
+            )
+        )
+    return checks
+
+
+def profile_table(
+    df: pl.LazyFrame, table: str, checks: list[Check], lifetimes: pl.LazyFrame
+) -> pl.DataFrame:
+    """Run all checks of a table as one aggregation, so in a single scan.
+
+    Args:
+        df (pl.LazyFrame): the table
+        table (str): CDM table name
+        checks (list[Check]): output of `table_checks`
+        lifetimes (pl.LazyFrame): `person_id`, `_birth_date` and `_death_date`
+
+    Returns:
+        pl.DataFrame: one row per check with the violated and denominator counts
+    """
+    if table in EVENT_DATES:
+        df = df.join(lifetimes, on="person_id", how="left")
+    counts = df.select(
+        [pl.count().alias("_rows")]
+        + [
+            c.violated.fill_null(False).sum().alias(f"v{i}")
+            for i, c in enumerate(checks)
+        ]
+        + [
+            (
+                pl.count()
+                if c.denominator is None
+                else c.denominator.fill_null(False).sum()
+            ).alias(f"d{i}")
+            for i, c in enumerate(checks)
+        ]
+    ).collect()
+    return pl.DataFrame(
+        {
+            "table": [table] * len(checks),
+            "check": [c.check for c in checks],
+            "column": [c.column for c in checks],
+            "violated": [counts[f"v{i}"][0] for i in range(len(checks))],
+            "denominator": [counts[f"d{i}"][0] for i in range(len(checks))],
+            "rows": [counts["_rows"][0]] * len(checks),
+        },
+        schema=DQ_RESULT_SCHEMA,
+    ).with_columns(
+        [
+            pl.when(pl.col("denominator") > 0)
+            .then(pl.col("violated") / pl.col("denominator"))
+            .otherwise(0.0)
+            .alias("pct_violated")
+        ]
+    )
+
+
+def run_dq(concept_domains: pl.DataFrame) -> pl.DataFrame:
+    """Profile every written CDM table and write the results next to them.
+
+    Args:
+        concept_domains (pl.DataFrame): output of `load_concept_domains`
+
+    Returns:
+        pl.DataFrame: one row per table, check and column
+    """
+    tables = {table: scan_table(table) for table in TABLE_FILES}
+    tables = {table: df for table, df in tables.items() if df is not None}
+    console.log(f"Profiling {list(tables)}...")
+
+    parent_keys = {
+        col: tables[parent].select(key).collect()[key]
+        for col, (parent, key) in FOREIGN_KEYS.items()
+        if parent in tables
+    }
+    domain_ids = {
+        domain: concept_domains.filter(pl.col("domain_id") == domain)["concept_id"]
+        for domain in set(CONCEPT_DOMAINS.values())
+    }
+    birth = (
+        tables["person"].select(
+            [
+                "person_id",
+                pl.coalesce(
+                    [
+                        pl.col("birth_datetime").cast(pl.Date),
+                        pl.date(pl.col("year_of_birth"), 1, 1),
+                    ]
+                ).alias("_birth_date"),
+            ]
+        )
+        if "person" in tables
+        else pl.DataFrame(
+            schema={"person_id": pl.Int64, "_birth_date": pl.Date}
+        ).lazy()
+    )
+    death = (
+        tables["death"]
+        .groupby("person_id")
+        .agg(pl.col("death_date").min().alias("_death_date"))
+        if "death" in tables
+        else pl.DataFrame(
+            schema={"person_id": pl.Int64, "_death_date": pl.Date}
+        ).lazy()
+    )
+    lifetimes = birth.join(death, on="person_id", how="left").collect().lazy()
+
+    results = []
+    for table, df in tables.items():
+        checks = table_checks(table, parent_keys, domain_ids)
+        if len(checks) == 0:
+            continue
+        result = profile_table(df, table, checks, lifetimes)
+        for row in result.filter(pl.col("violated") > 0).iter_rows(named=True):
+            console.log(
+                f"[yellow]{table}.{row['column']} {row['check']}: "
+                f"{row['violated']:,}/{row['denominator']:,} rows "
+                f"({row['pct_violated']:.2%})"
+            )
+        results.append(result)
+    if results:
+        report = pl.concat(results)
+    else:
+        console.log(f"[yellow]No CDM tables to profile in {DEST_DIR}")
+        report = pl.DataFrame(
+            schema={**DQ_RESULT_SCHEMA, "pct_violated": pl.Float64}
+        )
+    report.write_parquet(DQ_RESULTS_FILE)
+    console.log(
+        f"[green]Ran {len(report)} checks, "
+        f"{report.filter(pl.col('violated') > 0).height} with violations"
+    )
+    return report
@@ -0,0 +1,149 @@
+import polars as pl
+
+from paths import KNOWLEDGE_DIR
+
+RXNORM_VOCABULARIES = ["RxNorm", "RxNorm Extension"]
+
+# private row index used to broadcast the NDC matches back onto the source rows
+_ROW_ID = "_drug_row"
+
+
+def normalize_ndc(col: str) -> pl.Expr:
+    """Normalize an NDC column into a list of 11-digit (5-4-2) candidate codes.
+
+    Dashed codes (4-4-2, 5-3-2, 5-4-1) are zero padded segment by segment.
+    Undashed 10-digit codes are ambiguous, so all three padded layouts are
+    returned and the join against the vocabulary decides which one exists.
+
+    Args:
+        col (str): name of the column holding the raw NDC
+
+    Returns:
+        pl.Expr: list of candidate 11-digit NDCs, null if the value is not an NDC
+    """
+    raw = pl.col(col).str.strip()
+    digits = raw.str.replace_all(r"[^0-9]", "")
+    parts = raw.str.split("-")
+    dashed = pl.concat_str(
+        [
+            parts.arr.get(0).str.zfill(5),
+            parts.arr.get(1).str.zfill(4),
+            parts.arr.get(2).str.zfill(2),
+        ]
+    )
+    return (
+        pl.when(raw.str.contains(r"^\d{1,5}-\d{1,4}-\d{1,2}$"))
+        .then(pl.concat_list([dashed]))
+        .when(digits.str.lengths() == 11)
+        .then(pl.concat_list([digits]))
+        .when(digits.str.lengths() == 10)
+        .then(
+            pl.concat_list(
+                [
+                    # 4-4-2
+                    pl.lit("0") + digits,
+                    # 5-3-2
+                    digits.str.slice(0, 5) + pl.lit("0") + digits.str.slice(5, 5),
+                    # 5-4-1
+                    digits.str.slice(0, 9) + pl.lit("0") + digits.str.slice(9, 1),
+                ]
+            )
+        )
+        .otherwise(None)
+    )
+
+
+def load_ndc_lookup() -> pl.LazyFrame:
+    """Build the NDC -> standard RxNorm lookup from the local Athena vocabulary.
+
+    Every NDC concept is kept so `drug_source_concept_id` can be filled even when
+    Athena has no valid "Maps to" relationship into RxNorm.
+
+    Returns:
+        pl.LazyFrame: `ndc`, `drug_source_concept_id` and `drug_concept_id`
+    """
+    concepts = pl.scan_csv(
+        KNOWLEDGE_DIR / "CONCEPT.CSV",
+        low_memory=False,
+        sep="\t",
+        dtypes={"concept_code": pl.Utf8},
+    )
+    ndc = concepts.filter(pl.col("vocabulary_id") == "NDC").select(
+        [
+            pl.col("concept_code").alias("ndc"),
+            pl.col("concept_id").alias("drug_source_concept_id"),
+        ]
+    )
+    rxnorm = (
+        concepts.filter(pl.col("standard_concept") == "S")
+        .filter(pl.col("vocabulary_id").is_in(RXNORM_VOCABULARIES))
+        .select(pl.col("concept_id").alias("drug_concept_id"))
+    )
+    maps_to = (
+        pl.scan_csv(
+            KNOWLEDGE_DIR / "CONCEPT_RELATIONSHIP.CSV", low_memory=False, sep="\t"
+        )
+        .filter(pl.col("relationship_id") == "Maps to")
+        .filter(pl.col("invalid_reason").is_null())
+        .select(
+            [
+                pl.col("concept_id_1").alias("drug_source_concept_id"),
+                pl.col("concept_id_2").alias("drug_concept_id"),
+            ]
+        )
+        # only keep targets that are standard RxNorm drugs
+        .join(rxnorm, on="drug_concept_id", how="inner")
+    )
+    return (
+        ndc.join(maps_to, on="drug_source_concept_id", how="left")
+        # a handful of NDCs map to more than one clinical drug, keep one
+        .sort(["ndc", "drug_concept_id"])
+        .unique(subset="ndc", keep="first", maintain_order=True)
+    )
+
+
+def map_ndc_columns(
+    df: pl.LazyFrame, ndc_cols: list[str], ndc_lookup: pl.LazyFrame
+) -> pl.LazyFrame:
+    """Map drug rows to RxNorm using every NDC column in priority order.
+
+    The NDC columns are unpivoted into one long frame, normalized, joined once
+    against the lookup and the best candidate per row is joined back. A candidate
+    that maps to RxNorm always beats one that only has an NDC source concept,
+    otherwise the earlier column in `ndc_cols` wins.
+
+    Args:
+        df (pl.LazyFrame): drug rows with empty strings already converted to null
+        ndc_cols (list[str]): NDC columns, highest priority first
+        ndc_lookup (pl.LazyFrame): output of `load_ndc_lookup`
+
+    Returns:
+        pl.LazyFrame: `df` with `drug_concept_id`, `drug_source_concept_id` and
+            `ndc_source_value` (the raw NDC that matched) added
+    """
+    df = df.with_row_count(name=_ROW_ID)
+    priority = {col: i for i, col in enumerate(ndc_cols)}
+    matches = (
+        df.select([_ROW_ID] + ndc_cols)
+        .melt(
+            id_vars=_ROW_ID,
+            value_vars=ndc_cols,
+            variable_name="ndc_column",
+            value_name="ndc_source_value",
+        )
+        .drop_nulls("ndc_source_value")
+        .with_columns(
+            [
+                pl.col("ndc_column").map_dict(priority).alias("ndc_priority"),
+                normalize_ndc("ndc_source_value").alias("ndc"),
+            ]
+        )
+        .explode("ndc")
+        .join(ndc_lookup, on="ndc", how="inner")
+        .sort([_ROW_ID, pl.col("drug_concept_id").is_null(), "ndc_priority"])
+        .unique(subset=_ROW_ID, keep="first", maintain_order=True)
+        .select(
+            [_ROW_ID, "drug_concept_id", "drug_source_concept_id", "ndc_source_value"]
+        )
+    )
+    return df.join(matches, on=_ROW_ID, how="left").drop(_ROW_ID)
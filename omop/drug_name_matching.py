@@ -0,0 +1,254 @@
+import polars as pl
+from rich.console import Console
+
+from paths import KNOWLEDGE_DIR
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# names are truncated to this many characters before trigrams are taken,
+# ingredient, strength and form always fit well inside of it
+MAX_NAME_LENGTH = 64
+# dice coefficient over trigram sets needed to accept a match
+MIN_SCORE = 0.6
+# trigrams shared by more concepts than this (" ta", "mg ", ...) carry no signal
+# and only blow up the candidate join, so they are left out of the index
+MAX_TRIGRAM_CONCEPTS = 5_000
+# number of distinct query names scored per join
+BATCH_SIZE = 10_000
+
+RXNORM_VOCABULARIES = ["RxNorm", "RxNorm Extension"]
+
+# private row index used to broadcast the name matches back onto the source rows
+_ROW_ID = "_name_row"
+
+
+def normalize_drug_name(col: str) -> pl.Expr:
+    """Lowercase a drug name and reduce it to letters, digits and decimal points.
+
+    Args:
+        col (str): name of the column holding the raw drug name
+
+    Returns:
+        pl.Expr: the normalized name, truncated to `MAX_NAME_LENGTH`
+    """
+    return (
+        pl.col(col)
+        .str.to_lowercase()
+        .str.replace_all(r"[^a-z0-9.]+", " ")
+        .str.strip()
+        .str.slice(0, MAX_NAME_LENGTH)
+    )
+
+
+def _trigrams(df: pl.DataFrame, name_col: str) -> pl.DataFrame:
+    """Explode `name_col` into its set of padded character trigrams."""
+    # pad like pg_trgm so word starts weigh a little more than word ends
+    padded = pl.lit("  ") + pl.col(name_col) + pl.lit(" ")
+    return (
+        df.with_columns(
+            [
+                pl.concat_list(
+                    [padded.str.slice(i, 3) for i in range(MAX_NAME_LENGTH + 1)]
+                ).alias("trigram")
+            ]
+        )
+        .explode("trigram")
+        .filter(pl.col("trigram").str.lengths() == 3)
+        .unique(subset=[name_col, "trigram"])
+    )
+
+
+def load_drug_concepts() -> pl.LazyFrame:
+    """Standard RxNorm drug concepts with their normalized names.
+
+    Returns:
+        pl.LazyFrame: `concept_id` and `name`
+    """
+    return (
+        pl.scan_csv(
+            KNOWLEDGE_DIR / "CONCEPT.CSV",
+            low_memory=False,
+            sep="\t",
+            dtypes={"concept_code": pl.Utf8},
+        )
+        .filter(pl.col("standard_concept") == "S")
+        .filter(pl.col("domain_id") == "Drug")
+        .filter(pl.col("vocabulary_id").is_in(RXNORM_VOCABULARIES))
+        .select(["concept_id", normalize_drug_name("concept_name").alias("name")])
+        .filter(pl.col("name").str.lengths() > 0)
+    )
+
+
+def build_trigram_index(concepts: pl.LazyFrame) -> pl.DataFrame:
+    """Build the trigram -> concept inverted index.
+
+    Args:
+        concepts (pl.LazyFrame): output of `load_drug_concepts`
+
+    Returns:
+        pl.DataFrame: one row per (`trigram`, `concept_id`) with the number of
+            indexed trigrams of the concept in `concept_trigrams`, and one row
+            with a null `concept_id` per stop-listed trigram, so query names
+            can leave them out of their count too
+    """
+    console.log("Building drug name trigram index...")
+    postings = _trigrams(concepts.collect(), "name").with_columns(
+        [pl.count().over("trigram").alias("trigram_concepts")]
+    )
+    index = (
+        postings.filter(pl.col("trigram_concepts") <= MAX_TRIGRAM_CONCEPTS)
+        # counted after the stop list, so the dice score only compares
+        # trigrams that could have been shared
+        .with_columns([pl.count().over("concept_id").alias("concept_trigrams")])
+        .select(["trigram", "concept_id", "concept_trigrams"])
+    )
+    stop_list = (
+        postings.filter(pl.col("trigram_concepts") > MAX_TRIGRAM_CONCEPTS)
+        .select("trigram")
+        .unique()
+        .with_columns(
+            [
+                pl.lit(None).cast(index.schema["concept_id"]).alias("concept_id"),
+                pl.lit(None).cast(index.schema["concept_trigrams"]).alias(
+                    "concept_trigrams"
+                ),
+            ]
+        )
+    )
+    console.log(
+        f"Built drug name trigram index with {len(index):,} postings, "
+        f"{len(stop_list):,} trigrams stop-listed"
+    )
+    return pl.concat([index, stop_list])
+
+
+def match_names(
+    names: pl.Series, index: pl.DataFrame, min_score: float = MIN_SCORE
+) -> pl.DataFrame:
+    """Find the best scoring concept for each distinct normalized name.
+
+    Candidates are every concept sharing at least one trigram with the name and
+    are scored with the dice coefficient of the two trigram sets. Stop-listed
+    trigrams count for neither side.
+
+    Args:
+        names (pl.Series): normalized names, duplicates and nulls are dropped
+        index (pl.DataFrame): output of `build_trigram_index`
+        min_score (float): minimum score to accept a match
+
+    Returns:
+        pl.DataFrame: `name`, `concept_id` and `name_match_score`
+    """
+    queries = names.drop_nulls().unique().sort().to_frame("name")
+    stop_list = index.filter(pl.col("concept_id").is_null())["trigram"]
+    postings = index.filter(pl.col("concept_id").is_not_null())
+    results: list[pl.DataFrame] = []
+    for offset in range(0, len(queries), BATCH_SIZE):
+        grams = (
+            _trigrams(queries.slice(offset, BATCH_SIZE), "name")
+            .filter(~pl.col("trigram").is_in(stop_list))
+            .with_columns([pl.count().over("name").alias("name_trigrams")])
+        )
+        best = (
+            grams.join(postings, on="trigram", how="inner")
+            .groupby(["name", "concept_id"])
+            .agg(
+                [
+                    pl.count().alias("shared"),
+                    pl.col("name_trigrams").first(),
+                    pl.col("concept_trigrams").first(),
+                ]
+            )
+            .with_columns(
+                [
+                    (
+                        2
+                        * pl.col("shared")
+                        / (pl.col("name_trigrams") + pl.col("concept_trigrams"))
+                    ).alias("name_match_score")
+                ]
+            )
+            .filter(pl.col("name_match_score") >= min_score)
+            # highest score wins, lowest concept_id breaks ties
+            .sort(
+                ["name", "name_match_score", "concept_id"],
+                descending=[False, True, False],
+            )
+            .unique(subset="name", keep="first", maintain_order=True)
+            .select(["name", "concept_id", "name_match_score"])
+        )
+        results.append(best)
+    console.log(f"Matched {sum(len(r) for r in results):,}/{len(queries):,} names")
+    if len(results) == 0:
+        return pl.DataFrame(
+            schema={
+                "name": pl.Utf8,
+                "concept_id": pl.Int64,
+                "name_match_score": pl.Float64,
+            }
+        )
+    return pl.concat(results)
+
+
+def map_drug_names(
+    df: pl.LazyFrame, name_cols: list[str], index: pl.DataFrame
+) -> pl.LazyFrame:
+    """Fill missing `drug_concept_id`s by fuzzy matching drug names.
+
+    Only rows still missing a `drug_concept_id` are looked at and each distinct
+    name is scored once, the matches are then joined back onto the rows. When
+    several name columns match, the earlier column in `name_cols` wins. The
+    rows are collected once up front, the names to score and the final join
+    both read them instead of running the plan of `df` twice.
+
+    Args:
+        df (pl.LazyFrame): drug rows, already mapped by NDC
+        name_cols (list[str]): name columns, highest priority first
+        index (pl.DataFrame): output of `build_trigram_index`
+
+    Returns:
+        pl.LazyFrame: `df` with the unmapped `drug_concept_id`s filled in
+    """
+    df = df.with_row_count(name=_ROW_ID).collect().lazy()
+    priority = {col: i for i, col in enumerate(name_cols)}
+    names = (
+        df.filter(pl.col("drug_concept_id").is_null())
+        .select([_ROW_ID] + name_cols)
+        .melt(
+            id_vars=_ROW_ID,
+            value_vars=name_cols,
+            variable_name="name_column",
+            value_name="drug_name",
+        )
+        .select(
+            [
+                _ROW_ID,
+                pl.col("name_column").map_dict(priority).alias("name_priority"),
+                normalize_drug_name("drug_name").alias("name"),
+            ]
+        )
+        .filter(pl.col("name").str.lengths() > 0)
+    )
+    lookup = match_names(names.select("name").unique().collect()["name"], index)
+    matches = (
+        names.join(lookup.lazy(), on="name", how="inner")
+        .sort([_ROW_ID, "name_priority"])
+        .unique(subset=_ROW_ID, keep="first", maintain_order=True)
+        .select([_ROW_ID, pl.col("concept_id").alias("name_concept_id")])
+    )
+    return (
+        df.join(matches, on=_ROW_ID, how="left")
+        .with_columns(
+            [
+                pl.coalesce([pl.col("drug_concept_id"), pl.col("name_concept_id")])
+                .alias("drug_concept_id")
+            ]
+        )
+        .drop([_ROW_ID, "name_concept_id"])
+    )
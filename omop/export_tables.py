@@ -1,3 +1,4 @@
+import argparse
 import polars as pl
 from rich.console import Console
 
@@ -14,6 +15,10 @@ from combine_rx import combined as combined_rx
 from combine_rx import combined as combined_rx
 from combine_emars import combined as combined_emars
 
+from note_texts import NOTE_TEXTS_FILE
+import writers
+from writers import write_table
+
 pl.Config.set_fmt_str_lengths(80)
 
 console = Console(
@@ -26,13 +31,26 @@ console = Console(
 
 DEST_DIR = Path().cwd().parent / "data" / "source_tables"
 
-# notes first since manual
-(
-    pl.scan_ipc(Path().cwd().parent / "data" / "notes.feather")
-    .collect()
-    .to_pandas()
-    .to_csv(DEST_DIR / "combined_notes.csv", index=False)
+parser = argparse.ArgumentParser(
+    prog="export_tables.py",
+    description="Exports the combined source tables.",
+)
+parser.add_argument(
+    "--formats",
+    nargs="+",
+    default=writers.OUTPUT_FORMATS,
+    choices=sorted(writers.WRITERS),
+    help="Output formats to write every table in.",
+)
+args = parser.parse_args()
+writers.configure(formats=args.formats)
+
+# notes first since manual, their texts are stored once per distinct text
+write_table(
+    pl.scan_ipc(Path().cwd().parent / "data" / "notes.feather").collect(),
+    DEST_DIR / "combined_notes",
 )
+write_table(pl.scan_ipc(NOTE_TEXTS_FILE).collect(), DEST_DIR / "combined_note_texts")
 console.log("[green]Exported combined_notes[/green]")
 
 # now loop over imports
@@ -45,9 +63,7 @@ for table, name in [
     (combined_procedures, "combined_procedures"),
     (combined_rx, "combined_rx"),
 ]:
-    table.with_row_count(offset=1).collect().to_pandas().to_csv(
-        DEST_DIR / f"{name}.csv", index=False
-    )
+    write_table(table.with_row_count(offset=1).collect(), DEST_DIR / name)
     console.log(f"[green]Exported {name}[/green]")
 
 console.log("[green]Done.[/green]")
@@ -0,0 +1,142 @@
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Callable
+
+import polars as pl
+from rich.console import Console
+
+from paths import DEST_DIR
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# task name -> fingerprint of the inputs its current outputs were built from
+FINGERPRINT_FILE = DEST_DIR / ".fingerprints.json"
+# "path|size|mtime_ns" -> content hash, so multi GB vocabularies are hashed once
+HASH_CACHE_FILE = DEST_DIR / ".file_hashes.json"
+# content addressed intermediates, e.g. vocabulary lookups
+CACHE_DIR = DEST_DIR / ".cache"
+
+_HASH_BLOCK_SIZE = 1 << 20
+
+_hash_cache: dict[str, str] | None = None
+
+
+def _write_json(path: Path, data: dict):
+    # write then rename so readers never see half a file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    tmp.replace(path)
+
+
+def _read_json(path: Path) -> dict:
+    if not path.exists():
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def file_hash(path: Path) -> str:
+    """Content hash of a file, cached on its path, size and modification time.
+
+    Args:
+        path (Path): the file
+
+    Returns:
+        str: hex digest, or "missing" when the file does not exist
+    """
+    global _hash_cache
+    if not path.exists():
+        return "missing"
+    if _hash_cache is None:
+        _hash_cache = _read_json(HASH_CACHE_FILE)
+    stat = path.stat()
+    key = f"{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}"
+    if key not in _hash_cache:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            while block := f.read(_HASH_BLOCK_SIZE):
+                digest.update(block)
+        _hash_cache[key] = digest.hexdigest()
+        _write_json(HASH_CACHE_FILE, _hash_cache)
+    return _hash_cache[key]
+
+
+def code_hash(funcs: list[Callable]) -> str:
+    """Hash of the source code of some functions."""
+    digest = hashlib.blake2b(digest_size=16)
+    for func in funcs:
+        digest.update(inspect.getsource(func).encode())
+    return digest.hexdigest()
+
+
+def fingerprint(inputs: list[Path], code: list[Callable], salt: str = "") -> str:
+    """Fingerprint of everything a build step reads.
+
+    Args:
+        inputs (list[Path]): source files, vocabularies, crosswalks and rule tables
+        code (list[Callable]): functions whose source decides the output
+        salt (str): anything else the output depends on, e.g. the output formats
+
+    Returns:
+        str: hex digest that changes whenever any of the inputs change
+    """
+    payload = {
+        "inputs": {str(path): file_hash(path) for path in sorted(set(inputs))},
+        "code": code_hash(code),
+        "salt": salt,
+    }
+    return hashlib.blake2b(
+        json.dumps(payload, sort_keys=True).encode(), digest_size=16
+    ).hexdigest()
+
+
+def load_fingerprints() -> dict[str, str]:
+    """Fingerprints of the last successful build of every task."""
+    return _read_json(FINGERPRINT_FILE)
+
+
+def save_fingerprint(name: str, value: str):
+    """Record the fingerprint a task was successfully built from."""
+    fingerprints = load_fingerprints()
+    fingerprints[name] = value
+    _write_json(FINGERPRINT_FILE, fingerprints)
+
+
+def cached_frame(
+    name: str, inputs: list[Path], build: Callable[[], pl.DataFrame]
+) -> pl.DataFrame:
+    """Build a frame once per version of its inputs and reuse it afterwards.
+
+    The cache file is named after the fingerprint of `inputs` and the source of
+    `build`, so a new vocabulary release or a change to `build` gets a new file.
+
+    Args:
+        name (str): name of the intermediate, e.g. "ndc_lookup"
+        inputs (list[Path]): files `build` reads
+        build (Callable[[], pl.DataFrame]): computes the frame
+
+    Returns:
+        pl.DataFrame: the cached or freshly built frame
+    """
+    key = fingerprint(inputs, [build], salt=name)
+    path = CACHE_DIR / f"{name}-{key}.parquet"
+    if path.exists():
+        console.log(f"Using cached {name}")
+        return pl.read_parquet(path)
+    df = build()
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    df.write_parquet(tmp)
+    tmp.replace(path)
+    return df
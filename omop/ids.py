@@ -0,0 +1,56 @@
+from itertools import accumulate
+
+import polars as pl
+
+
+def partition_starts(counts: list[int]) -> list[int]:
+    """First id of every partition of a table, given the rows of each.
+
+    A prefix sum over the counts, so once they are known every partition owns
+    a disjoint range of ids and can be numbered on its own, even in parallel.
+    The ids of the whole table stay contiguous and small enough for the 32 bit
+    integer keys of most CDM databases.
+
+    Args:
+        counts (list[int]): rows of every partition, in partition order
+
+    Returns:
+        list[int]: first id of every partition
+    """
+    return list(accumulate(counts, initial=1))[:-1]
+
+
+def assign_ids(
+    df: pl.LazyFrame | pl.DataFrame,
+    name: str,
+    sort_key: list[str],
+    start: int = 1,
+) -> pl.LazyFrame | pl.DataFrame:
+    """Number the rows of one partition of a table in a reproducible order.
+
+    Rows are ordered by `sort_key` within the partition, rows that tie on it
+    keep the order they were read in. Categoricals are compared as strings
+    since their physical order depends on the string cache.
+
+    Args:
+        df (pl.LazyFrame | pl.DataFrame): the rows of the partition
+        name (str): id column to fill in or add, e.g. "measurement_id"
+        sort_key (list[str]): columns that identify a row, most significant first
+        start (int): first id of the partition, see `partition_starts`
+
+    Returns:
+        pl.LazyFrame | pl.DataFrame: `df` sorted, with `name` as Int64 ids
+    """
+    if start < 1:
+        raise ValueError(f"Ids start at 1, got {start}")
+    schema = df.schema
+    order = [
+        pl.col(col).cast(pl.Utf8) if schema[col] == pl.Categorical else pl.col(col)
+        for col in sort_key
+    ]
+    return (
+        df.with_row_count("_read_order")
+        .sort(order + [pl.col("_read_order")], nulls_last=True)
+        .drop("_read_order")
+        .with_columns([(pl.arange(0, pl.count()).cast(pl.Int64) + start).alias(name)])
+    )
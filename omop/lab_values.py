@@ -0,0 +1,129 @@
+import polars as pl
+
+# optional comparison, a number and optional units, e.g. "<0.5", ">= 60 mL/min"
+VALUE_PATTERN = (
+    r"^\s*(<=|>=|=<|=>|<|>|=)?"
+    r"\s*([-+]?(?:\d+\.?\d*|\.\d+))"
+    r"\s*([A-Za-z%/^*][^\s]*)?\s*$"
+)
+# "3.5-5.0" style ranges sometimes sit in a single reference limit
+RANGE_PATTERN = r"^\s*((?:\d+\.?\d*|\.\d+))\s*-\s*((?:\d+\.?\d*|\.\d+))\s*$"
+
+# Meas Value Operator concepts
+OPERATORS = pl.DataFrame(
+    {
+        "value_operator": ["<", "<=", "=", ">=", ">"],
+        "operator_concept_id": [4171756, 4171754, 4172703, 4171755, 4172704],
+    },
+    schema={"value_operator": pl.Utf8, "operator_concept_id": pl.Int32},
+)
+
+# lowercased text result -> Meas Value concept
+QUALITATIVE_RESULTS = pl.DataFrame(
+    [
+        ("positive", 9191),
+        ("pos", 9191),
+        ("+", 9191),
+        ("negative", 9189),
+        ("neg", 9189),
+        ("-", 9189),
+        ("trace", 9192),
+        ("detected", 45877985),
+        ("not detected", 45880296),
+        ("none detected", 45880296),
+        ("normal", 4069590),
+        ("abnormal", 4135493),
+        ("high", 4328749),
+        ("low", 4267416),
+    ],
+    schema={"value_text_key": pl.Utf8, "value_as_concept_id": pl.Int32},
+    orient="row",
+)
+
+
+def _extract_number(col: str, pattern: str, group: int) -> pl.Expr:
+    return pl.col(col).str.extract(pattern, group).cast(pl.Float64, strict=False)
+
+
+def parse_lab_values(df: pl.LazyFrame) -> pl.LazyFrame:
+    """Split lab results and reference limits into operator, number, unit and concept.
+
+    Everything runs as regex kernels over whole columns, operators and text
+    results are mapped to concepts by joining the small lookup tables above.
+
+    Adds:
+        value_operator: "<", "<=", "=", ">=" or ">", "=" for plain numbers
+        operator_concept_id: concept of `value_operator`
+        value_as_number: `VALUE_NUM`, or the number parsed from `VALUE_TXT`
+        value_unit: units written after the number in `VALUE_TXT`
+        value_as_concept_id: concept of a qualitative `VALUE_TXT`
+        range_low, range_high: numbers parsed from the reference limits, a
+            "low-high" range in either limit fills both
+
+    Args:
+        df (pl.LazyFrame): combined labs with `VALUE_TXT`, `VALUE_NUM`,
+            `REFERENCE_LOWER_LIMIT` and `REFERENCE_UPPER_LIMIT`
+
+    Returns:
+        pl.LazyFrame: `df` with the parsed columns
+    """
+    lower, upper = "REFERENCE_LOWER_LIMIT", "REFERENCE_UPPER_LIMIT"
+    return (
+        df.with_columns(
+            [
+                pl.col("VALUE_TXT").str.strip().alias("value_text"),
+                pl.col("VALUE_NUM").cast(pl.Float64, strict=False).alias("value_num"),
+            ]
+        )
+        .with_columns(
+            [
+                pl.coalesce(
+                    [
+                        pl.col("value_num"),
+                        _extract_number("value_text", VALUE_PATTERN, 2),
+                    ]
+                ).alias("value_as_number"),
+                # "=<" and "=>" are written the other way around now and then
+                pl.col("value_text")
+                .str.extract(VALUE_PATTERN, 1)
+                .str.replace("=<", "<=", literal=True)
+                .str.replace("=>", ">=", literal=True)
+                .alias("value_operator"),
+                pl.col("value_text").str.extract(VALUE_PATTERN, 3).alias("value_unit"),
+                pl.col("value_text")
+                .str.to_lowercase()
+                .str.replace_all(r"\s+", " ")
+                .str.rstrip(".")
+                .alias("value_text_key"),
+                pl.coalesce(
+                    [
+                        _extract_number(lower, RANGE_PATTERN, 1),
+                        _extract_number(upper, RANGE_PATTERN, 1),
+                        _extract_number(lower, VALUE_PATTERN, 2),
+                    ]
+                ).alias("range_low"),
+                pl.coalesce(
+                    [
+                        _extract_number(upper, RANGE_PATTERN, 2),
+                        _extract_number(lower, RANGE_PATTERN, 2),
+                        _extract_number(upper, VALUE_PATTERN, 2),
+                    ]
+                ).alias("range_high"),
+            ]
+        )
+        .with_columns(
+            [
+                # a plain number is an equality
+                pl.when(
+                    pl.col("value_operator").is_null()
+                    & pl.col("value_as_number").is_not_null()
+                )
+                .then(pl.lit("="))
+                .otherwise(pl.col("value_operator"))
+                .alias("value_operator"),
+            ]
+        )
+        .join(OPERATORS.lazy(), on="value_operator", how="left")
+        .join(QUALITATIVE_RESULTS.lazy(), on="value_text_key", how="left")
+        .drop(["value_text", "value_num", "value_text_key"])
+    )
@@ -0,0 +1,242 @@
+import argparse
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import polars as pl
+from rich.console import Console
+
+from cdm_schema import CDM_SCHEMAS, PRIMARY_KEYS, TABLE_FILES
+from paths import DEST_DIR
+from writers import find_output
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+pl.Config.set_fmt_str_lengths(80)
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# foreign key columns that get a (non unique) index after the load
+INDEXED_COLUMNS = ["person_id", "subject_id", "visit_occurrence_id", "note_id"]
+# rows per `executemany` call for SQLite, which has no bulk COPY
+SQLITE_CHUNK_SIZE = 100_000
+
+
+def sql_type(dtype: pl.PolarsDataType) -> str:
+    """SQL column type for a polars dtype from the CDM schema registry."""
+    if dtype == pl.Int32:
+        return "INTEGER"
+    elif dtype == pl.Int64:
+        return "BIGINT"
+    elif dtype == pl.Float64:
+        return "DOUBLE"
+    elif dtype == pl.Date:
+        return "DATE"
+    elif dtype == pl.Datetime:
+        return "TIMESTAMP"
+    else:
+        return "VARCHAR"
+
+
+def quote(name: str) -> str:
+    """Quoted SQL identifier, CDM columns like `offset` are reserved words."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def create_table_sql(table: str) -> str:
+    """`CREATE TABLE` statement without keys, those are added after the load."""
+    columns = ",\n    ".join(
+        f"{quote(col)} {sql_type(dtype)}" for col, dtype in CDM_SCHEMAS[table].items()
+    )
+    return f"CREATE TABLE {quote(table)} (\n    {columns}\n)"
+
+
+def index_sql(table: str) -> list[str]:
+    """Primary key and foreign key indexes for a table."""
+    statements = []
+    if table in PRIMARY_KEYS:
+        statements.append(
+            f"CREATE UNIQUE INDEX {quote(f'pk_{table}')} "
+            f"ON {quote(table)} ({quote(PRIMARY_KEYS[table])})"
+        )
+    for col in INDEXED_COLUMNS:
+        if col in CDM_SCHEMAS[table] and col != PRIMARY_KEYS.get(table):
+            statements.append(
+                f"CREATE INDEX {quote(f'idx_{table}_{col}')} "
+                f"ON {quote(table)} ({quote(col)})"
+            )
+    return statements
+
+
+def find_tables(tables: list[str]) -> dict[str, Path]:
+    """Locate the written file of each requested table, skipping missing ones."""
+    found = {}
+    for table in tables:
+        path = find_output(DEST_DIR / TABLE_FILES[table])
+        if path is None:
+            console.log(f"[yellow]No output found for {table}, skipping")
+            continue
+        found[table] = path
+    return found
+
+
+def load_duckdb(con, table: str, path: Path) -> int:
+    """Bulk load one table into DuckDB with its native readers.
+
+    Args:
+        con: a DuckDB connection (or cursor) owned by the calling thread
+        table (str): CDM table name
+        path (Path): the written table
+
+    Returns:
+        int: number of rows loaded
+    """
+    con.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+    con.execute(create_table_sql(table))
+    source = "'" + str(path).replace("'", "''") + "'"
+    if path.suffix == ".parquet":
+        con.execute(f"COPY {quote(table)} FROM {source} (FORMAT parquet)")
+    elif path.suffix == ".csv":
+        con.execute(f"COPY {quote(table)} FROM {source} (FORMAT csv, HEADER)")
+    else:
+        # Arrow IPC, handed to DuckDB zero-copy
+        arrow_table = pl.read_ipc(path, memory_map=True).to_arrow()
+        con.register("arrow_table", arrow_table)
+        con.execute(f"INSERT INTO {quote(table)} SELECT * FROM arrow_table")
+        con.unregister("arrow_table")
+    return con.execute(f"SELECT count(*) FROM {quote(table)}").fetchone()[0]
+
+
+def load_sqlite(
+    con: sqlite3.Connection, lock: threading.Lock, table: str, path: Path
+) -> int:
+    """Load one table into SQLite.
+
+    Files are read in parallel but SQLite only allows one writer, so the
+    inserts themselves are serialized on `lock`.
+
+    Args:
+        con (sqlite3.Connection): the shared connection
+        lock (threading.Lock): guards `con`
+        table (str): CDM table name
+        path (Path): the written table
+
+    Returns:
+        int: number of rows loaded
+    """
+    if path.suffix == ".parquet":
+        df = pl.read_parquet(path)
+    elif path.suffix == ".csv":
+        # CSV carries no types, read it with the CDM ones instead of guessing
+        df = pl.read_csv(path, dtypes=CDM_SCHEMAS[table])
+    else:
+        df = pl.read_ipc(path, memory_map=True)
+    columns = list(CDM_SCHEMAS[table])
+    placeholders = ", ".join(["?"] * len(columns))
+    insert = (
+        f"INSERT INTO {quote(table)} ({', '.join(quote(c) for c in columns)}) "
+        f"VALUES ({placeholders})"
+    )
+    with lock:
+        con.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+        con.execute(create_table_sql(table))
+        for chunk in df.select(columns).iter_slices(n_rows=SQLITE_CHUNK_SIZE):
+            con.executemany(insert, chunk.iter_rows())
+        con.commit()
+    return len(df)
+
+
+def run(db_path: Path, engine: str, tables: list[str], workers: int):
+    """Load the OMOP tables into a local database.
+
+    Args:
+        db_path (Path): database file, created if missing
+        engine (str): "duckdb" or "sqlite"
+        tables (list[str]): CDM table names to load
+        workers (int): number of tables loaded at the same time
+    """
+    found = find_tables(tables)
+    start = time.perf_counter()
+
+    if engine == "duckdb":
+        if duckdb is None:
+            raise ImportError("duckdb is not installed, use `--engine sqlite`")
+        con = duckdb.connect(str(db_path))
+
+        def load(item: tuple[str, Path]) -> tuple[str, int]:
+            # every thread needs its own cursor on the shared database
+            cursor = con.cursor()
+            try:
+                return item[0], load_duckdb(cursor, *item)
+            finally:
+                cursor.close()
+
+    else:
+        con = sqlite3.connect(db_path, check_same_thread=False)
+        con.execute("PRAGMA journal_mode = OFF")
+        con.execute("PRAGMA synchronous = OFF")
+        lock = threading.Lock()
+
+        def load(item: tuple[str, Path]) -> tuple[str, int]:
+            return item[0], load_sqlite(con, lock, *item)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for table, n_rows in pool.map(load, found.items()):
+            console.log(f"[green]Loaded {n_rows:,} rows into {table}")
+
+    console.log("Creating primary keys and indexes...")
+    for table in found:
+        for statement in index_sql(table):
+            con.execute(statement)
+    if engine == "sqlite":
+        con.commit()
+    con.close()
+    console.log(
+        f"[green]Loaded {len(found)} tables into {db_path} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="load_omop_db.py",
+        description="Bulk loads the generated OMOP tables into a local database.",
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=Path().cwd().parent / "data" / "omop.duckdb",
+        help="Database file to load into.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["duckdb", "sqlite"],
+        default="duckdb" if duckdb is not None else "sqlite",
+        help="Database engine, defaults to DuckDB when it is installed.",
+    )
+    parser.add_argument(
+        "--tables",
+        nargs="+",
+        default=list(TABLE_FILES),
+        choices=list(TABLE_FILES),
+        help="CDM tables to load.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Number of tables to load at the same time.",
+    )
+    args = parser.parse_args()
+    run(db_path=args.db, engine=args.engine, tables=args.tables, workers=args.workers)
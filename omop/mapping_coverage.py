@@ -0,0 +1,116 @@
+from typing import NamedTuple
+
+import polars as pl
+from rich.console import Console
+
+from paths import DEST_DIR
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# number of unmapped source values kept per vocabulary in the report
+TOP_N_UNMAPPED = 50
+
+
+class CoverageSpec(NamedTuple):
+    """A concept column and the source column it was mapped from.
+
+    `vocabulary` is either a fixed label or an expression evaluated per row,
+    for tables that mix source vocabularies in one concept column.
+    """
+
+    concept_col: str
+    source_col: str
+    vocabulary: str | pl.Expr
+
+
+def coverage_report(
+    df: pl.DataFrame, specs: list[CoverageSpec], top_n: int = TOP_N_UNMAPPED
+) -> pl.DataFrame:
+    """Summarize how many rows of an OMOP table mapped to a concept.
+
+    A concept id that is null or 0 counts as unmapped.
+
+    Args:
+        df (pl.DataFrame): the collected OMOP table
+        specs (list[CoverageSpec]): concept columns to report on
+        top_n (int): number of most frequent unmapped source values to keep
+
+    Returns:
+        pl.DataFrame: one row per concept column and source vocabulary with the
+            row counts and the `top_unmapped` source values with their counts
+    """
+    reports: list[pl.DataFrame] = []
+    for spec in specs:
+        vocabulary = (
+            pl.lit(spec.vocabulary)
+            if isinstance(spec.vocabulary, str)
+            else spec.vocabulary
+        )
+        frame = df.select(
+            [
+                vocabulary.alias("source_vocabulary"),
+                pl.col(spec.source_col).cast(pl.Utf8).alias("source_value"),
+                (pl.col(spec.concept_col).is_not_null() & (pl.col(spec.concept_col) != 0))
+                .fill_null(False)
+                .alias("mapped"),
+            ]
+        )
+        summary = frame.groupby("source_vocabulary").agg(
+            [
+                pl.count().cast(pl.Int64).alias("rows"),
+                pl.col("mapped").sum().cast(pl.Int64).alias("mapped"),
+            ]
+        )
+        top_unmapped = (
+            frame.filter(~pl.col("mapped"))
+            .groupby(["source_vocabulary", "source_value"])
+            .agg(pl.count().cast(pl.Int64).alias("count"))
+            .sort(
+                ["source_vocabulary", "count", "source_value"],
+                descending=[False, True, False],
+            )
+            .groupby("source_vocabulary", maintain_order=True)
+            .head(top_n)
+            .groupby("source_vocabulary", maintain_order=True)
+            .agg(pl.struct(["source_value", "count"]).alias("top_unmapped"))
+        )
+        reports.append(
+            summary.join(top_unmapped, on="source_vocabulary", how="left").select(
+                [
+                    pl.lit(spec.concept_col).alias("concept_column"),
+                    pl.lit(spec.source_col).alias("source_column"),
+                    "source_vocabulary",
+                    "rows",
+                    "mapped",
+                    (pl.col("rows") - pl.col("mapped")).alias("unmapped"),
+                    (pl.col("mapped") / pl.col("rows")).alias("pct_mapped"),
+                    "top_unmapped",
+                ]
+            )
+        )
+    return pl.concat(reports, how="vertical")
+
+
+def write_coverage(df: pl.DataFrame, table_name: str, specs: list[CoverageSpec]):
+    """Write the coverage report of an OMOP table next to it.
+
+    Args:
+        df (pl.DataFrame): the collected OMOP table
+        table_name (str): file stem of the table, e.g. "Measurement"
+        specs (list[CoverageSpec]): concept columns to report on
+    """
+    report = coverage_report(df, specs)
+    for row in report.select(
+        ["concept_column", "source_vocabulary", "rows", "pct_mapped"]
+    ).iter_rows(named=True):
+        console.log(
+            f"{table_name}.{row['concept_column']} ({row['source_vocabulary']}): "
+            f"{row['pct_mapped']:.1%} of {row['rows']:,} rows mapped"
+        )
+    report.write_parquet(DEST_DIR / f"{table_name}_coverage.parquet")
@@ -0,0 +1,209 @@
+import argparse
+import sqlite3
+import time
+from pathlib import Path
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.ipc
+from rich.console import Console
+from tqdm import tqdm
+
+from note_texts import NOTE_TEXTS_FILE
+
+pl.Config.set_fmt_str_lengths(80)
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+NOTES_FILE = Path().cwd().parent / "data" / "notes.feather"
+NOTE_SEARCH_DB = Path().cwd().parent / "data" / "note_search.db"
+# rows of `notes.feather` per `executemany` call
+SQLITE_CHUNK_SIZE = 100_000
+
+# the FTS5 table is contentless, it only maps terms to `TEXT_HASH` rowids, the
+# texts themselves stay in the note store
+SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS note_text_fts USING fts5(
+        text,
+        content='',
+        prefix='2 3',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    "CREATE TABLE IF NOT EXISTS indexed_text (text_hash INTEGER PRIMARY KEY)",
+    """
+    CREATE TABLE IF NOT EXISTS note (
+        note_id INTEGER PRIMARY KEY,
+        text_hash INTEGER NOT NULL,
+        patient_num TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS note_text_hash ON note (text_hash)",
+]
+
+
+def connect(db_path: Path = NOTE_SEARCH_DB) -> sqlite3.Connection:
+    """Open the search index, creating its tables when missing."""
+    con = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        con.execute(statement)
+    return con
+
+
+def index_texts(con: sqlite3.Connection, path: Path = NOTE_TEXTS_FILE) -> int:
+    """Add the texts of the note store that aren't indexed yet.
+
+    Every record batch is committed on its own, so an interrupted build picks
+    up where it stopped and a rebuilt store only costs its new texts.
+
+    Args:
+        con (sqlite3.Connection): the search index
+        path (Path): the note text store
+
+    Returns:
+        int: number of texts added
+    """
+    con.execute("CREATE TEMP TABLE IF NOT EXISTS batch_hash (text_hash INTEGER)")
+    added = 0
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in tqdm(range(reader.num_record_batches), desc="Indexing note texts"):
+            batch = reader.get_batch(i)
+            hashes = batch.column("TEXT_HASH").to_pylist()
+            con.execute("DELETE FROM batch_hash")
+            con.executemany(
+                "INSERT INTO batch_hash VALUES (?)", [(h,) for h in hashes]
+            )
+            new = {
+                h
+                for (h,) in con.execute(
+                    "SELECT text_hash FROM batch_hash "
+                    "WHERE text_hash NOT IN (SELECT text_hash FROM indexed_text)"
+                )
+            }
+            if not new:
+                continue
+            rows = [
+                (h, text)
+                for h, text in zip(hashes, batch.column("NOTE_TEXT").to_pylist())
+                if h in new and text is not None
+            ]
+            con.executemany(
+                "INSERT INTO note_text_fts (rowid, text) VALUES (?, ?)", rows
+            )
+            con.executemany(
+                "INSERT INTO indexed_text VALUES (?)", [(h,) for h, _ in rows]
+            )
+            con.commit()
+            added += len(rows)
+    return added
+
+
+def index_notes(con: sqlite3.Connection, path: Path = NOTES_FILE) -> int:
+    """Replace the note -> text and patient mapping, it is small next to the texts.
+
+    Args:
+        con (sqlite3.Connection): the search index
+        path (Path): `notes.feather`
+
+    Returns:
+        int: number of notes
+    """
+    notes = (
+        pl.scan_ipc(path)
+        .select(["note_id", "TEXT_HASH", "PATIENT_NUM"])
+        .drop_nulls("TEXT_HASH")
+        .collect()
+    )
+    con.execute("DELETE FROM note")
+    for chunk in notes.iter_slices(n_rows=SQLITE_CHUNK_SIZE):
+        con.executemany("INSERT INTO note VALUES (?, ?, ?)", chunk.iter_rows())
+    con.commit()
+    return len(notes)
+
+
+def search(con: sqlite3.Connection, query: str) -> pl.DataFrame:
+    """Notes whose text matches an FTS5 query.
+
+    Args:
+        con (sqlite3.Connection): the search index
+        query (str): FTS5 query, e.g. `cocaine`, `"crack cocaine"` or `meth*`
+
+    Returns:
+        pl.DataFrame: `note_id` and `patient_num` of every matching note
+    """
+    rows = con.execute(
+        "SELECT note.note_id, note.patient_num FROM note_text_fts "
+        "JOIN note ON note.text_hash = note_text_fts.rowid "
+        "WHERE note_text_fts MATCH ?",
+        (query,),
+    ).fetchall()
+    return pl.DataFrame(
+        rows,
+        schema={"note_id": pl.Int64, "patient_num": pl.Utf8},
+        orient="row",
+    )
+
+
+def build(db_path: Path):
+    start = time.perf_counter()
+    con = connect(db_path)
+    con.execute("PRAGMA journal_mode = WAL")
+    added = index_texts(con)
+    n_notes = index_notes(con)
+    console.log("Optimizing full text index...")
+    con.execute("INSERT INTO note_text_fts (note_text_fts) VALUES ('optimize')")
+    con.commit()
+    con.close()
+    console.log(
+        f"[green]Indexed {added:,} new texts for {n_notes:,} notes in {db_path.name} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+def query(db_path: Path, queries: list[str]):
+    con = connect(db_path)
+    for q in queries:
+        start = time.perf_counter()
+        found = search(con, q)
+        console.log(
+            f"[cyan]{q}[/cyan]: {len(found):,} notes, "
+            f"{found['patient_num'].n_unique():,} patients "
+            f"({(time.perf_counter() - start) * 1000:.0f} ms)"
+        )
+    con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="note_search.py",
+        description="Builds and queries a full text index over the note store.",
+    )
+    parser.add_argument(
+        "--db",
+        type=Path,
+        default=NOTE_SEARCH_DB,
+        help="SQLite file holding the index.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("build", help="Add new note texts to the index.")
+    query_parser = commands.add_parser(
+        "query", help="Count the notes and patients matching FTS5 queries."
+    )
+    query_parser.add_argument(
+        "queries",
+        nargs="+",
+        help='FTS5 queries, e.g. cocaine \'"crack cocaine"\' \'meth*\'.',
+    )
+    args = parser.parse_args()
+    if args.command == "build":
+        build(args.db)
+    else:
+        query(args.db, args.queries)
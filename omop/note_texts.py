@@ -0,0 +1,284 @@
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.ipc
+import xxhash
+
+# every distinct note text once, keyed by `TEXT_HASH`, `notes.feather` only
+# holds the hash of its text
+NOTE_TEXTS_FILE = Path().cwd().parent / "data" / "note_texts.feather"
+# sidecar of the text store, note_id -> (batch, row) of the note's text
+NOTE_INDEX_FILE = Path().cwd().parent / "data" / "note_texts.index.feather"
+# texts per record batch of the store, the unit NLP workers fetch
+NOTE_TEXTS_BATCH_SIZE = 10_000
+# columns of the store, as `NoteTextWriter` writes them
+NOTE_TEXTS_SCHEMA = pa.schema(
+    [("TEXT_HASH", pa.int64()), ("NOTE_TEXT", pa.large_string())]
+)
+
+
+def text_hash(texts: pl.Series) -> pl.Series:
+    """xxhash64 of every text, null where the text is null.
+
+    The hash only depends on the UTF-8 bytes of the text, so it is stable
+    across runs and library versions and can key NLP output between them. Its
+    bits are kept as a signed Int64 so it survives Python, Parquet and SQLite
+    round trips unchanged.
+
+    The bytes are hashed straight out of the Arrow data buffer, no Python
+    string is built for any text.
+    """
+    array = pa.compute.cast(texts.to_arrow(), pa.large_string())
+    if isinstance(array, pa.ChunkedArray):
+        array = array.combine_chunks()
+    offsets = np.frombuffer(array.buffers()[1], dtype=np.int64)[
+        array.offset : array.offset + len(array) + 1
+    ].tolist()
+    data = memoryview(array.buffers()[2] or b"")
+    digests = np.fromiter(
+        (
+            xxhash.xxh64_intdigest(data[start:stop])
+            for start, stop in zip(offsets[:-1], offsets[1:])
+        ),
+        dtype=np.uint64,
+        count=len(array),
+    )
+    # `set` drops the name of the series
+    return (
+        pl.Series(digests.view(np.int64))
+        .set(texts.is_null(), None)
+        .alias("TEXT_HASH")
+    )
+
+
+class NoteTextWriter:
+    """Append the texts of note batches to `NOTE_TEXTS_FILE`, each text once.
+
+    Only the hashes already written are remembered, never the texts, so memory
+    stays far below the size of the store. They are kept in a set, so finding
+    the new texts of a batch costs a lookup per text of the batch, however many
+    texts are in the store already. Texts are written in record batches of
+    exactly `NOTE_TEXTS_BATCH_SIZE` rows, only the last one can be shorter.
+
+    Args:
+        path (Path): the text store
+    """
+
+    def __init__(self, path: Path = NOTE_TEXTS_FILE):
+        self.path = path
+        self.seen: set[int] = set()
+        self._pending: list[pl.DataFrame] = []
+        self._pending_rows = 0
+        self._writer = None
+        self._closed = False
+
+    def __enter__(self) -> "NoteTextWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, df: pl.DataFrame):
+        """Append the texts of `df` that aren't in the store yet.
+
+        Args:
+            df (pl.DataFrame): notes with `TEXT_HASH` and `NOTE_TEXT`
+        """
+        texts = (
+            df.select(["TEXT_HASH", "NOTE_TEXT"])
+            .drop_nulls("TEXT_HASH")
+            .unique(subset="TEXT_HASH", maintain_order=True)
+        )
+        new = [h not in self.seen for h in texts["TEXT_HASH"].to_list()]
+        texts = texts.filter(pl.Series(new, dtype=pl.Boolean))
+        if len(texts) == 0:
+            return
+        self.seen.update(texts["TEXT_HASH"].to_list())
+        self._pending.append(texts)
+        self._pending_rows += len(texts)
+        if self._pending_rows >= NOTE_TEXTS_BATCH_SIZE:
+            self._flush(final=False)
+
+    def _flush(self, final: bool):
+        pending = pl.concat(self._pending, how="vertical")
+        n = len(pending)
+        if not final:
+            n -= n % NOTE_TEXTS_BATCH_SIZE
+        table = pending.slice(0, n).to_arrow()
+        rest = pending.slice(n, len(pending) - n)
+        self._pending = [rest] if len(rest) > 0 else []
+        self._pending_rows = len(rest)
+        if self._writer is None:
+            # uncompressed, so readers map the texts instead of decompressing them
+            self._writer = pa.ipc.new_file(str(self.path), table.schema)
+        for batch in table.to_batches(max_chunksize=NOTE_TEXTS_BATCH_SIZE):
+            self._writer.write_batch(batch)
+
+    def close(self):
+        if self._closed:
+            return
+        if self._pending:
+            self._flush(final=True)
+        if self._writer is None:
+            # without any text the store is still there, just empty
+            self._writer = pa.ipc.new_file(str(self.path), NOTE_TEXTS_SCHEMA)
+        self._writer.close()
+        self._writer = None
+        self._closed = True
+
+
+def batch_texts(batch: pa.RecordBatch) -> list[tuple[str, int]]:
+    """(text, hash) of the texts in one record batch of the store, nulls skipped.
+
+    The pairs are what `nlp.pipe(..., as_tuples=True)` takes, with the hash as
+    the context the NLP output is keyed by.
+    """
+    return [
+        (text, text_hash)
+        for text_hash, text in zip(
+            batch.column("TEXT_HASH").to_pylist(), batch.column("NOTE_TEXT").to_pylist()
+        )
+        if text is not None
+    ]
+
+
+def _text_locations(reader: pa.ipc.RecordBatchFileReader) -> pl.DataFrame:
+    """`TEXT_HASH`, `batch` and `row` of every text in the store."""
+    if reader.num_record_batches == 0:
+        return pl.DataFrame(
+            schema={"TEXT_HASH": pl.Int64, "batch": pl.UInt32, "row": pl.UInt32}
+        )
+    return pl.concat(
+        [
+            pl.from_arrow(reader.get_batch(i).select(["TEXT_HASH"])).with_columns(
+                [
+                    pl.lit(i).cast(pl.UInt32).alias("batch"),
+                    pl.arange(0, pl.count()).cast(pl.UInt32).alias("row"),
+                ]
+            )
+            for i in range(reader.num_record_batches)
+        ],
+        how="vertical",
+    )
+
+
+def write_note_index(
+    notes: Path, path: Path = NOTE_TEXTS_FILE, index: Path = NOTE_INDEX_FILE
+):
+    """Write the note_id -> (batch, row) sidecar of the text store.
+
+    Notes without text aren't in the index. It is sorted by `note_id`, so the
+    texts of a range of notes are found with a slice of the index. Like the
+    store it is written uncompressed, so readers map it.
+
+    Args:
+        notes (Path): `notes.feather`, with `note_id` and `TEXT_HASH`
+        path (Path): the text store
+        index (Path): where to write the index
+    """
+    with pa.memory_map(str(path)) as source:
+        locations = _text_locations(pa.ipc.open_file(source))
+    (
+        pl.scan_ipc(notes)
+        .select(["note_id", "TEXT_HASH"])
+        .join(locations.lazy(), on="TEXT_HASH")
+        .select(["note_id", "batch", "row"])
+        .sort("note_id")
+        .collect()
+        .write_ipc(index, compression="uncompressed")
+    )
+
+
+class NoteTextStore:
+    """Look note texts up in the memory mapped text store.
+
+    Only the hashes are read into memory, texts are taken from the mapped file
+    as they are asked for, so every process reading the store shares the OS
+    page cache instead of holding a copy of its own.
+
+    Args:
+        path (Path): the text store
+        index (Path): its note_id index, from `write_note_index`
+    """
+
+    def __init__(self, path: Path = NOTE_TEXTS_FILE, index: Path = NOTE_INDEX_FILE):
+        self.path = path
+        self.index = index
+        self._source = None
+        self.reader = None
+        self.texts_column = None
+        self.locations = None
+        self.batch_starts = None
+
+    def __enter__(self) -> "NoteTextStore":
+        self._source = pa.memory_map(str(self.path))
+        self.reader = pa.ipc.open_file(self._source)
+        self.texts_column = self.reader.read_all().column("NOTE_TEXT")
+        self.locations = _text_locations(self.reader)
+        # batches may be of any length, e.g. in a shard, so a (batch, row) is
+        # found from where its batch starts rather than a fixed stride
+        lengths = [self.reader.get_batch(i).num_rows for i in range(self.num_batches)]
+        self.batch_starts = pl.DataFrame(
+            {
+                "batch": pl.Series(range(len(lengths)), dtype=pl.UInt32),
+                "batch_start": pl.Series(np.cumsum([0] + lengths)[:-1], dtype=pl.Int64),
+            }
+        )
+        return self
+
+    def __exit__(self, *exc):
+        self.reader = None
+        self.texts_column = None
+        self.locations = None
+        self.batch_starts = None
+        self._source.close()
+
+    @property
+    def num_batches(self) -> int:
+        return self.reader.num_record_batches
+
+    @property
+    def num_texts(self) -> int:
+        """Texts that aren't null, e.g. the total of an NLP progress bar."""
+        return len(self.texts_column) - self.texts_column.null_count
+
+    def iter_texts(self) -> Iterator[tuple[str, int]]:
+        """`batch_texts` of every record batch, only one batch is read at a time."""
+        for i in range(self.num_batches):
+            yield from batch_texts(self.batch(i))
+
+    def batch(self, i: int) -> pa.RecordBatch:
+        """Record batch `i` of the store, zero copy from the mapped file."""
+        return self.reader.get_batch(i)
+
+    def _take(self, located: pl.DataFrame) -> pa.Array:
+        rows = (
+            located.select(["batch", "row"])
+            .join(self.batch_starts, on="batch", how="left")
+            .select(pl.col("batch_start") + pl.col("row").cast(pl.Int64))
+            .to_series()
+            .to_arrow()
+        )
+        return self.texts_column.take(rows).combine_chunks()
+
+    def texts(self, hashes: pl.Series) -> pa.Array:
+        """The text of every hash, in order, null for null or unknown hashes."""
+        located = pl.DataFrame({"TEXT_HASH": hashes.cast(pl.Int64)}).join(
+            self.locations, on="TEXT_HASH", how="left"
+        )
+        return self._take(located)
+
+    def note_texts(self, start: int, stop: int) -> pl.DataFrame:
+        """`note_id` and `NOTE_TEXT` of the notes with `start` <= note_id < `stop`."""
+        located = (
+            pl.scan_ipc(self.index)
+            .filter(pl.col("note_id").is_between(start, stop, closed="left"))
+            .collect()
+        )
+        return located.select("note_id").with_columns(
+            [pl.from_arrow(self._take(located)).alias("NOTE_TEXT")]
+        )
@@ -0,0 +1,145 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from html.entities import name2codepoint
+from xml.parsers import expat
+
+import polars as pl
+from rich.console import Console
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# characters of a payload fed to the parser at a time
+XML_FEED_SIZE = 64 << 10
+# processes parsing XML payloads
+XML_WORKERS = os.cpu_count() or 1
+# payloads handed to a worker at a time
+XML_CHUNK_SIZE = 64
+# elements that end a line when they close, HTML and CDA narrative blocks,
+# inline markup like <b> or <span> closes without breaking the text
+XML_BLOCK_ELEMENTS = {
+    "address",
+    "blockquote",
+    "br",
+    "caption",
+    "dd",
+    "div",
+    "dt",
+    "h1",
+    "h2",
+    "h3",
+    "h4",
+    "h5",
+    "h6",
+    "hr",
+    "item",
+    "li",
+    "list",
+    "ol",
+    "p",
+    "paragraph",
+    "pre",
+    "row",
+    "section",
+    "table",
+    "td",
+    "text",
+    "th",
+    "title",
+    "tr",
+    "ul",
+}
+
+
+def _entity_text(name: str) -> str:
+    # payloads use HTML entities like &nbsp; without declaring them
+    if name in name2codepoint:
+        return chr(name2codepoint[name])
+    return f"&{name};"
+
+
+def _parse_xml(xml: str) -> tuple[str | None, str | None]:
+    """(text, None) of a payload, (None, parser error) when it isn't well formed."""
+    pieces: list[str] = []
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    # with a foreign DTD undeclared entities are skipped instead of failing the parse
+    parser.UseForeignDTD(True)
+    parser.CharacterDataHandler = pieces.append
+    parser.SkippedEntityHandler = lambda name, _: pieces.append(_entity_text(name))
+
+    def end_element(name: str):
+        # compare the local name, payloads may carry a namespace prefix
+        if name.rpartition(":")[2].lower() in XML_BLOCK_ELEMENTS:
+            pieces.append("\n")
+
+    parser.EndElementHandler = end_element
+
+    xml = xml.strip()
+    try:
+        for offset in range(0, len(xml), XML_FEED_SIZE):
+            parser.Parse(xml[offset : offset + XML_FEED_SIZE], False)
+        parser.Parse("", True)
+    except expat.ExpatError as e:
+        return None, str(e)
+    lines = [line.strip() for line in "".join(pieces).splitlines()]
+    text = "\n".join(line for line in lines if line)
+    return text or None, None
+
+
+def xml_to_text(xml: str | None) -> str | None:
+    """Plain text of an XML note payload.
+
+    The payload is fed to expat in `XML_FEED_SIZE` pieces and its character
+    data is collected as it is parsed, so no tree of the document is ever
+    built. Closing `XML_BLOCK_ELEMENTS` end a line, blank lines are dropped.
+    HTML entities resolve to their characters even though no DTD declares
+    them.
+
+    Args:
+        xml (str | None): the payload
+
+    Returns:
+        str | None: its text, None when it holds none or isn't well formed
+    """
+    if xml is None:
+        return None
+    return _parse_xml(xml)[0]
+
+
+def _parse_payload(xml: str | None) -> tuple[str | None, str | None]:
+    return (None, None) if xml is None else _parse_xml(xml)
+
+
+def extract_xml_texts(pool: ProcessPoolExecutor, xml: pl.Series) -> pl.Series:
+    """`xml_to_text` of every payload, parsed in the processes of `pool`.
+
+    Payloads that aren't well formed are counted and logged with the first
+    parser error, their text is null.
+
+    Args:
+        pool (ProcessPoolExecutor): the workers
+        xml (pl.Series): payloads
+
+    Returns:
+        pl.Series: their texts, in order
+    """
+    texts = []
+    n_errors = 0
+    first_error = None
+    for text, error in pool.map(_parse_payload, xml, chunksize=XML_CHUNK_SIZE):
+        texts.append(text)
+        if error is not None:
+            n_errors += 1
+            first_error = first_error or error
+    if n_errors > 0:
+        console.log(
+            f"[yellow]{n_errors:,} of {len(xml):,} XML payloads aren't well "
+            f"formed, their text is null, e.g. {first_error}"
+        )
+    return pl.Series("XML_TEXT", texts, dtype=pl.Utf8)
@@ -1,13 +1,40 @@
+import argparse
 import itertools
 import json
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from typing import Iterator
+
 import polars as pl
+import pyarrow as pa
+import pyarrow.ipc
 from rich.console import Console
 
 from pathlib import Path
 
 from tqdm import tqdm
 
+from cdm_schema import CDM_SCHEMAS, TABLE_FILES, conform
+from date_summary import (
+    SUMMARY_DIR,
+    date_summary,
+    scan_date_summaries,
+    write_date_summary,
+)
+from dq import DQ_RESULTS_FILE, load_concept_domains, run_dq
+from drug_mapping import load_ndc_lookup, map_ndc_columns
+from drug_name_matching import build_trigram_index, load_drug_concepts, map_drug_names
+from fingerprint import cached_frame
+from ids import assign_ids, partition_starts
+from lab_values import parse_lab_values
+from mapping_coverage import CoverageSpec, write_coverage
+from note_texts import NOTE_TEXTS_FILE, NoteTextStore
+from paths import DEID_SOURCE_DIR, DEST_DIR, ID_SOURCE_DIR, KNOWLEDGE_DIR, RULES_DIR
+from rules import compile_rules, unmatched_values
+from snippets import extract_snippets
+from runner import Task, run
+import writers
+from writers import StreamingTableWriter, concat_outputs, write_table
 
 pl.Config.set_fmt_str_lengths(80)
 
@@ -24,9 +51,6 @@ console = Console(
     emoji=True,
 )
 
-KNOWLEDGE_DIR = Path().cwd().parent / "data" / "knowledge_bases"
-DEST_DIR = Path().cwd().parent / "data" / "omop_tables"
-
 
 def unique_pts(df: pl.LazyFrame) -> pl.LazyFrame:
     # this is NOT perfect
@@ -61,10 +85,13 @@ def unique_pts(df: pl.LazyFrame) -> pl.LazyFrame:
     return combined
 
 
+# the lookups are built on first use and kept for the process, every table is
+# built in a spawned process that imports this module and needs only a few
+@cache
 def make_patient_id_lookup() -> dict[int, str]:
     from combine_cohorts import combined as df
 
-    return {
+    patient_num_to_id = {
         row[1]: row[0]
         for row in (
             unique_pts(df)
@@ -74,13 +101,11 @@ def make_patient_id_lookup() -> dict[int, str]:
             .to_numpy()
         )
     }
-
-
-patient_num_to_id = make_patient_id_lookup()
-assert (
-    len(patient_num_to_id) == 26918
-), f"Should be 26,918 patients, got {len(patient_num_to_id)}"
-print(f"patient_num_to_id: {len(patient_num_to_id)}")
+    assert (
+        len(patient_num_to_id) == 26918
+    ), f"Should be 26,918 patients, got {len(patient_num_to_id)}"
+    print(f"patient_num_to_id: {len(patient_num_to_id)}")
+    return patient_num_to_id
 
 
 def load_patient_map() -> dict[str, dict[str, tuple[str, int]]]:
@@ -88,6 +113,7 @@ def load_patient_map() -> dict[str, dict[str, tuple[str, int]]]:
         return json.load(f)
 
 
+@cache
 def make_location_lookup() -> dict[str, int]:
     # same steps as in `omop_locations` so the ids should be the same
     from combine_cohorts import combined
@@ -103,9 +129,6 @@ def make_location_lookup() -> dict[str, int]:
     }
 
 
-location_lookup = make_location_lookup()
-
-
 def omop_persons():
     from combine_cohorts import combined
 
@@ -122,7 +145,7 @@ def omop_persons():
         [
             #
             # required
-            pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
+            pl.col("PATIENT_NUM").map_dict(make_patient_id_lookup()).alias("person_id"),
             pl.col("BIRTH_DATE").dt.year().alias("year_of_birth"),
             pl.col("PATIENT_NUM")
             .apply(lambda x: lookup(x, "GENDER", 1))  # type: ignore
@@ -137,18 +160,18 @@ def omop_persons():
             # optional
             pl.col("BIRTH_DATE").dt.month().alias("month_of_birth"),
             pl.col("BIRTH_DATE").dt.day().alias("day_of_birth"),
-            pl.col("PATIENT_NUM").map_dict(location_lookup).alias("location_id"),
+            pl.col("PATIENT_NUM").map_dict(make_location_lookup()).alias("location_id"),
             # for linkage back to source analytical tables
             pl.col("PATIENT_NUM").alias("person_source_value"),
             pl.col("PATIENT_NUM")
             .apply(lambda x: lookup(x, "GENDER", 0))  # type: ignore
-            .alias("gender_concept_id"),
+            .alias("gender_source_value"),
             pl.col("PATIENT_NUM")
             .apply(lambda x: lookup(x, "RACE", 0))  # type: ignore
-            .alias("race_concept_id"),
+            .alias("race_source_value"),
             pl.col("PATIENT_NUM")
             .apply(lambda x: lookup(x, "ETHNICITY", 0))  # type: ignore
-            .alias("ethnicity_concept_id"),
+            .alias("ethnicity_source_value"),
             #
             # null
             pl.lit(None).alias("birth_datetime"),
@@ -158,9 +181,9 @@ def omop_persons():
             pl.lit(None).alias("race_source_concept_id"),
             pl.lit(None).alias("ethnicity_source_concept_id"),
         ]
-    ).drop(old_cols)
+    ).drop(old_cols).pipe(conform, "person")
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Person.csv", index=False)
+    write_table(omop.collect(), DEST_DIR / "Person")
 
 
 def omop_locations():
@@ -208,9 +231,10 @@ def omop_locations():
         )
         .drop(address_cols + ["combined_address", "PATIENT_NUM"])
         .with_row_count(name="location_id", offset=1)
+        .pipe(conform, "location")
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Location.csv", index=False)
+    write_table(omop.collect(), DEST_DIR / "Location")
 
 
 def omop_deaths():
@@ -225,22 +249,18 @@ def omop_deaths():
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 # default to december 30th because we don't know the exact date
-                pl.col("ADMT_DT")
-                .dt.year()
-                .apply(lambda x: f"{x}-12-30")
-                .str.strptime(pl.Date, "%Y-%m-%d")
-                .alias("death_date"),
+                pl.date(pl.col("ADMT_DT").dt.year(), 12, 30).alias("death_date"),
                 #
                 # optional
                 # ehr encounter id
                 pl.lit(32827).alias("death_type_concept_id"),
-                pl.col("ADMT_DT")
-                .dt.year()
-                .apply(lambda x: f"{x}-12-30 00:00:00")
-                .str.strptime(pl.Datetime, "%Y-%m-%d %H:%M:%S")
-                .alias("death_date"),
+                pl.datetime(pl.col("ADMT_DT").dt.year(), 12, 30).alias(
+                    "death_datetime"
+                ),
                 #
                 # null
                 pl.lit(None).alias("cause_concept_id"),
@@ -249,11 +269,15 @@ def omop_deaths():
             ]
         )
         .drop(["PATIENT_NUM", "ADMT_DT"])
+        .pipe(conform, "death")
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Death.csv", index=False)
+    table = omop.collect()
+    write_date_summary(table, "Death")
+    write_table(table, DEST_DIR / "Death")
 
 
+@cache
 def make_encounter_lookup():
     from combine_encounters import combined as df
 
@@ -266,9 +290,7 @@ def make_encounter_lookup():
     }
 
 
-visit_num_to_id = make_encounter_lookup()
-
-
+@cache
 def make_encounter_date_lookup():
     from combine_encounters import combined as df
 
@@ -278,9 +300,6 @@ def make_encounter_date_lookup():
     }
 
 
-encounter_date_lookup = make_encounter_date_lookup()
-
-
 def omop_encounters():
     from combine_encounters import combined
 
@@ -302,12 +321,13 @@ def omop_encounters():
                 #
                 # required
                 pl.col("VISIT_NUM")
-                .map_dict(visit_num_to_id)
+                .map_dict(make_encounter_lookup())
                 .alias("visit_occurrence_id"),
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
-                # outpatient, not always true but want to check formatting
-                pl.lit(None).alias("visit_concept_id"),
-                # pl.lit(9202).alias("visit_concept_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
+                # inpatient/outpatient/ed, see `rules/visit_type.csv`
+                compile_rules("IN_OUT_CD_DES", "visit_type").alias("visit_concept_id"),
                 pl.col("ADMT_DT").cast(pl.Date).alias("visit_start_date"),
                 pl.col("DISCHRG_DT").cast(pl.Date).alias("visit_end_date"),
                 # ehr encounter type
@@ -332,9 +352,12 @@ def omop_encounters():
             ]
         )
         .drop(old_cols)
+        .pipe(conform, "visit_occurrence")
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Visit_Occurrence.csv", index=False)
+    table = omop.collect()
+    write_date_summary(table, "Visit_Occurrence")
+    write_table(table, DEST_DIR / "Visit_Occurrence")
 
 
 def fetch_icd10_codes():
@@ -382,25 +405,27 @@ def omop_diagnoses():
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 pl.col("DIAGNOSIS").map_dict(icd_lookup).alias("condition_concept_id"),
                 pl.col("VISIT_NUM")
-                .map_dict(encounter_date_lookup)
+                .map_dict(make_encounter_date_lookup())
                 .alias("condition_start_date"),
                 pl.lit(32827).alias("condition_type_concept_id"),  # EHR encounter
                 # optional
                 pl.when(pl.col("DIAG_SEQUENCE_NUM") == "1")
                 .then(32902)  # primary diagnosis
-                .otherwise(None),
+                .otherwise(None)
+                .alias("condition_status_concept_id"),
                 pl.lit(None).alias("condition_start_datetime"),
                 pl.lit(None).alias("condition_end_date"),
                 pl.lit(None).alias("condition_end_datetime"),
                 # null
-                pl.lit(None).alias("condition_status_concept_id"),
                 pl.lit(None).alias("stop_reason"),
                 pl.lit(None).alias("provider_id"),
                 pl.col("VISIT_NUM")
-                .map_dict(visit_num_to_id)
+                .map_dict(make_encounter_lookup())
                 .alias("visit_occurrence_id"),
                 pl.lit(None).alias("visit_detail_id"),
                 pl.col("DIAGNOSIS").alias("condition_source_value"),
@@ -409,12 +434,22 @@ def omop_diagnoses():
             ]
         )
         .drop(old_cols)
-        .with_row_count(name="condition_occurrence_id", offset=1)
+        .pipe(conform, "condition_occurrence")
+        .pipe(
+            assign_ids,
+            "condition_occurrence_id",
+            ["person_id", "condition_start_date", "condition_source_value"],
+        )
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(
-        DEST_DIR / "Condition_occurrence.csv", index=False
+    table = omop.collect()
+    write_coverage(
+        table,
+        "Condition_occurrence",
+        [CoverageSpec("condition_concept_id", "condition_source_value", "ICD10")],
     )
+    write_date_summary(table, "Condition_occurrence")
+    write_table(table, DEST_DIR / "Condition_occurrence")
 
 
 def omop_procedures():
@@ -455,7 +490,9 @@ def omop_procedures():
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 pl.col("CPT_CODE").map_dict(cpt4_lookup).alias("procedure_concept_id"),
                 pl.col("SERVICE_DATE").alias("procedure_date"),
                 # 32827 is EHR encounter
@@ -464,7 +501,7 @@ def omop_procedures():
                 # optional
                 pl.col("CPT_QUANTITY").cast(pl.Float64).alias("quantity"),
                 pl.col("VISIT_NUM")
-                .map_dict(visit_num_to_id)
+                .map_dict(make_encounter_lookup())
                 .alias("visit_occurrence_id"),
                 pl.col("CPT_CODE").alias("procedure_source_value"),
                 # omop says ETL should decide on method if more than one
@@ -487,12 +524,27 @@ def omop_procedures():
             ]
         )
         .drop(old_cols)
-        .with_row_count(name="procedure_occurrence_id", offset=1)
+        .pipe(conform, "procedure_occurrence")
+        .pipe(
+            assign_ids,
+            "procedure_occurrence_id",
+            ["person_id", "procedure_date", "procedure_source_value"],
+        )
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(
-        DEST_DIR / "Procedure_occurrence.csv", index=False
+    table = omop.collect()
+    write_coverage(
+        table,
+        "Procedure_occurrence",
+        [
+            CoverageSpec("procedure_concept_id", "procedure_source_value", "CPT4"),
+            CoverageSpec(
+                "modifier_concept_id", "modifier_source_value", "CPT4 Modifier"
+            ),
+        ],
     )
+    write_date_summary(table, "Procedure_occurrence")
+    write_table(table, DEST_DIR / "Procedure_occurrence")
 
 
 def omop_labs():
@@ -530,11 +582,16 @@ def omop_labs():
     old_cols = df.columns
 
     omop = (
-        df.with_columns(
+        # adds `value_as_number`, `value_operator`, `operator_concept_id`,
+        # `value_unit`, `value_as_concept_id`, `range_low` and `range_high`
+        df.pipe(parse_lab_values)
+        .with_columns(
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 pl.col("LOINC_CD")
                 .map_dict(loinc_lookup)
                 .alias("measurement_concept_id"),
@@ -547,21 +604,21 @@ def omop_labs():
                 # datetime will be required in CDMv6
                 pl.col("ORDR_PERFRMD_DT_TM").alias("measurement_datetime"),
                 pl.col("ORDR_PERFRMD_DT_TM").cast(pl.Time).alias("measurement_time"),
-                pl.lit("=").alias("operator_concept_id"),
-                pl.col("VALUE_NUM").alias("value_as_number"),
-                pl.col("REFERENCE_LOWER_LIMIT").alias("range_low"),
-                pl.col("REFERENCE_UPPER_LIMIT").alias("range_high"),
                 pl.col("VISIT_NUM")
-                .map_dict(visit_num_to_id)
+                .map_dict(make_encounter_lookup())
                 .alias("visit_occurrence_id"),
                 pl.col("LOINC_CD").alias("measurement_source_value"),
-                pl.col("UNIT_OF_MEAS")
+                # units written next to a text result count when none were given
+                pl.coalesce([pl.col("UNIT_OF_MEAS"), pl.col("value_unit")])
                 .map_dict(units_lookup)
                 .alias("unit_source_concept_id"),
-                pl.col("UNIT_OF_MEAS").alias("unit_source_value"),
+                pl.coalesce([pl.col("UNIT_OF_MEAS"), pl.col("value_unit")]).alias(
+                    "unit_source_value"
+                ),
+                pl.coalesce([pl.col("VALUE_TXT"), pl.col("VALUE_NUM").cast(pl.Utf8)])
+                .alias("value_source_value"),
                 #
                 # null
-                pl.lit(None).alias("value_as_concept_id"),
                 pl.lit(None).alias("provider_id"),
                 pl.lit(None).alias("visit_detail_id"),
                 pl.lit(None).alias("measurement_source_concept_id"),
@@ -569,65 +626,34 @@ def omop_labs():
                 pl.lit(None).alias("meas_event_field_concept_id"),
             ]
         )
-        .with_columns([])
-        .drop(old_cols)
-        .with_row_count(name="measurement_id", offset=1)
+        .drop(old_cols + ["value_operator", "value_unit"])
+        .pipe(conform, "measurement")
+        .pipe(
+            assign_ids,
+            "measurement_id",
+            ["person_id", "measurement_datetime", "measurement_source_value"],
+        )
     )
     console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Measurement.csv", index=False)
-
-
-def map_routes(x: str) -> int | None:
-    if any(
-        item in x for item in ["oral", "swish", "spit", "swallow", "mouth", "throat"]
-    ):
-        return 4132161
-    elif "intravenous" in x:
-        return 4171047
-    elif "subcutaneous" in x:
-        return 4142048
-    elif "topical" in x or "external" in x:
-        return 4263689
-    elif "tube" in x:
-        return 3661892
-    elif "sublingual" in x:
-        return 4292110
-    elif "transdermal" in x:
-        return 4262099
-    elif x == "nebulization":
-        return 45956874
-    elif "nasal" in x or "nostril" in x:
-        return 4262914
-    elif "external" in x:
-        return 4157760
-    elif "intravenous" in x:
-        return 4171047
-    elif "muscular" in x:
-        return 4302612
-    elif "epidural" in x:
-        return 4225555
-    elif "inhalation" in x:
-        return 45956874
-    # there are more, but these are the MAJOR categories
-    else:
-        return None
+    table = omop.collect()
+    write_coverage(
+        table,
+        "Measurement",
+        [
+            CoverageSpec("measurement_concept_id", "measurement_source_value", "LOINC"),
+            CoverageSpec("unit_source_concept_id", "unit_source_value", "UCUM"),
+        ],
+    )
+    write_date_summary(table, "Measurement")
+    write_table(table, DEST_DIR / "Measurement")
 
 
 # use this in omop MEDS
-def omop_emars() -> pl.LazyFrame:
+def omop_emars(ndc_lookup: pl.LazyFrame, name_index: pl.DataFrame) -> pl.LazyFrame:
     from combine_emars import combined as emars
 
-    drug_name_lookup: dict[str, int] = {
-        row[1]: row[0]
-        for row in pl.scan_csv(
-            KNOWLEDGE_DIR / "CONCEPT.CSV", low_memory=False, sep="\t"
-        )
-        .filter(pl.col("standard_concept") == "S")
-        .filter(pl.col("domain_id") == "Drug")
-        .select(["concept_id", "concept_code"])
-        .collect()
-        .to_numpy()
-    }
+    ndc_cols = ["PRIMARY_NDC", "SECOND_NDC", "THIRD_NDC", "FOURTH_NDC", "FIFTH_NDC"]
+    name_cols = ["MED_ORDER_NAME", "GENERIC_NAME"]
 
     old_emar_cols = emars.columns
     table = (
@@ -640,14 +666,17 @@ def omop_emars() -> pl.LazyFrame:
                 .keep_name()
             ]
         )
+        # adds `drug_concept_id`, `drug_source_concept_id` and `ndc_source_value`
+        .pipe(map_ndc_columns, ndc_cols, ndc_lookup)
+        # fuzzy match the names of whatever the NDCs could not map
+        .pipe(map_drug_names, name_cols, name_index)
         .with_columns(
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
-                pl.col("MED_ORDER_NAME")
-                .map_dict(drug_name_lookup)
-                .alias("drug_concept_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 pl.col("MED_ADMINISTERED_DTTM")
                 .cast(pl.Date)
                 .alias("drug_exposure_start_date"),
@@ -660,50 +689,36 @@ def omop_emars() -> pl.LazyFrame:
                 pl.col("STOP_DATETIME").alias("drug_exposure_end_datetime"),
                 pl.col("STOP_DATETIME").alias("verbatim_end_date"),
                 pl.col("DISCONTINUE_RSN").alias("stop_reason"),
-                pl.lit("").alias("refills"),  # None for EMARS
-                pl.lit("DOSE").alias("quantity"),
-                pl.lit("1").alias("days_supply"),  # default
+                pl.lit(None).alias("refills"),  # None for EMARS
+                pl.col("DOSE").alias("quantity"),
+                pl.lit(1).alias("days_supply"),  # default
                 pl.col("SUMMARY_LINE").alias("sig"),
-                pl.col("ORDER_ROUTE_CODE")
-                .str.to_lowercase()
-                .apply(map_routes)
-                .alias("route_concept_id"),
+                compile_rules("ORDER_ROUTE_CODE", "route").alias("route_concept_id"),
                 pl.col("VISIT_NUM")
-                .map_dict(visit_num_to_id)
+                .map_dict(make_encounter_lookup())
                 .alias("visit_occurrence_id"),
-                pl.lit("MED_ORDER_NAME").alias("drug_source_value"),
+                # the NDC that mapped, otherwise the ordered medication name
+                pl.coalesce([pl.col("ndc_source_value"), pl.col("MED_ORDER_NAME")])
+                .alias("drug_source_value"),
                 pl.col("ORDER_ROUTE_CODE").alias("route_source_value"),
                 pl.col("DOSEUNIT").alias("dose_unit_source_value"),
-                pl.col("PRIMARY_NDC").alias("drug_source_concept_id"),
                 #
                 # null
-                pl.lit("").alias("provider_id"),
-                pl.lit("").alias("lot_number"),
-                pl.lit("").alias("visit_detail_id"),
+                pl.lit(None).alias("provider_id"),
+                pl.lit(None).alias("lot_number"),
+                pl.lit(None).alias("visit_detail_id"),
             ]
         )
-        .drop(old_emar_cols)
+        .drop(old_emar_cols + ["ndc_source_value"])
     )
     console.log("EMAR done")
     return table
 
 
 # use this in omop MEDS
-def omop_rx() -> pl.LazyFrame:
+def omop_rx(ndc_lookup: pl.LazyFrame, name_index: pl.DataFrame) -> pl.LazyFrame:
     from combine_rx import combined as rx
 
-    ndc_lookup: dict[str, int] = {
-        row[1]: row[0]
-        for row in pl.scan_csv(
-            KNOWLEDGE_DIR / "CONCEPT.CSV", low_memory=False, sep="\t"
-        )
-        .filter(pl.col("standard_concept") == "S")
-        .filter(pl.col("domain_id") == "Drug")
-        .select(["concept_id", "concept_code"])
-        .collect()
-        .to_numpy()
-    }
-
     old_rx_cols = rx.columns
     table = (
         rx.with_columns(
@@ -715,12 +730,17 @@ def omop_rx() -> pl.LazyFrame:
                 .keep_name()
             ]
         )
+        # adds `drug_concept_id`, `drug_source_concept_id` and `ndc_source_value`
+        .pipe(map_ndc_columns, ["NDC"], ndc_lookup)
+        # fuzzy match the names of whatever the NDCs could not map
+        .pipe(map_drug_names, ["DESCRIPTION", "TCGPI_NAME"], name_index)
         .with_columns(
             [
                 #
                 # required
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
-                pl.col("NDC").map_dict(ndc_lookup).alias("drug_concept_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
                 pl.col("ORDER_START_DTTM")
                 .cast(pl.Date)
                 .alias("drug_exposure_start_date"),
@@ -737,124 +757,194 @@ def omop_rx() -> pl.LazyFrame:
                 pl.col("QUANTITY").alias("quantity"),
                 pl.col("DAYS_SUPPLY").alias("days_supply"),
                 pl.col("ORDER_SIG").alias("sig"),
-                # see above
-                pl.col("ROUTE")
-                .str.to_lowercase()
-                .apply(map_routes)
-                .alias("route_concept_id"),
-                pl.lit("DOSE").alias("drug_source_value"),
+                # see `rules/route.csv`
+                compile_rules("ROUTE", "route").alias("route_concept_id"),
+                pl.col("NDC").alias("drug_source_value"),
                 pl.col("ROUTE").alias("route_source_value"),
                 pl.col("DOSE_UOM").alias("dose_unit_source_value"),
-                pl.col("NDC").alias("drug_source_concept_id"),
                 #
                 # null
-                pl.lit("").alias("provider_id"),
-                pl.lit("").alias("lot_number"),
-                pl.lit(0).cast(pl.Int64).alias("visit_occurrence_id"),
-                pl.lit("").alias("visit_detail_id"),
+                pl.lit(None).alias("provider_id"),
+                pl.lit(None).alias("lot_number"),
+                pl.lit(None).alias("visit_occurrence_id"),
+                pl.lit(None).alias("visit_detail_id"),
             ]
         )
-        .drop(old_rx_cols)
+        .drop(old_rx_cols + ["ndc_source_value"])
     )
     console.log("RX done")
     return table
 
 
 def omop_medications():
-    # not sure why we have to do this this way and why standard `pl.concat` doesn't work
-    # but whatever
-    emars = omop_emars()
-    emars = emars.select(sorted(emars.columns))
-    # emars.collect().to_pandas().to_csv("EMAR.csv", index=False)
-    rx = omop_rx()
-    rx = rx.select(sorted(rx.columns))
-    # need these lengths to infer correct schema
-    omop = pl.concat(
+    console.log("Loading NDC to RxNorm lookup...")
+    # both only change with the vocabulary release, so they are cached on it
+    ndc_lookup = cached_frame(
+        "ndc_lookup",
+        ATHENA_VOCABULARY + [Path("drug_mapping.py")],
+        lambda: load_ndc_lookup().collect(),
+    ).lazy()
+    console.log("Loaded NDC to RxNorm lookup")
+    name_index = cached_frame(
+        "drug_name_trigrams",
+        ATHENA_VOCABULARY + [Path("drug_name_matching.py")],
+        lambda: build_trigram_index(load_drug_concepts()),
+    )
+    # both halves carry categorical columns, which can only be concatenated
+    # when they share one string cache
+    with pl.StringCache():
+        # conform each half first so the column order and dtypes line up, each
+        # half is a partition numbered on its own once both sizes are known
+        id_key = ["person_id", "drug_exposure_start_datetime", "drug_source_value"]
+        halves = pl.collect_all(
+            [
+                conform(omop_emars(ndc_lookup, name_index), "drug_exposure"),
+                conform(omop_rx(ndc_lookup, name_index), "drug_exposure"),
+            ]
+        )
+        starts = partition_starts([len(half) for half in halves])
+        table = pl.concat(
+            [
+                assign_ids(half, "drug_exposure_id", id_key, start=start)
+                for half, start in zip(halves, starts)
+            ]
+        )
+        console.log(table.columns)
+    write_coverage(
+        table,
+        "Drug_Exposure",
         [
-            emars,
-            rx,
-        ]
-    ).with_row_count(name="drug_exposure_id", offset=1)
-    console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Drug_Exposure.csv", index=False)
-
-
-def map_note_type(x: str) -> int | None:
-    if x == "2.  intake & output" or "flowsheet" in x:
-        return 706274
-    elif "progress" in x:
-        return 706550
-    elif "education" in x:
-        return 706287
-    elif "care plan" in x:
-        return 706300
-    elif "evaluation" in x:
-        return 706346
-    elif "oncology" in x:
-        return 706266
-    elif "discharge" in x:
-        return 706531
-    elif "admit" in x or "admission" in x:
-        return 706554
-    elif "note" in x:
-        # generic note
-        return 706391
-    # specific
-    elif x == "mechanical ventilation record":
-        return 1002469
-    else:
-        return None
+            # `drug_source_value` is the NDC when one mapped, otherwise the name
+            CoverageSpec(
+                "drug_concept_id",
+                "drug_source_value",
+                pl.when(pl.col("drug_source_value").str.contains(r"^[0-9-]+$"))
+                .then(pl.lit("NDC"))
+                .otherwise(pl.lit("Drug name")),
+            ),
+            CoverageSpec("route_concept_id", "route_source_value", "Route"),
+        ],
+    )
+    write_date_summary(table, "Drug_Exposure")
+    write_table(table, DEST_DIR / "Drug_Exposure")
 
 
-def omop_notes():
-    df = pl.scan_ipc(Path().cwd().parent / "data" / "notes.feather")
+# rows of `notes.feather` mapped and written at a time
+NOTE_BATCH_SIZE = 50_000
+# slices of `notes.feather` written in parallel and merged in order afterwards
+NOTE_SHARDS = 1
+
+NOTES_FILE = Path().cwd().parent / "data" / "notes.feather"
+
+
+def note_batches(path: Path, start: int, stop: int) -> Iterator[pl.DataFrame]:
+    """Record batches `start` to `stop` of an IPC file in `NOTE_BATCH_SIZE` slices."""
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(start, stop):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, NOTE_BATCH_SIZE):
+                yield pl.from_arrow(batch.slice(offset, NOTE_BATCH_SIZE))
 
-    def identify_note_type(x: str) -> int:
-        if x == "SCM":
-            return 32829
-        elif x == "EPIC":
-            return 32831
-        elif x == "AEHR":
-            return 32834
-        else:
-            raise ValueError(f"Unknown source: {x}")
 
+def map_notes(df: pl.DataFrame) -> pl.DataFrame:
     old_cols = df.columns
+    return (
+        df.with_columns(
+            [
+                # required
+                # already has `note_id` column as identifier
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("person_id"),
+                pl.col("CREATED_DTM").cast(pl.Date).alias("note_date"),
+                # source of note (ehr note, ehr admin, etc)
+                compile_rules("NOTE_SOURCE", "note_source").alias(
+                    "note_type_concept_id"
+                ),
+                # see `rules/note_class.csv`
+                compile_rules("NOTE_TYPE", "note_class").alias(
+                    "note_class_concept_id"
+                ),
+                pl.col("NOTE_TEXT").alias("note_text"),
+                # encoding for the note, only valid is utf-8 id
+                pl.lit(32678).alias("encoding_concept_id"),
+                # english
+                pl.lit(4180186).alias("language_concept_id"),
+                #
+                # optional
+                pl.col("CREATED_DTM").alias("note_datetime"),
+                pl.col("VISIT_NUM")
+                .map_dict(make_encounter_lookup())
+                .alias("visit_occurrence_id"),
+                # source value that was mapped to note_class_concept_id
+                pl.col("NOTE_TYPE").alias("note_source_value"),
+                #
+                # null
+                pl.lit(None).alias("note_title"),
+                pl.lit(None).alias("provider_id"),
+                pl.lit(None).alias("visit_detail_id"),
+                pl.lit(None).alias("note_event_id"),
+                pl.lit(None).alias("note_event_field_concept_id"),
+            ]
+        )
+        .drop([c for c in old_cols if c != "note_id"])
+        .pipe(conform, "note")
+    )
 
-    omop = df.with_columns(
-        [
-            # required
-            # already has `note_id` column as identifier
-            pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("person_id"),
-            pl.col("CREATED_DTM").cast(pl.Date).alias("note_date"),
-            # source of note (ehr note, ehr admin, etc)
-            pl.col("NOTE_SOURCE")
-            .apply(identify_note_type)
-            .alias("note_type_concept_id"),
-            pl.col("NOTE_TYPE").str.to_lowercase().alias("note_class_concept_id"),
-            pl.col("NOTE_TEXT").alias("note_text"),
-            # encoding for the note, only valid is utf-8 id
-            pl.lit(32678).alias("encoding_concept_id"),
-            # english
-            pl.lit(4180186).alias("language_concept_id"),
-            #
-            # optional
-            pl.col("CREATED_DTM").alias("note_datetime"),
-            pl.col("VISIT_NUM").map_dict(visit_num_to_id).alias("visit_occurrence_id"),
-            # source value that was mapped to note_class_concept_id
-            pl.col("NOTE_TYPE").alias("note_source_value"),
-            #
-            # null
-            pl.lit(None).alias("note_title"),
-            pl.lit(None).alias("provider_id"),
-            pl.lit(None).alias("visit_detail_id"),
-            pl.lit(None).alias("note_event_id"),
-            pl.lit(None).alias("note_event_field_concept_id"),
-        ]
-    ).drop([c for c in old_cols if c != "note_id"])
-    console.log(omop.columns)
-    omop.collect().to_pandas().to_csv(DEST_DIR / "Note.csv", index=False)
-    del omop, df
+
+def write_notes(start: int, stop: int, path: Path) -> pl.DataFrame:
+    """Map and write record batches `start` to `stop` of the notes.
+
+    Without any notes an empty table with the Note schema is written, so the
+    output exists for the tables and checks downstream.
+
+    Returns:
+        pl.DataFrame: date summary of the written notes
+    """
+    summaries = []
+    with NoteTextStore(NOTE_TEXTS_FILE) as store, StreamingTableWriter(
+        path, schema=CDM_SCHEMAS["note"]
+    ) as writer:
+        for batch in note_batches(NOTES_FILE, start, stop):
+            # notes only hold the hash of their text
+            batch = batch.with_columns(
+                [pl.from_arrow(store.texts(batch["TEXT_HASH"])).alias("NOTE_TEXT")]
+            )
+            table = map_notes(batch)
+            summaries.append(date_summary(table))
+            writer.write(table)
+    if not summaries:
+        summaries.append(date_summary(pl.DataFrame(schema=CDM_SCHEMAS["note"])))
+    return pl.concat(summaries)
+
+
+def omop_notes(shards: int = NOTE_SHARDS):
+    """Write the Note table, in `shards` slices in parallel when more than one.
+
+    Args:
+        shards (int): slices of `notes.feather` written at the same time
+    """
+    # the projection keeps this scan to the one column
+    unknown = unmatched_values(pl.scan_ipc(NOTES_FILE), "NOTE_SOURCE", "note_source")
+    if unknown:
+        raise ValueError(f"Unknown sources: {unknown}")
+
+    with pa.memory_map(str(NOTES_FILE)) as source:
+        n_batches = pa.ipc.open_file(source).num_record_batches
+    shards = max(1, min(shards, n_batches))
+    bounds = [n_batches * i // shards for i in range(shards + 1)]
+    console.log(f"Writing {n_batches:,} note batches in {shards} shards...")
+    if shards == 1:
+        summaries = [write_notes(0, n_batches, DEST_DIR / "Note")]
+    else:
+        parts = [DEST_DIR / f"Note_shard{i:03d}" for i in range(shards)]
+        # polars and pyarrow release the GIL, threads are enough here
+        with ThreadPoolExecutor(max_workers=shards) as pool:
+            summaries = list(pool.map(write_notes, bounds[:-1], bounds[1:], parts))
+        concat_outputs(parts, DEST_DIR / "Note")
+    # a summary of summaries still has the min and max date of every person
+    write_date_summary(pl.concat(summaries), "Note")
 
 
 def cui_to_snomed_converter() -> dict[str, str]:
@@ -876,147 +966,167 @@ def cui_to_snomed_converter() -> dict[str, str]:
     return mapper
 
 
-def snomed_to_omop_conveter() -> dict[str, int]:
-    return {
-        row[6]: row[0]
-        for row in pl.read_csv(
-            Path().cwd().parent / "data" / "knowledge_bases" / "CONCEPT.csv",
+# partitioned output of `scripts/scispacy_notes_snomed.py`
+NLP_OUTPUT_DIR = Path().cwd().parent / "data" / "snomed_output"
+
+
+def load_snomed_concepts() -> pl.LazyFrame:
+    """Standard SNOMED concepts keyed by their code, to join the NLP output on."""
+    return (
+        pl.scan_csv(
+            KNOWLEDGE_DIR / "CONCEPT.CSV",
+            low_memory=False,
             sep="\t",
+            dtypes={"concept_code": pl.Utf8},
         )
         .filter(pl.col("standard_concept") == "S")
         .filter(pl.col("vocabulary_id") == "SNOMED")
-        .to_numpy()
-    }
-
-
-def omop_note_nlp():
-    # data_dir = Path().cwd().parent / "data" / "scispacy_output" / "batches"
-    # files = list(data_dir.iterdir())
-
-    # console.log("[yellow]Creating cui to snomed map")
-    # cui_to_snomed = cui_to_snomed_converter()
-    # console.log("[green]Created cui to snomed map")
-
-    console.log("[yellow]Creating snomed to omop map")
-    snomed_to_omop = snomed_to_omop_conveter()
-    console.log("[green]Created snomed to omop map")
-
-    line_offset = 1
-    file = Path().cwd() / "snomed_output.jsonl"
-
-    # with open(DEST_DIR / "Note_NLP.csv", "w") as f:
-    # for i, file in tqdm(enumerate(files), total=len(files)):
-    df = pl.scan_ndjson(file)
-    df = (
-        df
-        # pl.read_ipc(file)
-        # .with_columns(
-        #     [
-        #         pl.col("nlp_datetime").str.strptime(
-        #             pl.Datetime, "%Y-%m-%dT%H:%M:%S%.6f"
-        #         ),
-        #         # pl.col("cui").map_dict(cui_to_snomed).alias("snomed_id"),
-        #     ]
-        # )
-        .with_columns(
+        .select(
             [
-                # pl.col("nlp_datetime").cast(pl.Date).alias("nlp_date"),
-                pl.col("cui")
-                .map_dict(snomed_to_omop)
-                .alias("note_nlp_concept_id"),
+                pl.col("concept_code").alias("suid"),
+                pl.col("concept_id").alias("note_nlp_concept_id"),
             ]
         )
     )
-    old_cols = df.columns
-    omop = (
-        df.with_columns(
-            [
-                #
-                # required
-                # for now this is an old invalid row_id
-                pl.col("row_num").alias("note_id"),
-                # raw text extracted
-                pl.col("entity").alias("lexical_variant"),
-                # date run
-                pl.lit("5-3-23").alias("nlp_date"),
-                #
-                # optional
-                pl.lit("scispacy v0.5.1 w/ SNOMED linker").alias("nlp_system"),
-                pl.col("cui").alias("note_nlp_source_concept_id"),
-                pl.col("note_nlp_concept_id"),
-                pl.lit(None).alias("nlp_datetime"),
-                #
-                # null
-                # can't we fill snippet?
-                pl.lit(None).alias("snippet"),
-                pl.lit(None).alias("offset"),
-                pl.lit(None).alias("section_concept_id"),
-                pl.lit(None).alias("term_exists"),
-                pl.lit(None).alias("term_temporal"),
-                pl.lit(None).alias("term_modifiers"),
-            ]
-        )
-        .drop([c for c in old_cols if c != "nlp_date" and c != "nlp_datetime"])
-        .with_row_count(name="note_nlp_id", offset=line_offset)
+
+
+def omop_note_nlp():
+    console.log("[yellow]Loading SNOMED concepts")
+    concepts = load_snomed_concepts().collect().lazy()
+
+    # NLP ran once per distinct text, mentions point into the text store by
+    # hash and are fanned out to every note with that text
+    notes_by_text = (
+        pl.scan_ipc(NOTES_FILE)
+        .select([pl.col("TEXT_HASH").alias("text_hash"), pl.col("note_id")])
+        .drop_nulls()
+        .collect()
+    )
+    parts = sorted(NLP_OUTPUT_DIR.glob("*.parquet"))
+    # the rows every partition fans out to are counted up front, so each one
+    # is numbered from its own start without waiting on the ones before it
+    counts = pl.collect_all(
+        [
+            pl.scan_parquet(part)
+            .select([pl.col("text_hash").cast(pl.Int64)])
+            .join(notes_by_text.lazy(), on="text_hash")
+            .select(pl.count())
+            for part in parts
+        ]
+    )
+    starts = partition_starts([count.item() for count in counts])
+    with NoteTextStore(NOTE_TEXTS_FILE) as store, StreamingTableWriter(
+        DEST_DIR / "Note_NLP", schema=CDM_SCHEMAS["note_nlp"]
+    ) as writer:
+        mapped: list[pl.DataFrame] = []
+        for part, start in tqdm(
+            zip(parts, starts), total=len(parts), desc="Note_NLP partitions"
+        ):
+            found = (
+                pl.scan_parquet(part)
+                .with_columns([pl.col("text_hash").cast(pl.Int64)])
+                .join(concepts, on="suid", how="left")
+                .collect()
+            )
+            # mentions of texts no note has, e.g. from an older store, have no
+            # row in the store to cut a snippet from
+            found = found.filter(
+                pl.col("text_hash").is_in(notes_by_text["text_hash"].unique())
+            )
+            if len(found) == 0:
+                continue
+            hashes = found["text_hash"].unique()
+            rows = found.select("text_hash").join(
+                pl.DataFrame({"text_hash": hashes}).with_row_count("text_row"),
+                on="text_hash",
+                how="left",
+            )["text_row"]
+            # snippets are cut once per mention of a text, not once per note
+            found = found.with_columns(
+                [
+                    extract_snippets(
+                        store.texts(hashes),
+                        rows.to_numpy(),
+                        found["start_char"].to_numpy(),
+                        found["end_char"].to_numpy(),
+                    ).alias("snippet")
+                ]
+            ).join(notes_by_text, on="text_hash")
+            table = (
+                found.with_columns(
+                    [
+                        #
+                        # required
+                        pl.col("note_id"),
+                        # raw text extracted
+                        pl.col("entity").alias("lexical_variant"),
+                        # date run
+                        pl.col("nlp_datetime").cast(pl.Date).alias("nlp_date"),
+                        #
+                        # optional
+                        pl.col("snippet"),
+                        pl.col("start_char").alias("offset"),
+                        pl.lit("scispacy v0.5.1 w/ SNOMED linker").alias("nlp_system"),
+                        # SNOMED is standard so the source concept is the same concept
+                        pl.col("note_nlp_concept_id").alias(
+                            "note_nlp_source_concept_id"
+                        ),
+                        pl.col("nlp_datetime"),
+                        pl.when(pl.col("negated"))
+                        .then(pl.lit("N"))
+                        .otherwise(pl.lit("Y"))
+                        .alias("term_exists"),
+                        #
+                        # null
+                        pl.lit(None).alias("section_concept_id"),
+                        pl.lit(None).alias("term_temporal"),
+                        pl.lit(None).alias("term_modifiers"),
+                    ]
+                )
+                .pipe(conform, "note_nlp")
+                .pipe(
+                    assign_ids,
+                    "note_nlp_id",
+                    ["note_id", "offset", "note_nlp_concept_id"],
+                    start=start,
+                )
+            )
+            writer.write(table)
+            # the two columns the coverage report needs, kept from every batch
+            mapped.append(table.select(["note_nlp_concept_id", "lexical_variant"]))
+
+    write_coverage(
+        pl.concat(mapped)
+        if mapped
+        else pl.DataFrame(
+            schema={"note_nlp_concept_id": pl.Int32, "lexical_variant": pl.Utf8}
+        ),
+        "Note_NLP",
+        [CoverageSpec("note_nlp_concept_id", "lexical_variant", "SNOMED")],
     )
-    omop = omop.collect()
-    omop.write_csv(file=DEST_DIR / "Note_NLP.csv")
-    console.log(f"[green]Wrote {len(omop)} rows to file")
 
 
 def omop_observation_period():
-    # ! requires all the other files to be done first !
-    # here we want to look through the dest dir and since its omop we know there will be
-    # "date" in the date columns so we can just search all of them :)
-    x = pl.read_csv(DEST_DIR / "Person.csv")["person_id"].unique()
-    people_table = pl.DataFrame({"person_id": x})
-    not_date_files = {
-        "Person.csv",
-        "Location.csv",
-        "Note_NLP.csv",
-        "Cohort.csv",
-        "Cohort_Definition.csv",
-    }
-    for file in DEST_DIR.glob("*.csv"):
-        if file.name in not_date_files:
-            continue
-        console.log(f"Getting observation period data from {file.name}...")
-        df = pl.scan_csv(file, try_parse_dates=True)
-        date_cols = [c for c in df.columns if "date" in c]
-        if len(date_cols) == 0:
-            raise ValueError(f"Could not find date columns in {file}")
-        pt_dates = (
-            df.select(date_cols + ["person_id"])
-            .groupby("person_id")
-            .agg([pl.min(col) for col in date_cols])
-        ).with_columns([pl.col("person_id").cast(pl.Int64)])
-        people_table = people_table.join(
-            pt_dates.collect(), on="person_id", how="outer"
-        )
-    console.log("Finding min and max dates...")
+    # ! requires the tables with dates to be built first !
+    # every one of them leaves a per person (min, max) date summary behind
+    console.log("Reducing date summaries...")
     omop = (
-        people_table.with_columns(
-            [pl.concat_list(pl.col(pl.Date, pl.Datetime)).alias("dates")]
-        ).select(
+        scan_date_summaries(list(DATED_TASKS.values()))
+        .select(
             [
-                # all
+                #
                 # required
                 pl.col("person_id"),
-                # exact = false allows us to parse only date from datetime
-                pl.col("dates")
-                .arr.min()
-                .cast(pl.Date)
-                .alias("observation_period_start_date"),
-                pl.col("dates")
-                .arr.max()
-                .cast(pl.Date)
-                .alias("observation_period_end_date"),
+                pl.col("min_date").alias("observation_period_start_date"),
+                pl.col("max_date").alias("observation_period_end_date"),
                 pl.lit(32827).alias("period_type_concept_id"),  # EHR encounter
             ]
         )
-    ).with_row_count(name="observation_period_id", offset=1)
+        .pipe(conform, "observation_period")
+        .pipe(assign_ids, "observation_period_id", ["person_id"])
+    )
     console.log(omop.columns)
-    omop.to_pandas().to_csv(DEST_DIR / "Observation_Period.csv", index=False)
+    write_table(omop.collect(), DEST_DIR / "Observation_Period")
 
 
 def omop_cohort_definition():
@@ -1055,9 +1165,9 @@ def omop_cohort_definition():
             "cohort_initiation_date": None,
         },
     ]
-    omop = pl.DataFrame(data)
+    omop = conform(pl.DataFrame(data), "cohort_definition")
     console.log(omop.columns)
-    omop.write_csv(DEST_DIR / "Cohort_Definition.csv")
+    write_table(omop, DEST_DIR / "Cohort_Definition")
 
 
 def omop_cohorts():
@@ -1079,7 +1189,9 @@ def omop_cohorts():
                 pl.col("cohort")
                 .map_dict(cohort_definition_map)
                 .alias("cohort_definition_id"),
-                pl.col("PATIENT_NUM").map_dict(patient_num_to_id).alias("subject_id"),
+                pl.col("PATIENT_NUM")
+                .map_dict(make_patient_id_lookup())
+                .alias("subject_id"),
                 pl.lit("2017-01-01")
                 .str.strptime(pl.Date, "%Y-%m-%d")
                 .alias("cohort_start_date"),
@@ -1089,30 +1201,303 @@ def omop_cohorts():
             ]
         )
         .drop(["PATIENT_NUM"])
+        .pipe(conform, "cohort")
     )
     console.log(omop.columns)
-    omop.write_csv(DEST_DIR / "Cohort.csv")
+    write_table(omop, DEST_DIR / "Cohort")
 
 
-if __name__ == "__main__":
-    for name, func in [
-        # ("persons", omop_persons),
-        # ("encounters", omop_encounters),
-        # ("locations", omop_locations),
-        # ("diagnoses", omop_diagnoses),
-        # ("procedures", omop_procedures),
-        # ("notes", omop_notes),
-        ("note_nlp", omop_note_nlp),
-        # ("labs", omop_labs),
-        # ("medications", omop_medications),
-        # ("deaths", omop_deaths),
-        # ("observation_period", omop_observation_period),
-        # ("cohort_definition", omop_cohort_definition),
-        # ("cohorts", omop_cohorts),
-        # ("observations", omop_observations),
-    ]:
-        console.log(f"[yellow]Processing {name} table...[/yellow]")
-        func()
-        console.log(f"[green]Exported {name} table.[/green]")
+ATHENA_VOCABULARY = [
+    KNOWLEDGE_DIR / "VOCABULARY.CSV",
+    KNOWLEDGE_DIR / "CONCEPT.CSV",
+    KNOWLEDGE_DIR / "CONCEPT_RELATIONSHIP.CSV",
+]
+
+
+def source_files(kind: str, module: str) -> list[Path]:
+    """Raw extracts of one kind plus the module that combines them."""
+    return sorted(DEID_SOURCE_DIR.glob(f"EX5765_COHORT*_{kind}_LDS.csv")) + [
+        Path(module)
+    ]
+
+
+# every builder maps patient and visit numbers with the module level lookups
+# and conforms to the CDM schema, so all of them depend on these
+SHARED_INPUTS = (
+    sorted(ID_SOURCE_DIR.glob("EX5765_COHORT*_COHORT_LDS.csv"))
+    + source_files("ENCOUNTER", "combine_encounters.py")
+    + [
+        Path("combine_cohorts.py"),
+        Path("cdm_schema.py"),
+        Path("writers.py"),
+        Path("ids.py"),
+    ]
+)
+SHARED_CODE = [unique_pts, make_patient_id_lookup, make_encounter_lookup]
+
+
+def table_task(
+    name: str,
+    func,
+    table: str,
+    inputs: list[Path],
+    code: list | None = None,
+    deps: list[str] | None = None,
+    memory_gb: float = 2.0,
+) -> Task:
+    """A builder writing `DEST_DIR / table`, with the shared inputs added."""
+    return Task(
+        name,
+        func,
+        deps=deps or [],
+        memory_gb=memory_gb,
+        inputs=SHARED_INPUTS + inputs,
+        code=SHARED_CODE + (code or []),
+        outputs=[DEST_DIR / table],
+    )
+
+
+# tables that leave a date summary behind for the observation period
+DATED_TASKS = {
+    "deaths": "Death",
+    "encounters": "Visit_Occurrence",
+    "diagnoses": "Condition_occurrence",
+    "procedures": "Procedure_occurrence",
+    "labs": "Measurement",
+    "medications": "Drug_Exposure",
+    "notes": "Note",
+}
+
+TASKS = [
+    table_task(
+        "persons",
+        omop_persons,
+        "Person",
+        [Path().cwd().parent / "data" / "patient_demographics.json"],
+        code=[load_patient_map],
+    ),
+    table_task(
+        "locations",
+        omop_locations,
+        "Location",
+        [],
+        code=[make_location_lookup],
+        deps=["persons"],
+    ),
+    table_task("deaths", omop_deaths, "Death", [Path("date_summary.py")]),
+    table_task(
+        "encounters",
+        omop_encounters,
+        "Visit_Occurrence",
+        [Path("date_summary.py"), Path("rules.py"), RULES_DIR / "visit_type.csv"],
+    ),
+    table_task(
+        "diagnoses",
+        omop_diagnoses,
+        "Condition_occurrence",
+        source_files("DIAGNOSIS", "combine_diagnoses.py")
+        + ATHENA_VOCABULARY
+        + [Path("date_summary.py"), Path("mapping_coverage.py")],
+        code=[fetch_icd10_codes],
+    ),
+    table_task(
+        "procedures",
+        omop_procedures,
+        "Procedure_occurrence",
+        source_files("PROCEDURE", "combine_procedures.py")
+        + [KNOWLEDGE_DIR / "CONCEPT_CPT4.CSV"]
+        + [Path("date_summary.py"), Path("mapping_coverage.py")],
+    ),
+    table_task(
+        "labs",
+        omop_labs,
+        "Measurement",
+        source_files("LABS", "combine_labs.py")
+        + ATHENA_VOCABULARY
+        + [
+            Path("lab_values.py"),
+            Path("date_summary.py"),
+            Path("mapping_coverage.py"),
+        ],
+        memory_gb=8,
+    ),
+    # NDC lookup and trigram index
+    table_task(
+        "medications",
+        omop_medications,
+        "Drug_Exposure",
+        source_files("EMAR", "combine_emars.py")
+        + source_files("RX", "combine_rx.py")
+        + ATHENA_VOCABULARY
+        + [
+            Path("drug_mapping.py"),
+            Path("drug_name_matching.py"),
+            Path("rules.py"),
+            RULES_DIR / "route.csv",
+            Path("date_summary.py"),
+            Path("mapping_coverage.py"),
+        ],
+        code=[omop_emars, omop_rx],
+        memory_gb=12,
+    ),
+    table_task(
+        "notes",
+        omop_notes,
+        "Note",
+        [
+            NOTES_FILE,
+            NOTE_TEXTS_FILE,
+            Path("note_texts.py"),
+            Path("rules.py"),
+            RULES_DIR / "note_source.csv",
+            RULES_DIR / "note_class.csv",
+            Path("date_summary.py"),
+        ],
+        code=[map_notes, write_notes, note_batches],
+        memory_gb=16,
+    ),
+    table_task(
+        "note_nlp",
+        omop_note_nlp,
+        "Note_NLP",
+        sorted(NLP_OUTPUT_DIR.glob("*.parquet"))
+        + ATHENA_VOCABULARY
+        + [
+            NOTES_FILE,
+            NOTE_TEXTS_FILE,
+            Path("note_texts.py"),
+            Path("snippets.py"),
+            Path("mapping_coverage.py"),
+        ],
+        code=[load_snomed_concepts],
+        memory_gb=8,
+    ),
+    Task(
+        "observation_period",
+        omop_observation_period,
+        deps=list(DATED_TASKS),
+        # the summaries only change when the dates of an upstream table do
+        inputs=[SUMMARY_DIR / f"{table}.parquet" for table in DATED_TASKS.values()]
+        + [
+            Path("date_summary.py"),
+            Path("cdm_schema.py"),
+            Path("writers.py"),
+            Path("ids.py"),
+        ],
+        outputs=[DEST_DIR / "Observation_Period"],
+    ),
+    Task(
+        "cohort_definition",
+        omop_cohort_definition,
+        inputs=[Path("cdm_schema.py"), Path("writers.py")],
+        outputs=[DEST_DIR / "Cohort_Definition"],
+    ),
+    table_task(
+        "cohorts",
+        omop_cohorts,
+        "Cohort",
+        source_files("DIAGNOSIS", "combine_diagnoses.py")
+        + [Path("build_patient_cohort_map.py")],
+        deps=["diagnoses", "cohort_definition"],
+    ),
+]
+
+
+def omop_dq():
+    concept_domains = cached_frame(
+        "concept_domains",
+        ATHENA_VOCABULARY + [Path("dq.py")],
+        load_concept_domains,
+    )
+    run_dq(concept_domains)
+
+
+TASKS.append(
+    Task(
+        "dq",
+        omop_dq,
+        deps=[task.name for task in TASKS],
+        memory_gb=8,
+        # whatever got written, in any format
+        inputs=[
+            (DEST_DIR / stem).with_suffix(suffix)
+            for stem in TABLE_FILES.values()
+            for suffix, _ in writers.WRITERS.values()
+        ]
+        + ATHENA_VOCABULARY
+        + [Path("dq.py"), Path("cdm_schema.py")],
+        outputs=[DQ_RESULTS_FILE.with_suffix("")],
+    )
+)
 
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="omop_tables.py",
+        description="Builds the OMOP tables from the combined source tables.",
+    )
+    parser.add_argument(
+        "targets",
+        nargs="*",
+        help=(
+            "Tables to build along with everything upstream, defaults to all. "
+            f"One of {[task.name for task in TASKS]}."
+        ),
+    )
+    parser.add_argument(
+        "--formats",
+        nargs="+",
+        default=writers.OUTPUT_FORMATS,
+        choices=sorted(writers.WRITERS),
+        help="Output formats to write every table in.",
+    )
+    parser.add_argument(
+        "--row-group-size",
+        type=int,
+        default=writers.PARQUET_ROW_GROUP_SIZE,
+        help="Rows per Parquet row group.",
+    )
+    parser.add_argument(
+        "--note-shards",
+        type=int,
+        default=NOTE_SHARDS,
+        help="Slices of the Note table written in parallel.",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Rebuild the selected tables even when their inputs did not change.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Max tables built at the same time, defaults to the CPU count.",
+    )
+    parser.add_argument(
+        "--memory-gb",
+        type=float,
+        default=None,
+        help="Memory budget shared by the running tables, defaults to 80%% of RAM.",
+    )
+    args = parser.parse_args()
+    writers.configure(formats=args.formats, row_group_size=args.row_group_size)
+    notes_task = next(task for task in TASKS if task.name == "notes")
+    # only changes how the Note table is written, not what, so it is no input
+    notes_task.kwargs["shards"] = args.note_shards
+
+    results = run(
+        TASKS,
+        targets=args.targets,
+        workers=args.workers,
+        memory_gb=args.memory_gb,
+        # a different output format is a different output
+        salt=json.dumps([sorted(args.formats), args.row_group_size]),
+        force=args.force,
+        # every table is built in a spawned process that imports `writers` anew
+        initializer=writers.configure,
+        initargs=(args.formats, args.row_group_size),
+    )
+    if any(result.error is not None for result in results):
+        raise SystemExit(1)
     console.log("[green]Done.[/green]")
@@ -3,3 +3,8 @@ from pathlib import Path
 
 ID_SOURCE_DIR = Path().home() / "068IPOP_STIMuLINK-DataAnalytics" / "UKHC_5765-Harris"
 DEID_SOURCE_DIR = Path().home() / "068IPOP_STIMuLINK-Team" / "UKHC_5765-Harris"
+
+KNOWLEDGE_DIR = Path().cwd().parent / "data" / "knowledge_bases"
+DEST_DIR = Path().cwd().parent / "data" / "omop_tables"
+# keyword/regex -> concept rule tables, see `rules.py`
+RULES_DIR = Path().cwd() / "rules"
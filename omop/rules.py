@@ -0,0 +1,83 @@
+import polars as pl
+
+from paths import RULES_DIR
+
+# how the `pattern` of a rule is compared against the lowercased source value
+MATCH_KINDS = ["contains", "equals", "regex"]
+
+
+def load_rules(name: str) -> pl.DataFrame:
+    """Read a rule table from `RULES_DIR`.
+
+    Rule tables are CSVs with the columns `match`, `pattern`, `concept_id` and
+    a free text `description`. Rules are tried top to bottom and the first one
+    that matches wins, so the order of the file matters.
+
+    Args:
+        name (str): file stem of the rule table, e.g. "route"
+
+    Returns:
+        pl.DataFrame: the rules in file order
+    """
+    rules = pl.read_csv(
+        RULES_DIR / f"{name}.csv",
+        dtypes={"match": pl.Utf8, "pattern": pl.Utf8, "concept_id": pl.Int64},
+    )
+    unknown = set(rules["match"].unique()) - set(MATCH_KINDS)
+    if unknown:
+        raise ValueError(f"Unknown match kinds in {name}.csv: {unknown}")
+    return rules
+
+
+def compile_rules(col: str, name: str) -> pl.Expr:
+    """Compile a rule table into one vectorized `when/then` expression.
+
+    Patterns are compared against the lowercased value of `col`, values no rule
+    matches become null.
+
+    Args:
+        col (str): column holding the source value
+        name (str): file stem of the rule table, e.g. "route"
+
+    Returns:
+        pl.Expr: the `concept_id` of the first matching rule
+    """
+    value = pl.col(col).cast(pl.Utf8).str.to_lowercase()
+    expr = None
+    for rule in load_rules(name).iter_rows(named=True):
+        pattern = rule["pattern"].lower()
+        if rule["match"] == "contains":
+            condition = value.str.contains(pattern, literal=True)
+        elif rule["match"] == "equals":
+            condition = value == pattern
+        else:
+            condition = value.str.contains(pattern)
+        concept = pl.lit(rule["concept_id"])
+        expr = (
+            pl.when(condition).then(concept)
+            if expr is None
+            else expr.when(condition).then(concept)
+        )
+    if expr is None:
+        return pl.lit(None)
+    return expr.otherwise(pl.lit(None))
+
+
+def unmatched_values(df: pl.LazyFrame, col: str, name: str) -> list[str]:
+    """Distinct non-null values of `col` that no rule of `name` matches.
+
+    Args:
+        df (pl.LazyFrame): the source frame
+        col (str): column holding the source value
+        name (str): file stem of the rule table
+
+    Returns:
+        list[str]: the unmatched source values
+    """
+    return (
+        df.select(pl.col(col).cast(pl.Utf8).unique())
+        .drop_nulls()
+        .filter(compile_rules(col, name).is_null())
+        .collect()[col]
+        .to_list()
+    )
@@ -0,0 +1,295 @@
+import dataclasses
+import multiprocessing as mp
+import os
+import resource
+import time
+import traceback
+from dataclasses import dataclass, field
+from multiprocessing.connection import wait
+from pathlib import Path
+from typing import Callable
+
+from rich.console import Console
+
+from fingerprint import fingerprint, load_fingerprints, save_fingerprint
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# share of the physical memory the runner lets tasks claim by default
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+@dataclass
+class Task:
+    """One table builder and what it needs before it can run.
+
+    Args:
+        name (str): unique task name used on the command line
+        func (Callable[..., None]): builds and writes the table
+        kwargs (dict): keyword arguments `func` is called with
+        deps (list[str]): tasks that have to finish first
+        memory_gb (float): rough peak memory, used to schedule within the budget
+        inputs (list[Path]): files the task reads, part of its fingerprint
+        code (list[Callable]): helpers whose source is fingerprinted with `func`
+        outputs (list[Path]): written tables without suffix, e.g. `DEST_DIR / "Note"`
+    """
+
+    name: str
+    func: Callable[..., None]
+    kwargs: dict = field(default_factory=dict)
+    deps: list[str] = field(default_factory=list)
+    memory_gb: float = 2.0
+    inputs: list[Path] = field(default_factory=list)
+    code: list[Callable] = field(default_factory=list)
+    outputs: list[Path] = field(default_factory=list)
+
+
+@dataclass
+class TaskResult:
+    name: str
+    seconds: float
+    peak_rss_mb: float
+    error: str | None = None
+    cached: bool = False
+
+
+def total_memory_gb() -> float:
+    """Physical memory of the machine in GB."""
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024**3
+
+
+def select_tasks(tasks: list[Task], targets: list[str] | None) -> dict[str, Task]:
+    """The targets and everything upstream of them.
+
+    Args:
+        tasks (list[Task]): the whole graph
+        targets (list[str] | None): task names, everything when empty or None
+
+    Returns:
+        dict[str, Task]: selected tasks by name, in the order of `tasks`
+    """
+    by_name = {task.name: task for task in tasks}
+    for task in tasks:
+        missing = [dep for dep in task.deps if dep not in by_name]
+        if missing:
+            raise ValueError(f"{task.name} depends on unknown tasks {missing}")
+    if not targets:
+        return by_name
+    unknown = [t for t in targets if t not in by_name]
+    if unknown:
+        raise ValueError(f"Unknown targets {unknown}, choose from {list(by_name)}")
+    selected: set[str] = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in selected:
+            selected.add(name)
+            stack.extend(by_name[name].deps)
+    return {name: task for name, task in by_name.items() if name in selected}
+
+
+def outputs_exist(task: Task) -> bool:
+    """Whether every output of the task was written in at least one format."""
+    return all(any(path.parent.glob(f"{path.name}.*")) for path in task.outputs)
+
+
+def _run_task(task: Task, conn, initializer: Callable | None, initargs: tuple):
+    """Child process entry point, reports timing and errors back over `conn`."""
+    start = time.perf_counter()
+    error = None
+    try:
+        if initializer is not None:
+            initializer(*initargs)
+        task.func(**task.kwargs)
+    except BaseException:
+        error = traceback.format_exc()
+    # the parent replaces it with what it reads when it reaps the process
+    conn.send(
+        TaskResult(task.name, time.perf_counter() - start, own_peak_rss_mb(), error)
+    )
+    conn.close()
+
+
+def own_peak_rss_mb() -> float:
+    """Peak RSS of this process or any child it reaped, in MB."""
+    # ru_maxrss is in KiB on linux
+    return (
+        max(
+            resource.getrusage(who).ru_maxrss
+            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+        )
+        / 1024
+    )
+
+
+def reap(process: mp.Process) -> tuple[int | None, float | None]:
+    """Wait for a finished task process, its exit code and peak RSS in MB.
+
+    `os.wait4` reports the usage of that one child, unlike `RUSAGE_CHILDREN`,
+    which is the max over every child reaped so far. Starting a process lets
+    multiprocessing reap children that already exited, the peak of such a
+    child is unknown here and None.
+    """
+    try:
+        _, status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.join()
+        return process.exitcode, None
+    # ru_maxrss is in KiB on linux
+    return os.waitstatus_to_exitcode(status), usage.ru_maxrss / 1024
+
+
+def run(
+    tasks: list[Task],
+    targets: list[str] | None = None,
+    workers: int | None = None,
+    memory_gb: float | None = None,
+    salt: str = "",
+    force: bool = False,
+    initializer: Callable | None = None,
+    initargs: tuple = (),
+) -> list[TaskResult]:
+    """Run the selected tasks in dependency order, independent ones in parallel.
+
+    Every task runs in its own spawned process, so it starts from a fresh
+    interpreter instead of a fork of a parent holding threads and locks, and
+    gives its memory back when it exits. Task functions have to be importable
+    module level functions, and run wide settings of the parent have to be
+    passed on with `initializer`, the child only sees what its imports set up.
+    A task is
+    started once its dependencies are done, a worker is free and its
+    `memory_gb` fits in what is left of the budget. A task larger than the
+    whole budget runs on its own.
+
+    Right before a task would start its fingerprint is taken over its inputs,
+    which by then include whatever its upstream tasks wrote. When it matches
+    the fingerprint of the last successful build and the outputs are still
+    there the task is skipped.
+
+    Args:
+        tasks (list[Task]): the whole graph
+        targets (list[str] | None): tasks to build with their upstreams, all when None
+        workers (int | None): max concurrent tasks, defaults to the CPU count
+        memory_gb (float | None): memory budget, defaults to 80% of physical memory
+        salt (str): run wide settings the outputs depend on, e.g. the formats
+        force (bool): rebuild everything, ignoring the fingerprints
+        initializer (Callable | None): called with `initargs` in every task
+            process before the task, e.g. to configure the writers
+        initargs (tuple): arguments of `initializer`
+
+    Returns:
+        list[TaskResult]: one result per selected task, in completion order
+    """
+    selected = select_tasks(tasks, targets)
+    workers = workers or os.cpu_count() or 1
+    budget = memory_gb or total_memory_gb() * DEFAULT_MEMORY_FRACTION
+    console.log(
+        f"Running {len(selected)} tasks on {workers} workers "
+        f"within {budget:.1f} GB: {list(selected)}"
+    )
+
+    ctx = mp.get_context("spawn")
+    pending = dict(selected)
+    done: set[str] = set()
+    failed: set[str] = set()
+    # sentinel -> (task, process, receiving end of its pipe)
+    running: dict[int, tuple[Task, mp.Process, object]] = {}
+    results: list[TaskResult] = []
+    # fingerprints of the running tasks, saved once they succeed
+    fingerprints: dict[str, str] = {}
+    previous = load_fingerprints()
+    start = time.perf_counter()
+
+    while pending or running:
+        # anything downstream of a failure can never run
+        for name, task in list(pending.items()):
+            if any(dep in failed for dep in task.deps):
+                console.log(f"[red]Skipping {name}, an upstream task failed")
+                results.append(TaskResult(name, 0.0, 0.0, "upstream task failed"))
+                failed.add(name)
+                del pending[name]
+
+        in_use = sum(task.memory_gb for task, _, _ in running.values())
+        for name, task in list(pending.items()):
+            if len(running) >= workers:
+                break
+            if not all(dep in done for dep in task.deps):
+                continue
+            if task.name not in fingerprints:
+                fingerprints[task.name] = fingerprint(
+                    task.inputs, [task.func] + task.code, salt
+                )
+                if (
+                    not force
+                    and previous.get(task.name) == fingerprints[task.name]
+                    and outputs_exist(task)
+                ):
+                    console.log(f"[green]{name} is up to date, skipping")
+                    results.append(TaskResult(name, 0.0, 0.0, cached=True))
+                    done.add(name)
+                    del pending[name]
+                    continue
+            if running and in_use + task.memory_gb > budget:
+                continue
+            recv, send = ctx.Pipe(duplex=False)
+            process = ctx.Process(
+                target=_run_task,
+                args=(task, send, initializer, initargs),
+                name=name,
+            )
+            process.start()
+            send.close()
+            running[process.sentinel] = (task, process, recv)
+            in_use += task.memory_gb
+            del pending[name]
+            console.log(f"[yellow]Started {name} ({task.memory_gb:.1f} GB)")
+
+        if not running:
+            # skipped tasks may have unblocked others
+            if pending and any(
+                all(dep in done for dep in task.deps) for task in pending.values()
+            ):
+                continue
+            break
+
+        for sentinel in wait(list(running)):
+            task, process, recv = running.pop(sentinel)
+            exitcode, peak_rss_mb = reap(process)
+            try:
+                result = recv.recv()
+                # otherwise the peak the task measured on itself is kept
+                if peak_rss_mb is not None:
+                    result = dataclasses.replace(result, peak_rss_mb=peak_rss_mb)
+            except EOFError:
+                # the process died before it could report back
+                result = TaskResult(
+                    task.name,
+                    0.0,
+                    peak_rss_mb or 0.0,
+                    f"exited with code {exitcode}",
+                )
+            recv.close()
+            results.append(result)
+            if result.error is None:
+                done.add(task.name)
+                save_fingerprint(task.name, fingerprints[task.name])
+                console.log(
+                    f"[green]Finished {task.name} in {result.seconds:.1f}s, "
+                    f"peak RSS {result.peak_rss_mb:,.0f} MB"
+                )
+            else:
+                failed.add(task.name)
+                console.log(f"[red]{task.name} failed:\n{result.error}")
+
+    console.log(
+        f"Ran {len(selected)} tasks in {time.perf_counter() - start:.1f}s, "
+        f"{len(done)} succeeded ({sum(r.cached for r in results)} up to date), "
+        f"{len(failed)} failed or skipped"
+    )
+    return results
@@ -0,0 +1,151 @@
+import argparse
+import heapq
+import json
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute
+import pyarrow.ipc
+from rich.console import Console
+from tqdm import tqdm
+
+from note_texts import NOTE_TEXTS_FILE
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+NOTE_SHARDS_DIR = Path().cwd().parent / "data" / "note_shards"
+MANIFEST_FILE = "manifest.json"
+
+
+def text_lengths(reader: pa.ipc.RecordBatchFileReader) -> list[int]:
+    """Characters of every text of the store, in store order, 0 for nulls."""
+    lengths: list[int] = []
+    for i in range(reader.num_record_batches):
+        column = reader.get_batch(i).column("NOTE_TEXT")
+        lengths.extend(pa.compute.utf8_length(column).fill_null(0).to_pylist())
+    return lengths
+
+
+def balance_shards(lengths: list[int], shards: int) -> list[int]:
+    """Assign every text to a shard so all shards hold about as many characters.
+
+    Texts go to the lightest shard longest first, which keeps a few huge notes
+    from piling up in one shard no matter how skewed the lengths are.
+
+    Args:
+        lengths (list[int]): characters per text
+        shards (int): number of shards
+
+    Returns:
+        list[int]: shard of every text
+    """
+    assignment = [0] * len(lengths)
+    loads = [(0, shard) for shard in range(shards)]
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__, reverse=True):
+        load, shard = heapq.heappop(loads)
+        assignment[i] = shard
+        heapq.heappush(loads, (load + lengths[i], shard))
+    return assignment
+
+
+def shard_notes(shards: int, out_dir: Path, path: Path = NOTE_TEXTS_FILE) -> dict:
+    """Split the note store into `shards` IPC files balanced by character count.
+
+    Every shard has the columns of the store and keeps its order, so any NLP
+    script that reads the store reads a shard. The manifest lists the shards
+    with their texts and characters.
+
+    Args:
+        shards (int): number of shards
+        out_dir (Path): directory of the shards and their manifest
+        path (Path): the note text store
+
+    Returns:
+        dict: the manifest
+    """
+    if shards < 1:
+        raise ValueError(f"Need at least one shard, got {shards}")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        lengths = text_lengths(reader)
+        shard_of = balance_shards(lengths, shards)
+        assignment = np.asarray(shard_of, dtype=np.int32)
+
+        files = [out_dir / f"shard-{shard:05d}.feather" for shard in range(shards)]
+        # uncompressed like the store, so workers can map their shard
+        writers = [pa.ipc.new_file(str(file), reader.schema) for file in files]
+        texts = [0] * shards
+        characters = [0] * shards
+        offset = 0
+        for i in tqdm(range(reader.num_record_batches), desc="Sharding notes"):
+            batch = reader.get_batch(i)
+            batch_shards = assignment[offset : offset + batch.num_rows]
+            # one stable sort groups the rows by shard in store order, every
+            # shard is then a slice of the batch instead of a filter over it
+            order = np.argsort(batch_shards, kind="stable")
+            bounds = np.searchsorted(batch_shards[order], np.arange(shards + 1))
+            grouped = batch.take(pa.array(order))
+            for shard in range(shards):
+                start, end = int(bounds[shard]), int(bounds[shard + 1])
+                if start == end:
+                    continue
+                writers[shard].write_batch(grouped.slice(start, end - start))
+                texts[shard] += end - start
+            offset += batch.num_rows
+        for writer in writers:
+            writer.close()
+    for shard, length in zip(shard_of, lengths):
+        characters[shard] += length
+
+    manifest = {
+        "source": str(path),
+        "total_texts": len(lengths),
+        "total_characters": sum(lengths),
+        "shards": [
+            {
+                "shard": shard,
+                "file": files[shard].name,
+                "texts": texts[shard],
+                "characters": characters[shard],
+            }
+            for shard in range(shards)
+        ],
+    }
+    with open(out_dir / MANIFEST_FILE, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="shard_notes.py",
+        description="Splits the note store into shards balanced by character count.",
+    )
+    parser.add_argument(
+        "--shards",
+        "-n",
+        type=int,
+        required=True,
+        help="Number of shards, e.g. one per NLP worker or node.",
+    )
+    parser.add_argument(
+        "--out",
+        type=Path,
+        default=NOTE_SHARDS_DIR,
+        help="Directory to write the shards and their manifest to.",
+    )
+    args = parser.parse_args()
+    manifest = shard_notes(args.shards, args.out)
+    sizes = [shard["characters"] for shard in manifest["shards"]]
+    console.log(
+        f"[green]Wrote {args.shards} shards of {min(sizes):,} to {max(sizes):,} "
+        f"characters to {args.out}"
+    )
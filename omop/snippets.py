@@ -0,0 +1,98 @@
+import numpy as np
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute
+
+# max characters of note text kept around a mention in `note_nlp.snippet`
+SNIPPET_WINDOW = 250
+
+
+def _windows(
+    starts: np.ndarray, ends: np.ndarray, text_lengths: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Center a `SNIPPET_WINDOW` wide window on every mention, clipped to its text."""
+    pad = np.maximum(SNIPPET_WINDOW - (ends - starts), 0) // 2
+    lo = np.clip(starts - pad, 0, text_lengths)
+    hi = np.clip(np.minimum(ends + pad, lo + SNIPPET_WINDOW), lo, text_lengths)
+    return lo, hi
+
+
+def extract_snippets(
+    texts: pa.Array, rows: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> pl.Series:
+    """Cut the text around each mention straight out of the Arrow buffers.
+
+    `texts` is usually a column of a memory mapped record batch, mentions point
+    into it by row. For ASCII notes character offsets are byte offsets, so all
+    of their snippets are gathered from the data buffer in one numpy operation
+    without materializing a single Python string. The few notes holding other
+    characters are sliced in Python.
+
+    Args:
+        texts (pa.Array): note texts
+        rows (np.ndarray): row in `texts` of every mention
+        starts (np.ndarray): character offset where every mention starts
+        ends (np.ndarray): character offset where every mention ends
+
+    Returns:
+        pl.Series: one snippet per mention, null when its row has no text
+    """
+    texts = pa.compute.cast(texts, pa.large_string())
+    if isinstance(texts, pa.ChunkedArray):
+        texts = texts.combine_chunks()
+    rows = rows.astype(np.int64)
+    starts = starts.astype(np.int64)
+    ends = ends.astype(np.int64)
+
+    offsets = np.frombuffer(texts.buffers()[1], dtype=np.int64)[
+        texts.offset : texts.offset + len(texts) + 1
+    ]
+    data = (
+        np.frombuffer(texts.buffers()[2], dtype=np.uint8)
+        if texts.buffers()[2] is not None
+        else np.empty(0, dtype=np.uint8)
+    )
+    # non ASCII bytes per text from a running count over the data buffer
+    high = np.concatenate([[0], np.cumsum(data[offsets[0] : offsets[-1]] >= 0x80)])
+    non_ascii = (high[offsets[1:] - offsets[0]] - high[offsets[:-1] - offsets[0]]) > 0
+
+    byte_lengths = np.diff(offsets)
+    lo, hi = _windows(starts, ends, byte_lengths[rows])
+    # leave the other notes for the python pass below
+    fast = ~non_ascii[rows]
+    lengths = np.where(fast, hi - lo, 0)
+    out_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    begin = offsets[rows] + lo
+    gather = np.repeat(begin - out_offsets[:-1], lengths) + np.arange(
+        out_offsets[-1], dtype=np.int64
+    )
+    snippets = pl.from_arrow(
+        pa.LargeStringArray.from_buffers(
+            len(rows), pa.py_buffer(out_offsets), pa.py_buffer(data[gather])
+        )
+    )
+
+    slow = np.flatnonzero(~fast)
+    if len(slow) > 0:
+        cache: dict[int, str] = {}
+        values = []
+        for i in slow:
+            row = int(rows[i])
+            if row not in cache:
+                cache[row] = texts[row].as_py() or ""
+            text = cache[row]
+            s, e = _windows(starts[i : i + 1], ends[i : i + 1], np.array([len(text)]))
+            values.append(text[s[0] : e[0]])
+        snippets = snippets.set_at_idx(slow, values)
+
+    valid = np.asarray(texts.is_valid())[rows]
+    return (
+        pl.DataFrame({"snippet": snippets, "valid": valid})
+        .select(
+            pl.when(pl.col("valid"))
+            .then(pl.col("snippet"))
+            .otherwise(None)
+            .alias("snippet")
+        )
+        .to_series()
+    )
@@ -0,0 +1,114 @@
+import sqlite3
+from datetime import date, datetime
+
+import polars as pl
+import pytest
+
+import load_omop_db
+from cdm_schema import conform
+from writers import write_table
+
+TABLES = ["person", "note_nlp"]
+
+
+@pytest.fixture
+def cdm_dir(tmp_path, monkeypatch):
+    """Write a two table CDM fixture in one format and point the loader at it."""
+
+    def write(fmt: str):
+        out = tmp_path / "omop_tables"
+        out.mkdir()
+        person = pl.DataFrame(
+            {
+                "person_id": [1, 2],
+                "gender_concept_id": [8507, 8532],
+                "year_of_birth": [1980, 1990],
+                "birth_datetime": [datetime(1980, 1, 2, 3, 4), datetime(1990, 5, 6)],
+                # would be guessed as integers from a CSV
+                "person_source_value": ["007", "010"],
+                "gender_source_value": ["M", "F"],
+            }
+        ).pipe(conform, "person")
+        note_nlp = pl.DataFrame(
+            {
+                "note_nlp_id": [1, 2],
+                "note_id": [10, 10],
+                "snippet": ["no cocaine use", "denies heroin"],
+                # `offset` is a reserved word in both engines
+                "offset": [3, 7],
+                "lexical_variant": ["cocaine", "heroin"],
+                "note_nlp_concept_id": [1, 2],
+                "nlp_date": [date(2023, 1, 1)] * 2,
+                "nlp_datetime": [datetime(2023, 1, 1, 12)] * 2,
+                "term_exists": ["N", "N"],
+            }
+        ).pipe(conform, "note_nlp")
+        write_table(person, out / "Person", formats=[fmt])
+        write_table(note_nlp, out / "Note_NLP", formats=[fmt])
+        monkeypatch.setattr(load_omop_db, "DEST_DIR", out)
+        return out
+
+    return write
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet", "ipc"])
+def test_load_sqlite(cdm_dir, tmp_path, fmt):
+    cdm_dir(fmt)
+    db = tmp_path / "omop.db"
+    load_omop_db.run(db, "sqlite", TABLES, workers=2)
+
+    con = sqlite3.connect(db)
+    assert con.execute(
+        "SELECT person_id, year_of_birth, person_source_value FROM person "
+        "ORDER BY person_id"
+    ).fetchall() == [(1, 1980, "007"), (2, 1990, "010")]
+    assert con.execute(
+        'SELECT lexical_variant FROM note_nlp ORDER BY "offset"'
+    ).fetchall() == [("cocaine",), ("heroin",)]
+    indexes = {
+        name
+        for (name,) in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    }
+    assert {"pk_person", "pk_note_nlp", "idx_note_nlp_note_id"} <= indexes
+    con.close()
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet", "ipc"])
+def test_load_duckdb(cdm_dir, tmp_path, fmt):
+    duckdb = pytest.importorskip("duckdb")
+    cdm_dir(fmt)
+    db = tmp_path / "omop.duckdb"
+    load_omop_db.run(db, "duckdb", TABLES, workers=2)
+
+    con = duckdb.connect(str(db))
+    assert con.execute(
+        "SELECT person_id, year_of_birth, person_source_value FROM person "
+        "ORDER BY person_id"
+    ).fetchall() == [(1, 1980, "007"), (2, 1990, "010")]
+    assert con.execute(
+        'SELECT lexical_variant FROM note_nlp ORDER BY "offset"'
+    ).fetchall() == [("cocaine",), ("heroin",)]
+    assert con.execute(
+        "SELECT data_type FROM information_schema.columns "
+        "WHERE table_name = 'person' AND column_name = 'birth_datetime'"
+    ).fetchone() == ("TIMESTAMP",)
+    con.close()
+
+
+def test_missing_tables_are_skipped(cdm_dir, tmp_path):
+    out = cdm_dir("csv")
+    (out / "Person.csv").unlink()
+    db = tmp_path / "omop.db"
+    load_omop_db.run(db, "sqlite", TABLES, workers=1)
+
+    con = sqlite3.connect(db)
+    tables = {
+        name
+        for (name,) in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    assert tables == {"note_nlp"}
+    con.close()
@@ -0,0 +1,251 @@
+import shutil
+from pathlib import Path
+from typing import Callable
+
+import polars as pl
+import pyarrow as pa
+import pyarrow.ipc
+import pyarrow.parquet as pq
+from rich.console import Console
+
+console = Console(
+    color_system="truecolor",
+    force_terminal=True,
+    force_jupyter=False,
+    markup=True,
+    emoji=True,
+)
+
+# formats written by `write_table` when none are passed, set per run with `configure`
+OUTPUT_FORMATS: list[str] = ["csv"]
+PARQUET_ROW_GROUP_SIZE = 512_000
+
+
+def _write_csv(df: pl.DataFrame, path: Path):
+    df.write_csv(path)
+
+
+def _write_parquet(df: pl.DataFrame, path: Path):
+    df.write_parquet(
+        path, compression="zstd", row_group_size=PARQUET_ROW_GROUP_SIZE
+    )
+
+
+def _write_ipc(df: pl.DataFrame, path: Path):
+    df.write_ipc(path, compression="lz4")
+
+
+# format -> (file suffix, writer)
+WRITERS: dict[str, tuple[str, Callable[[pl.DataFrame, Path], None]]] = {
+    "csv": (".csv", _write_csv),
+    "parquet": (".parquet", _write_parquet),
+    "ipc": (".feather", _write_ipc),
+}
+
+
+def configure(formats: list[str], row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+    """Set the output formats and Parquet row group size for this run.
+
+    Args:
+        formats (list[str]): any of the keys of `WRITERS`
+        row_group_size (int): rows per Parquet row group
+    """
+    global OUTPUT_FORMATS, PARQUET_ROW_GROUP_SIZE
+    unknown = [f for f in formats if f not in WRITERS]
+    if unknown:
+        raise ValueError(f"Unknown output formats: {unknown}")
+    OUTPUT_FORMATS = list(formats)
+    PARQUET_ROW_GROUP_SIZE = row_group_size
+
+
+def write_table(df: pl.DataFrame, path: Path, formats: list[str] | None = None):
+    """Write a collected table in every requested format.
+
+    The frame is written natively by polars, once per format, without another
+    materialization.
+
+    Args:
+        df (pl.DataFrame): the table to write
+        path (Path): output path without suffix, e.g. `DEST_DIR / "Person"`
+        formats (list[str] | None): formats to write, defaults to `OUTPUT_FORMATS`
+    """
+    for fmt in formats or OUTPUT_FORMATS:
+        if fmt not in WRITERS:
+            raise ValueError(f"Unknown output format: {fmt}")
+        suffix, writer = WRITERS[fmt]
+        out_path = path.with_suffix(suffix)
+        writer(df, out_path)
+        console.log(f"Wrote {len(df):,} rows to {out_path.name}")
+
+
+def find_output(path: Path) -> Path | None:
+    """Find a written table, preferring the columnar formats.
+
+    Args:
+        path (Path): output path without suffix, e.g. `DEST_DIR / "Person"`
+
+    Returns:
+        Path | None: the first of the Parquet, IPC or CSV files that exists
+    """
+    for fmt in ["parquet", "ipc", "csv"]:
+        candidate = path.with_suffix(WRITERS[fmt][0])
+        if candidate.exists():
+            return candidate
+    return None
+
+
+class StreamingTableWriter:
+    """Append a table batch by batch to every requested format.
+
+    Memory stays proportional to one batch. CSV gets its header once and
+    polars quotes multi-line text, Parquet gets one or more row groups per
+    batch and IPC one record batch per batch. Categoricals are written as
+    plain strings since every batch carries its own dictionary. When no batch
+    was written an empty table with `schema` is, so the output still exists for
+    the loaders and checks downstream.
+
+    Args:
+        path (Path): output path without suffix, e.g. `DEST_DIR / "Note"`
+        formats (list[str] | None): formats to write, defaults to `OUTPUT_FORMATS`
+        schema (dict | None): schema of the table, e.g. `CDM_SCHEMAS["note"]`
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        formats: list[str] | None = None,
+        schema: dict | None = None,
+    ):
+        self.path = path
+        self.formats = list(formats or OUTPUT_FORMATS)
+        self.schema = schema
+        unknown = [f for f in self.formats if f not in WRITERS]
+        if unknown:
+            raise ValueError(f"Unknown output formats: {unknown}")
+        self.rows = 0
+        self._opened = False
+        self._csv = None
+        self._parquet = None
+        self._ipc = None
+        self._ipc_sink = None
+
+    def __enter__(self) -> "StreamingTableWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open(self, schema: pa.Schema):
+        if "csv" in self.formats:
+            self._csv = open(self.path.with_suffix(WRITERS["csv"][0]), "wb")
+        if "parquet" in self.formats:
+            self._parquet = pq.ParquetWriter(
+                self.path.with_suffix(WRITERS["parquet"][0]),
+                schema,
+                compression="zstd",
+            )
+        if "ipc" in self.formats:
+            self._ipc_sink = pa.OSFile(
+                str(self.path.with_suffix(WRITERS["ipc"][0])), "wb"
+            )
+            self._ipc = pa.ipc.new_file(
+                self._ipc_sink,
+                schema,
+                options=pa.ipc.IpcWriteOptions(compression="lz4"),
+            )
+
+    def write(self, df: pl.DataFrame):
+        """Append one batch, all batches must share the same schema."""
+        df = df.with_columns([pl.col(pl.Categorical).cast(pl.Utf8)])
+        arrow = df.to_arrow()
+        first = not self._opened
+        if first:
+            self._open(arrow.schema)
+            self._opened = True
+        if self._csv is not None:
+            df.write_csv(self._csv, has_header=first)
+        if self._parquet is not None:
+            self._parquet.write_table(arrow, row_group_size=PARQUET_ROW_GROUP_SIZE)
+        if self._ipc is not None:
+            self._ipc.write_table(arrow)
+        self.rows += len(df)
+
+    def close(self):
+        if not self._opened:
+            if self.schema is None:
+                console.log(f"[yellow]No rows to write to {self.path.name}")
+                return
+            self.write(pl.DataFrame(schema=self.schema))
+        for sink in [self._csv, self._parquet, self._ipc, self._ipc_sink]:
+            if sink is not None:
+                sink.close()
+        self._csv = self._parquet = self._ipc = self._ipc_sink = None
+        for fmt in self.formats:
+            console.log(
+                f"Wrote {self.rows:,} rows to "
+                f"{self.path.with_suffix(WRITERS[fmt][0]).name}"
+            )
+
+
+def concat_outputs(parts: list[Path], path: Path, formats: list[str] | None = None):
+    """Stream tables written in parts into one table, in the order of `parts`.
+
+    Used to merge shards written in parallel, one batch or row group is in
+    memory at a time and the parts are deleted afterwards. Parts without
+    output, e.g. empty shards, are skipped.
+
+    Args:
+        parts (list[Path]): output paths of the parts without suffix
+        path (Path): output path of the merged table without suffix
+        formats (list[str] | None): formats to merge, defaults to `OUTPUT_FORMATS`
+    """
+    for fmt in formats or OUTPUT_FORMATS:
+        suffix = WRITERS[fmt][0]
+        files = [
+            part.with_suffix(suffix)
+            for part in parts
+            if part.with_suffix(suffix).exists()
+        ]
+        out_path = path.with_suffix(suffix)
+        if fmt == "csv":
+            with open(out_path, "wb") as out:
+                for i, file in enumerate(files):
+                    with open(file, "rb") as src:
+                        # only the first part keeps its header
+                        if i > 0:
+                            src.readline()
+                        shutil.copyfileobj(src, out)
+        elif fmt == "parquet":
+            writer = None
+            for file in files:
+                parquet = pq.ParquetFile(file)
+                for group in range(parquet.num_row_groups):
+                    table = parquet.read_row_group(group)
+                    if writer is None:
+                        writer = pq.ParquetWriter(
+                            out_path, table.schema, compression="zstd"
+                        )
+                    writer.write_table(table)
+            if writer is not None:
+                writer.close()
+        else:
+            writer = None
+            sink = pa.OSFile(str(out_path), "wb")
+            for file in files:
+                with pa.memory_map(str(file)) as source:
+                    reader = pa.ipc.open_file(source)
+                    for i in range(reader.num_record_batches):
+                        batch = reader.get_batch(i)
+                        if writer is None:
+                            writer = pa.ipc.new_file(
+                                sink,
+                                batch.schema,
+                                options=pa.ipc.IpcWriteOptions(compression="lz4"),
+                            )
+                        writer.write_batch(batch)
+            if writer is not None:
+                writer.close()
+            sink.close()
+        for file in files:
+            file.unlink()
+        console.log(f"Merged {len(files)} parts into {out_path.name}")
@@ -5,6 +5,7 @@ import json
 import multiprocessing
 import pickle
 import subprocess
+import sys
 from pathlib import Path
 import time
 from typing import Any, Iterator
@@ -43,9 +44,25 @@ from tqdm import tqdm
 from negspacy.negation import Negex
 from spacy.lang.en import English
 
+# the note store helpers live with the pipeline in `omop/`
+sys.path.append(str(Path(__file__).resolve().parent.parent / "omop"))
+from note_texts import NOTE_TEXTS_FILE, NoteTextStore
+
 
 c = Console()
 
+parser = argparse.ArgumentParser(
+    prog="med7",
+    description="Runs Med7 on the text in the note text store.",
+)
+parser.add_argument(
+    "--file",
+    "-f",
+    type=str,
+    default=str(NOTE_TEXTS_FILE),
+    help="The note text store to run on. Must be a feather file.",
+)
+args = parser.parse_args()
 
 c.log("Initializing models...")
 
@@ -57,43 +74,30 @@ nlp.add_pipe("negex")
 
 c.log("Done initializing models.")
 
+
+def sentence_data(store: NoteTextStore) -> Iterator[tuple[str, dict]]:
+    """(sentence, context) of every text of the store, tokenized as they are read."""
+    for text, text_hash in tqdm(
+        store.iter_texts(), total=store.num_texts, desc="Processing notes with Med7..."
+    ):
+        for i, sent in enumerate(sent_tokenize(text)):
+            yield sent, {"text_hash": text_hash, "sent_num": i}
+
+
 c.log("Loading notes")
-# read notes making sure no NA
-notes = pl.scan_ipc("../data/notes.feather", memory_map=False).drop_nulls()
-document_data = [
-    (
-        row[1],  # note
-        {"row_num": row[0]},  # context
-    )
-    for row in tqdm(
-        notes.select(["note_id", "NOTE_TEXT"]).fetch(500_000).to_numpy(),
-        desc="Making tuples...",
-    )
-]
-del notes
-c.log("Done loading notes.")
-
-sentence_data = []
-for note, context in tqdm(document_data, desc="Sentencizing..."):
-    for i, sent in enumerate(sent_tokenize(note)):
-        context["sent_num"] = i
-        sentence_data.append((sent, context))
-
-
-del document_data
-
-with open("med7_output.jsonl", "wb") as f:
-    for doc, context in tqdm(
-        nlp.pipe(sentence_data, as_tuples=True, batch_size=1_000, n_process=-1),
-        desc="Processing notes with Med7...",
-        total=len(sentence_data),
+# every distinct note text once, memory mapped instead of read into memory
+with NoteTextStore(Path(args.file)) as store, open("med7_output.jsonl", "wb") as f:
+    c.log("Done loading notes.")
+    # sentences are streamed into the pipeline, none are held in memory
+    for doc, context in nlp.pipe(
+        sentence_data(store), as_tuples=True, batch_size=1_000, n_process=-1
     ):
         if any(x in doc.text for x in {"meth", "cocaine", "heroin", "alcohol"}):
             print(doc.text)
         for i, ent in enumerate(doc.ents):
             print(i, "---", ent.text)
             data = {
-                "row_num": context["row_num"],
+                "text_hash": context["text_hash"],
                 "sent_num": context["sent_num"],
                 "entity": ent.text.strip(),
                 "label": ent.label_,
@@ -10,6 +10,8 @@ from rich.progress import track
 
 # dataframes
 import polars as pl
+import pyarrow as pa
+import pyarrow.ipc
 
 # spacy libraries
 import spacy
@@ -40,9 +42,6 @@ TOTAL = 0
 FILE_BATCH_SIZE = 50_000  # number of NLP results to write to file
 DT = datetime.datetime.now().isoformat()
 
-if not Doc.has_extension("row_id"):
-    Doc.set_extension("row_id", default=None)
-
 
 def setup_paths():
     """Sets up the output paths for the script."""
@@ -88,10 +87,12 @@ def setup() -> tuple[Language, EntityLinker]:
 
 def load_data(
     fpath: Path, text_col: str, id_col: str
-) -> list[tuple[str, dict[str, str]]]:
+) -> Iterator[tuple[str, dict[str, str]]]:
     """Loads the data from file provided.
 
-    EXPECTS FEATHER FILE path
+    EXPECTS FEATHER FILE path, the file is memory mapped and read one record
+    batch at a time, so processes share the OS page cache instead of each
+    holding every text.
 
     Args:
         fpath (Path): Path to the file.
@@ -102,51 +103,73 @@ def load_data(
         Context data, text records with row_num as additional context
     """
     logger.log("[cyan]Loading data and applying context...")
-    data = (
-        pl.scan_ipc(fpath)
-        .select([text_col, id_col])
-        .drop_nulls()
-        # remove some extra whitespace around the whole note
-        .with_columns([pl.col(text_col).str.strip()])
-        # .collect()
-        .fetch(1_000_000)
-        .to_numpy()
-    )
-    context_data: list[tuple[str, dict[str, str]]] = []
-    for row in data:
-        # (text, context_dict)
-        context_data.append((row[0], {"row_id": row[1]}))
+    reader = pa.ipc.open_file(pa.memory_map(str(fpath)))
     # global trickery
     global TOTAL
-    TOTAL = len(context_data)
-    return context_data
-
-
-def call_nlp(nlp: Language, text_tuples: list[tuple[str, dict[str, str]]]) -> list[Doc]:
+    TOTAL = 0
+    for i in range(reader.num_record_batches):
+        column = reader.get_batch(i).column(text_col)
+        TOTAL += len(column) - column.null_count
+
+    def context_data() -> Iterator[tuple[str, dict[str, str]]]:
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for text, id_ in zip(
+                batch.column(text_col).to_pylist(), batch.column(id_col).to_pylist()
+            ):
+                if text is None or id_ is None:
+                    continue
+                # (text, context_dict)
+                # remove some extra whitespace around the whole note
+                yield text.strip(), {"row_id": id_}
+
+    return context_data()
+
+
+def call_nlp(
+    nlp: Language, text_tuples: Iterator[tuple[str, dict[str, str]]]
+) -> Iterator[tuple[Doc, dict[str, str]]]:
     """Calls the NLP pipeline on the data.
 
     Args:
         nlp (Language): The spacy language object.
-        text_tuples (list[tuple[str, dict[str, str]]]): Context data, text records with row_num as additional context
+        text_tuples (Iterator[tuple[str, dict[str, str]]]): Context data, text records with row_num as additional context
 
     Returns:
-        Iterator of tuples containing the row number and the processed text.
+        Iterator of tuples containing the processed text and its context, docs
+        are produced as they are consumed.
     """
     # configurable batch size using GLOBAL
     # configurable processes using GLOBAL
     logger.log("[cyan]Calling NLP pipeline...")
-    doc_tuples = nlp.pipe(
+    return nlp.pipe(
         texts=text_tuples,
         batch_size=BATCH_SIZE,
         n_process=N_PROCESSES,
         as_tuples=True,
         disable=["tagger", "lemmatizer", "textcat"],
     )
-    docs: list[Doc] = []
-    for doc, context in doc_tuples:
-        doc._.row_id = context["row_id"]
-        docs.append(doc)
-    return docs
+
+
+def doc_results(
+    doc: Doc, row_id: str, lookup: dict[str, Entity]
+) -> list[dict[str, str | bool | float]]:
+    """Flat result rows of one processed document."""
+    output: list[dict[str, str | bool | float]] = []
+    for ent in doc.ents:
+        for kb_ent in ent._.kb_ents:
+            concept = lookup[kb_ent[0]]
+            results: dict[str, str | bool | float] = {
+                "row_id": row_id,
+                "cui": concept.concept_id.strip(),
+                "name": concept.canonical_name.strip(),
+                "entity": ent.text.strip(),
+                "negated": ent._.negex,
+                "score": kb_ent[1],
+                "nlp_datetime": DT,
+            }
+            output.append(results)
+    return output
 
 
 def save_output(data: list[dict[str, str | bool | float]], batch: int):
@@ -161,32 +184,27 @@ def save_output(data: list[dict[str, str | bool | float]], batch: int):
     logger.log(f"[green]Saved batch: {batch} with {len(data)} results.")
 
 
-def process_results(docs: list[Doc], lookup: dict[str, Entity]) -> None:
+def process_results(
+    doc_tuples: Iterator[tuple[Doc, dict[str, str]]], lookup: dict[str, Entity]
+) -> None:
+    """Turns every document into result rows as it comes off the pipeline.
+
+    Docs are dropped as soon as their rows are taken, and rows are written every
+    `FILE_BATCH_SIZE` of them, so memory stays flat whatever the corpus size.
+    """
     # use dynamically set global here for total to help with ETA
     output: list[dict[str, str | bool | float]] = []
     batch = 1
-    for i, doc in tqdm(enumerate(docs), total=TOTAL, desc="Processing documents..."):
-        if i % FILE_BATCH_SIZE == 0 and i != 0:
-            batch += 1
+    for doc, context in tqdm(doc_tuples, total=TOTAL, desc="Processing documents..."):
+        output.extend(doc_results(doc, context["row_id"], lookup))
+        if len(output) >= FILE_BATCH_SIZE:
             # compress and save the results
             save_output(data=output, batch=batch)
             # then clear output
-            output.clear()
-        # process the results
-        for ent in doc.ents:
-            for kb_ent in ent._.kb_ents:
-                concept = lookup[kb_ent[0]]
-                results: dict[str, str | bool | float] = {
-                    "row_id": doc._.row_id,
-                    "cui": concept.concept_id.strip(),
-                    "name": concept.canonical_name.strip(),
-                    "entity": ent.text.strip(),
-                    "negated": ent._.negex,
-                    "score": kb_ent[1],
-                    "nlp_datetime": DT,
-                }
-                output.append(results)
-    save_output(data=output, batch=batch)
+            output = []
+            batch += 1
+    if output:
+        save_output(data=output, batch=batch)
 
 
 def run(fpath: str, text_col: str, id_col: str) -> None:
@@ -203,8 +221,8 @@ def run(fpath: str, text_col: str, id_col: str) -> None:
     # get the lookup table
     lookup = linker.kb.cui_to_entity
 
-    docs_list = call_nlp(nlp=nlp, text_tuples=text_tuples)
-    process_results(docs=docs_list, lookup=lookup)
+    doc_tuples = call_nlp(nlp=nlp, text_tuples=text_tuples)
+    process_results(doc_tuples=doc_tuples, lookup=lookup)
 
 
 if __name__ == "__main__":
@@ -236,7 +254,7 @@ if __name__ == "__main__":
     args = parser.parse_args()
     run(fpath=args.file, text_col=args.text_col, id_col=args.id_col)
     # run(
-    #     fpath="../data/notes.feather",
+    #     fpath="../data/note_texts.feather",
     #     text_col="NOTE_TEXT",
-    #     id_col="note_id",
+    #     id_col="TEXT_HASH",
     # )
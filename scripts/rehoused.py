@@ -1,3 +1,7 @@
+import argparse
+import sys
+from pathlib import Path
+
 from rehoused_nlp import calculate_rehoused
 import pandas as pd
 from tqdm import tqdm
@@ -5,43 +9,59 @@ from rehoused_nlp import build_nlp
 
 import warnings
 
+# the note store helpers live with the pipeline in `omop/`
+sys.path.append(str(Path(__file__).resolve().parent.parent / "omop"))
+from note_texts import NOTE_TEXTS_FILE, NoteTextStore
+
 warnings.filterwarnings("ignore")
 
+parser = argparse.ArgumentParser(
+    prog="rehoused",
+    description="Classifies the text in the note text store with ReHouSED.",
+)
+parser.add_argument(
+    "--file",
+    "-f",
+    type=str,
+    default=str(NOTE_TEXTS_FILE),
+    help="The note text store to run on. Must be a feather file.",
+)
+args = parser.parse_args()
+
 nlp = build_nlp()
 
-df = (
-    pd.read_feather("../data/notes.feather")
-    .drop(
-        columns=[
-            "DATA_SOURCE",
-            "EPIC_LINES",
-            "IS_XML",
-            "NOTE_SOURCE",
-            "NOTE_TYPE",
-            "SPECIALTY",
-            "XML_DATA",
-        ]
-    )
-    .dropna(subset="NOTE_TEXT")
-    # .sample(100_000, random_state=42)
+df = pd.read_feather("../data/notes.feather").drop(
+    columns=[
+        "DATA_SOURCE",
+        "EPIC_LINES",
+        "IS_XML",
+        "NOTE_SOURCE",
+        "NOTE_TYPE",
+        "SPECIALTY",
+        "XML_DATA",
+    ]
 )
+# .sample(100_000, random_state=42)
 print("Input:")
 print(df.head())
 
 
-docs = list(
-    nlp.pipe(
-        tqdm(df["NOTE_TEXT"], desc="NLP"),
+# every distinct text is classified once and joined back to its notes, only
+# the classification of a doc is kept, never the doc itself
+hashes, classifications = [], []
+with NoteTextStore(Path(args.file)) as store:
+    for doc, text_hash in nlp.pipe(
+        tqdm(store.iter_texts(), total=store.num_texts, desc="NLP"),
+        as_tuples=True,
         # batch_size=1_000_000,
         batch_size=1_000,
         # n_process=4,
-    )
-)
+    ):
+        hashes.append(text_hash)
+        classifications.append(doc._.document_classification)
 
-df["docs"] = docs
-df["document_classification"] = [
-    doc._.document_classification for doc in tqdm(docs, desc="loop")
-]
+texts = pd.DataFrame({"TEXT_HASH": hashes, "document_classification": classifications})
+df = df.merge(texts, on="TEXT_HASH")
 
 df["days_since_index"] = (
     df.sort_values(by="CREATED_DTM")
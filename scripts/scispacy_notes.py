@@ -1,29 +1,25 @@
 import argparse
 import datetime
-from itertools import zip_longest
-import json
 import multiprocessing
-import subprocess
+import queue
+import sys
+import threading
+import traceback
 from pathlib import Path
 import time
 from typing import Any, Iterator
 
 import pandas as pd
 from rich.console import Console
-from p_tqdm import p_uimap
-from nltk.tokenize import sent_tokenize
-import nltk
 import random
 import orjson
 
-from functools import partial
 from pathlib import Path
 import pandas as pd
 from rich import print
 import spacy
 from scispacy.abbreviation import AbbreviationDetector
 from scispacy.linking import EntityLinker
-from p_tqdm import p_uimap
 from scispacy.candidate_generation import DEFAULT_PATHS, DEFAULT_KNOWLEDGE_BASES
 from scispacy.candidate_generation import CandidateGenerator, LinkerPaths
 from scispacy.linking_utils import KnowledgeBase, Entity as LinkedEntity
@@ -40,35 +36,49 @@ from rich import print
 import polars as pl
 from tqdm import tqdm
 
+# the note store helpers live with the pipeline in `omop/`
+sys.path.append(str(Path(__file__).resolve().parent.parent / "omop"))
+from note_texts import NoteTextStore, batch_texts
 
-print("Downloading `punkt` sentence tokenizer...")
-nltk.download("punkt")
 
 c = Console()
 
 # TODO: add negation
 # https://github.com/jenojp/negspacy
-# TODO: use spacy batching
-# TODO: research spacy speed improvements with nlp.pipe
 
 
-print("Initializing Scispacy...")
-
-nlp = spacy.load("en_core_sci_lg")
-
-# nlp.add_pipe("abbreviation_detector")
-nlp.add_pipe(
-    "scispacy_linker",
-    config={
-        "resolve_abbreviations": True,
-        "max_entities_per_mention": 3,
-        "k": 30,  # default is 30
-        "threshold": 0.9,  # default is 0.7
-        "filter_for_definitions": True,  # this is the big one! limits to only entities with definitions in knowledge base, oh was already true by default
-        "linker_name": "umls",
-    },
-)
-linker = nlp.get_pipe("scispacy_linker")
+# worker processes, each loads the model once and keeps it
+N_WORKERS = 48
+# texts per task handed to a worker
+TASK_SIZE = 1_000
+# docs per `nlp.pipe` batch inside a worker
+PIPE_BATCH_SIZE = 100
+# tasks and results waiting in the queues, keeps the parent from reading ahead
+QUEUE_SIZE = 2 * N_WORKERS
+# result rows per output batch file
+OUTPUT_BATCH_SIZE = 1_000_000
+# seconds to wait on a result before checking that the workers are alive
+RESULT_TIMEOUT = 60
+
+
+def load_model() -> tuple[spacy.language.Language, EntityLinker]:
+    """Loads Scispacy with the UMLS linker."""
+    nlp = spacy.load("en_core_sci_lg")
+
+    # nlp.add_pipe("abbreviation_detector")
+    nlp.add_pipe(
+        "scispacy_linker",
+        config={
+            "resolve_abbreviations": True,
+            "max_entities_per_mention": 3,
+            "k": 30,  # default is 30
+            "threshold": 0.9,  # default is 0.7
+            "filter_for_definitions": True,  # this is the big one! limits to only entities with definitions in knowledge base, oh was already true by default
+            "linker_name": "umls",
+        },
+    )
+    linker = nlp.get_pipe("scispacy_linker")
+    return nlp, linker
 
 
 def setup_paths():
@@ -80,27 +90,21 @@ def setup_paths():
     p.mkdir(exist_ok=True, parents=True)
 
 
-def load_data(fpath: str) -> pl.DataFrame:
+def load_data(fpath: str) -> NoteTextStore:
     """Loads the data from file provided.
 
-    EXPECTS FEATHER FILE
+    EXPECTS THE NOTE TEXT STORE, it is memory mapped and read one record batch
+    at a time so the workers share the OS page cache instead of copies of the
+    texts
 
     Returns:
-        Data frame of notes with only ID and text columns
+        The store of distinct note texts, to be entered with `with`
     """
-    # manually reset index for now
-    # 97 nulls apparently in text as of today (3-29-2023)
-    df = pl.scan_ipc(fpath).select(["note_id", "NOTE_TEXT"]).drop_nulls().collect()
-    return df
+    return NoteTextStore(Path(fpath))
 
 
-def process_row(row: tuple[int, str] | None) -> list[dict[str, Any]] | None:
-    if row is None:
-        return None
-    id_, text = row
+def doc_rows(doc, text_hash: int, linker: EntityLinker) -> list[dict[str, Any]]:
     results: list[dict[str, Any]] = []
-    # run metamap
-    doc = nlp(text)
     for ent in doc.ents:
         for kb_ent in ent._.kb_ents:
             concept: LinkedEntity = linker.kb.cui_to_entity[kb_ent[0]]
@@ -110,7 +114,7 @@ def process_row(row: tuple[int, str] | None) -> list[dict[str, Any]] | None:
             # i decided to NOT make this match OMOP but instead pull what could only be determined at this runtime
             # and we can later add extra fields where OMOP wants
             data = {
-                "row_num": id_,
+                "text_hash": text_hash,
                 "cui": concept.concept_id.strip(),
                 # "name": concept.canonical_name.strip(),
                 "score": kb_ent[1],
@@ -126,21 +130,90 @@ def process_row(row: tuple[int, str] | None) -> list[dict[str, Any]] | None:
     return results
 
 
-def punk_it(row: tuple[int, str]) -> list[tuple[int, str]]:
-    results = []
-    for sent in sent_tokenize(row[1]):
-        results.append((row[0], sent))
-    return results
+def worker(tasks: multiprocessing.Queue, results: multiprocessing.Queue):
+    """Loads the model once, then runs `nlp.pipe` over tasks until a `None`.
+
+    Posts `None` when it is done, or the traceback when it raises.
+    """
+    try:
+        nlp, linker = load_model()
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            rows: list[dict[str, Any]] = []
+            for doc, text_hash in nlp.pipe(
+                task, as_tuples=True, batch_size=PIPE_BATCH_SIZE
+            ):
+                rows.extend(doc_rows(doc, text_hash, linker))
+            results.put((len(task), rows))
+    except Exception:
+        results.put(traceback.format_exc())
+        raise
+    results.put(None)
+
+
+def put_task(tasks: multiprocessing.Queue, task: Any, stop: threading.Event) -> bool:
+    """Puts a task on the queue while it is full, False once `stop` is set."""
+    while not stop.is_set():
+        try:
+            tasks.put(task, timeout=RESULT_TIMEOUT)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def feed(store: NoteTextStore, tasks: multiprocessing.Queue, stop: threading.Event):
+    """Puts the texts on the task queue, blocking while it is full."""
+    for i in range(store.num_batches):
+        # 97 nulls apparently in text as of today (3-29-2023)
+        rows = batch_texts(store.batch(i))
+        for start in range(0, len(rows), TASK_SIZE):
+            if not put_task(tasks, rows[start : start + TASK_SIZE], stop):
+                return
+    for _ in range(N_WORKERS):
+        if not put_task(tasks, None, stop):
+            return
+
+
+def abort(
+    workers: list[multiprocessing.Process],
+    tasks: multiprocessing.Queue,
+    stop: threading.Event,
+    message: str,
+):
+    """Stops the feeder and the workers, then raises with `message`."""
+    stop.set()
+    for p in workers:
+        p.terminate()
+    # nobody reads the tasks left on the queue, don't block on them at exit
+    tasks.cancel_join_thread()
+    raise RuntimeError(message)
+
+
+def check_workers(
+    workers: list[multiprocessing.Process],
+    tasks: multiprocessing.Queue,
+    stop: threading.Event,
+):
+    """Raises when a worker died, its texts would be missing from the output.
+
+    A worker killed outright, e.g. by the OOM killer, never posts anything,
+    so the others are terminated instead of waiting on it forever.
+    """
+    failed = [p for p in workers if not p.is_alive() and p.exitcode != 0]
+    if failed:
+        codes = ", ".join(str(p.exitcode) for p in failed)
+        message = f"{len(failed)} NLP worker(s) died with exit codes {codes}"
+        abort(workers, tasks, stop, message)
 
 
-def compress_output(batch: int, in_path: Path):
-    """Compresses the output file."""
-    c.log(f"[yellow]Compressing chunk:...")
+def save_output(rows: list[dict[str, Any]], batch: int):
+    """Compresses and saves a batch of results."""
+    c.log(f"[yellow]Compressing batch {batch}...")
     out_path = Path() / "data" / "scispacy_output" / "batches" / f"{batch}.feather"
-    pl.scan_ndjson(in_path).collect().write_ipc(out_path, compression="lz4")
-    # clear the output file
-    with open(in_path, "r+") as f:
-        f.truncate(0)
+    pl.from_dicts(rows).write_ipc(out_path, compression="lz4")
 
 
 def run(fpath: str) -> None:
@@ -148,53 +221,58 @@ def run(fpath: str) -> None:
 
     Args:
         fpath (str): The path to the dataset.
-        text_col (str): The text column to run Scispacy on.
-        id_col (str): The identifier column
     """
     setup_paths()
     c.log("Loading data...")
-    df = load_data(fpath=fpath)
-
-    c.log("Dicing sentences...")
-
-    # this explodes the data to multiple rows per note
-    # where the new rows/note is the # of sentences in the note
-    # rows = df.head(1000000).to_numpy()
-    rows = df.to_numpy()
-    sentence_data = []
-    # for id_, text in tqdm(rows):
-    #     sentence_data.append((id_, text))
-    # for sent in sent_tokenize(text):
-    #     sentence_data.append((id_, sent))
-
-    chunk_size = 100_000
-    sentence_chunks = list(zip_longest(*[iter(rows)] * chunk_size))
-    # sentence_chunks = list(zip_longest(*[iter(sentence_data)] * chunk_size))
-    num_chunks = len(sentence_chunks)
-    print(f"There are {num_chunks} chunks to process...")
-    del df, rows, sentence_data
-
-    c.log("NLP-ing sentences...")
-    temp_path = Path("data") / "scispacy_output" / "temp.jsonl"
-    for j, chunk in enumerate(sentence_chunks):
-        i = j + 1
-        c.log(f"[blue]Processing chunk {i}/{num_chunks}")
-        # already done
-        # if i < 133:
-        # continue
-        with open(temp_path, "wb") as f:
-            for result in p_uimap(process_row, chunk, num_cpus=48):
+    with load_data(fpath=fpath) as store:
+        c.log(f"Starting {N_WORKERS} workers...")
+        context = multiprocessing.get_context("spawn")
+        tasks = context.Queue(maxsize=QUEUE_SIZE)
+        results = context.Queue(maxsize=QUEUE_SIZE)
+        workers = [
+            context.Process(target=worker, args=(tasks, results))
+            for _ in range(N_WORKERS)
+        ]
+        for p in workers:
+            p.start()
+        stop = threading.Event()
+        feeder = threading.Thread(target=feed, args=(store, tasks, stop), daemon=True)
+        feeder.start()
+
+        c.log("NLP-ing notes...")
+        output: list[dict[str, Any]] = []
+        batch = 0
+        running = N_WORKERS
+        with tqdm(total=store.num_texts, desc="Processing notes...") as progress:
+            while running > 0:
+                try:
+                    result = results.get(timeout=RESULT_TIMEOUT)
+                except queue.Empty:
+                    check_workers(workers, tasks, stop)
+                    continue
                 if result is None:
+                    running -= 1
                     continue
-                for line in result:
-                    f.write(orjson.dumps(line) + b"\n")
-        c.log(f"[green]Finished chunk: {i}/{num_chunks}...")
-
-        # take output, collect it, and write it to a feather file
-        # then clear the output
-        # this is to help with storage and memory
-        compress_output(batch=i, in_path=temp_path)
-
+                if isinstance(result, str):
+                    abort(workers, tasks, stop, f"An NLP worker raised:\n{result}")
+                n_texts, rows = result
+                output.extend(rows)
+                progress.update(n_texts)
+                if len(output) >= OUTPUT_BATCH_SIZE:
+                    batch += 1
+                    save_output(output, batch)
+                    output = []
+        if output:
+            batch += 1
+            save_output(output, batch)
+
+        # a dead worker would leave the feeder blocked on a full queue, so the
+        # workers are checked before joining it
+        check_workers(workers, tasks, stop)
+        feeder.join()
+        for p in workers:
+            p.join()
+        check_workers(workers, tasks, stop)
     c.log("[green]Done!")
 
 
@@ -210,5 +288,5 @@ if __name__ == "__main__":
         help="The file to run Scispacy on. Must be a feather file.",
     )
     args = parser.parse_args()
-    # run(fpath="data/notes.feather")
+    # run(fpath="data/note_texts.feather")
     run(fpath=args.file)
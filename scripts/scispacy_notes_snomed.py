@@ -4,6 +4,7 @@ from itertools import zip_longest
 import json
 import multiprocessing
 import subprocess
+import sys
 from pathlib import Path
 import time
 from typing import Any, Iterator
@@ -41,12 +42,29 @@ import polars as pl
 from tqdm import tqdm
 from negspacy.negation import Negex
 
+# the note store helpers live with the pipeline in `omop/`
+sys.path.append(str(Path(__file__).resolve().parent.parent / "omop"))
+from note_texts import NOTE_TEXTS_FILE, NoteTextStore
+
 
 print("Downloading `punkt` sentence tokenizer...")
 # nltk.download("punkt")
 
 c = Console()
 
+parser = argparse.ArgumentParser(
+    prog="scispacy_notes_snomed",
+    description="Runs Scispacy with the SNOMED linker on the note text store.",
+)
+parser.add_argument(
+    "--file",
+    "-f",
+    type=str,
+    default=str(NOTE_TEXTS_FILE),
+    help="The note text store to run on. Must be a feather file.",
+)
+args = parser.parse_args()
+
 SNOMED_LINKER_PATHS = LinkerPaths(
     ann_index="models/nmslib_index.bin",
     tfidf_vectorizer="models/tfidf_vectorizer.joblib",
@@ -92,44 +110,52 @@ nlp.add_pipe(
 
 c.log("Done initializing Scispacy.")
 
-c.log("Loading notes")
-# read notes making sure no NA
-notes = pl.scan_ipc("../data/notes.feather").drop_nulls(subset=["NOTE_TEXT"])
-document_data = [
-    (
-        row[1],  # note
-        {"row_num": row[0]},  # context
-    )
-    for row in tqdm(
-        notes.select(["note_id", "NOTE_TEXT"]).collect().to_numpy(),
-        desc="Making tuples...",
-    )
-]
-del notes
-c.log("Done loading notes.")
+c.log("NLP...")
 
+# mentions per output partition
+FILE_BATCH_SIZE = 1_000_000
+OUTPUT_DIR = Path("../data/snomed_output")
+OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+nlp_datetime = datetime.datetime.now()
 
 
-c.log("NLP...")
+def write_partition(rows: list[dict], part: int):
+    pl.DataFrame(rows).write_parquet(OUTPUT_DIR / f"part-{part:05d}.parquet")
+
 
-with open("snomed_output.jsonl", "wb") as f:
-    for doc, context in tqdm(
-        nlp.pipe(document_data, as_tuples=True, batch_size=1_000, n_process=-1),
+rows = []
+part = 0
+# every distinct note text once, results are fanned out to the notes by hash
+with NoteTextStore(Path(args.file)) as store:
+    for doc, text_hash in tqdm(
+        nlp.pipe(store.iter_texts(), as_tuples=True, batch_size=1_000, n_process=-1),
         desc="Processing notes...",
-        total=len(document_data),
+        total=store.num_texts,
     ):
         for ent in doc.ents:
             for kb_ent in ent._.kb_ents:
                 concept: LinkedEntity = linker.kb.cui_to_entity[kb_ent[0]]
-                data = {
-                    "row_num": context["row_num"],
-                    # ! changed to `suid` since its not UMLS cui anymore
-                    "suid": concept.concept_id.strip(),
-                    "name": concept.canonical_name.strip(),
-                    "score": kb_ent[1],
-                    "negated": ent._.negex,
-                    "entity": ent.text.strip(),
-                }
-                f.write(orjson.dumps(data) + b"\n")
+                rows.append(
+                    {
+                        "text_hash": text_hash,
+                        # ! changed to `suid` since its not UMLS cui anymore
+                        "suid": concept.concept_id.strip(),
+                        "name": concept.canonical_name.strip(),
+                        "score": kb_ent[1],
+                        "negated": ent._.negex,
+                        "entity": ent.text.strip(),
+                        # character offsets into the note text
+                        "start_char": ent.start_char,
+                        "end_char": ent.end_char,
+                        "nlp_datetime": nlp_datetime,
+                    }
+                )
+        # texts come back in order so every partition covers a range of the store
+        if len(rows) >= FILE_BATCH_SIZE:
+            write_partition(rows, part)
+            rows = []
+            part += 1
+if rows:
+    write_partition(rows, part)
 
 c.log("Done NLP.")